@@ -0,0 +1,93 @@
+"""
+Accessor calls and mapping time per invoice with and without the
+per-invoice accessor memoization of the mappers::
+
+    python benchmarks/bench_accessors.py --invoices 20000 --cost 0.00001
+
+`--cost` simulates the seconds each accessor spends, e.g. on an ORM
+lookup.
+"""
+import argparse
+import time
+from collections import Counter
+from datetime import date
+
+from pyAEATsii import mapping
+
+_FIELDS = (
+    'year', 'period', 'nif', 'serial_number', 'issue_date', 'invoice_kind',
+    'specialkey_or_trascendence', 'description', 'not_exempt_kind',
+    'exempt_kind', 'counterpart_name', 'counterpart_nif',
+    'counterpart_id_type', 'counterpart_country', 'counterpart_id',
+    'untaxed_amount', 'total_amount', 'taxes',
+)
+_TAX_FIELDS = (
+    'tax_rate', 'tax_base', 'tax_amount',
+    'tax_equivalence_surcharge_rate', 'tax_equivalence_surcharge_amount',
+)
+
+
+def _mapper_class(calls, cost, memoized):
+
+    def accessor(name):
+        def get(invoice):
+            calls[name] += 1
+            if cost:
+                end = time.time() + cost
+                while time.time() < end:
+                    pass
+            return invoice.get(name)
+        return staticmethod(get)
+
+    attrs = dict((name, accessor(name)) for name in _FIELDS + _TAX_FIELDS)
+    if memoized:
+        attrs['_memoized_accessors'] = \
+            mapping.IssuedInvoiceMapper._invoice_accessors
+    return type('Mapper', (mapping.IssuedInvoiceMapper,), attrs)
+
+
+def _invoice(n):
+    return {
+        'year': 2017,
+        'period': 5,
+        'nif': '00000010X',
+        'serial_number': str(n),
+        'issue_date': date(2017, 5, 1),
+        'invoice_kind': 'F1',
+        'specialkey_or_trascendence': '01',
+        'description': 'Invoice %d' % n,
+        'not_exempt_kind': 'S1',
+        'counterpart_name': 'Counterpart',
+        'counterpart_nif': 'LT00000011B',
+        'counterpart_id_type': '02',
+        'counterpart_country': 'LT',
+        'counterpart_id': 'LT00000011B',
+        'untaxed_amount': 100,
+        'total_amount': 121,
+        'taxes': [{'tax_rate': .21, 'tax_base': 100, 'tax_amount': 21}],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--invoices', type=int, default=20000)
+    parser.add_argument('--cost', type=float, default=0.)
+    args = parser.parse_args()
+
+    invoices = [_invoice(n) for n in range(args.invoices)]
+    print('memoized  calls/invoice  us/invoice')
+    for memoized in (False, True):
+        calls = Counter()
+        mapper = _mapper_class(calls, args.cost, memoized)()
+        start = time.time()
+        for invoice in invoices:
+            mapper.build_submit_request(invoice)
+        elapsed = time.time() - start
+        invoice_calls = sum(calls[f] for f in _FIELDS)
+        print('%8s  %13.1f  %10.1f' % (
+            memoized, float(invoice_calls) / len(invoices),
+            elapsed * 1e6 / len(invoices)))
+
+
+if __name__ == '__main__':
+    main()
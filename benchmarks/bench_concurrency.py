@@ -0,0 +1,70 @@
+"""
+Throughput of submit_many against a local pyAEATsii.mockserver endpoint.
+
+The service is bound as usual, with the test WSDLs of tests/data and its
+own connection pool sized to the number of workers, and sent to the
+endpoint through `address`, so every batch is serialized by zeep and
+posted over the pooled session. The endpoint answers after a fixed
+latency, simulating the AEAT round trip, so the numbers show how
+throughput scales with the number of batches in flight::
+
+    python benchmarks/bench_concurrency.py --batches 32 --latency 0.2
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pyAEATsii import mapping
+from pyAEATsii import service
+from pyAEATsii.compiled import compile_mapper
+from pyAEATsii.mockserver import MockSIIServer
+
+import invoices
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from tests.stub import seeded_cache  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--batches', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    headers = mapping.get_headers(
+        name='Benchmark', vat='00000010X', comm_kind='A0')
+    mapper = compile_mapper(invoices.MAPPERS['issued']())
+    batch = invoices.generate(args.batches * args.batch_size, seed=args.seed)
+    cache_path = tempfile.mkdtemp(prefix='pyAEATsii-bench-')
+    wsdl_cache = seeded_cache(cache_path, base=service.wsdl_base)
+    print('workers  seconds  batches/s  invoices/s  peak')
+    try:
+        with MockSIIServer(latency=args.latency) as server:
+            for workers in args.workers:
+                server.reset()
+                svc = service.bind_issued_invoices_service(
+                    None, None, cache=wsdl_cache, offline=True,
+                    address=server.url, pool_maxsize=workers)
+                start = time.time()
+                svc.submit_many(
+                    headers, batch, mapper, batch_size=args.batch_size,
+                    max_workers=workers)
+                elapsed = time.time() - start
+                print('%7d  %7.2f  %9.1f  %10.1f  %4d' % (
+                    workers, elapsed, args.batches / elapsed,
+                    len(batch) / elapsed, server.peak_concurrency))
+    finally:
+        shutil.rmtree(cache_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Mapping throughput, serialization time, peak memory of a submission and
+round trip latency against a local MockSIIServer, on the synthetic
+invoices of benchmarks/invoices.py::
+
+    python benchmarks/bench_suite.py --output baseline.json
+    python benchmarks/bench_suite.py --compare baseline.json
+
+Every metric is written to the JSON report with its unit and whether
+higher or lower is better. With `--compare`, metrics that got worse by
+more than `--threshold` (10% by default) are flagged and the exit
+status is 1, so a branch can be checked against a baseline run on the
+same machine.
+
+The WSDL documents are read from the pyAEATsii.cache.WsdlCache under
+`--cache`, as left by binding the services. Without it the reduced
+schemas of tests/data are used, which only cover issued invoices, so
+serialization, memory and round trips are then measured for issued
+invoices alone.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import lxml
+import zeep
+from lxml import etree
+
+from pyAEATsii import columnar
+from pyAEATsii import mapping
+from pyAEATsii import service
+from pyAEATsii.cache import WsdlCache
+from pyAEATsii.compiled import compile_mapper
+from pyAEATsii.mockserver import MockSIIServer
+from pyAEATsii.serializer import iter_envelope
+
+import invoices
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+_DATA = os.path.join(_ROOT, 'tests', 'data')
+
+_SECTIONS = ('mapping', 'serialization', 'memory', 'round_trip')
+
+_COLUMNAR_MAPPERS = {
+    'issued': columnar.IssuedColumnarMapper,
+    'recieved': columnar.RecievedColumnarMapper,
+}
+
+# book: (WSDL, submit operation, bind function)
+_BOOKS = {
+    'issued': (
+        'SuministroFactEmitidas.wsdl', 'SuministroLRFacturasEmitidas',
+        service.bind_issued_invoices_service),
+    'recieved': (
+        'SuministroFactRecibidas.wsdl', 'SuministroLRFacturasRecibidas',
+        service.bind_recieved_invoices_service),
+}
+
+# ru_maxrss is in bytes on macOS, KiB elsewhere
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_MIB = 1024. * 1024
+
+
+def _headers():
+    return mapping.get_headers(
+        name='Benchmark', vat='00000010X', comm_kind='A0')
+
+
+def _rss():
+    """
+    (current, peak) resident set size of this process, in bytes. Linux
+    carries ru_maxrss over from the parent process, so VmHWM is read
+    instead where available.
+    """
+    try:
+        with open('/proc/self/status') as fh:
+            status = dict(line.split(':', 1) for line in fh)
+        return tuple(
+            int(status[name].split()[0]) * 1024
+            for name in ('VmRSS', 'VmHWM'))
+    except (IOError, KeyError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+        return peak, peak
+
+
+def _best(function, repeat):
+    """Shortest of `repeat` timed calls, the least disturbed one"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class Report(object):
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.metrics = {}
+
+    def add(self, name, value, unit, better):
+        self.metrics[name] = {
+            'value': value, 'unit': unit, 'better': better}
+        print('%-48s %14.4f %s' % (name, value, unit))
+
+    def to_json(self):
+        return {'meta': self.meta, 'metrics': self.metrics}
+
+
+def _meta(args, temporary):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=_ROOT,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'zeep': zeep.__version__,
+        'lxml': lxml.__version__,
+        'args': vars(args),
+        # The reduced schemas of tests/data or those of --cache
+        'schemas': 'tests/data' if temporary else args.cache,
+    }
+
+
+def _wsdl_cache(path):
+    """(cache path, whether it is a temporary copy of tests/data)"""
+    if path:
+        return path, False
+    path = tempfile.mkdtemp(prefix='pyAEATsii-bench-')
+    cache = WsdlCache(path)
+    for name in os.listdir(_DATA):
+        with open(os.path.join(_DATA, name), 'rb') as fh:
+            cache.add(service.wsdl_base + name, fh.read())
+    return path, True
+
+
+def _bind(book, cache_path, **kwargs):
+    return _BOOKS[book][2](
+        None, None, cache=WsdlCache(cache_path), offline=True, **kwargs)
+
+
+def _records(book, count, seed):
+    mapper = compile_mapper(invoices.MAPPERS[book]())
+    return [
+        mapper.build_submit_request(invoice)
+        for invoice in invoices.generate(count, book, seed)]
+
+
+def bench_mapping(report, args, books):
+    for book in sorted(invoices.MAPPERS):
+        batch = invoices.generate(args.invoices, book, args.seed)
+        mapper = invoices.MAPPERS[book]()
+        for variant, mapper in (
+                ('plain', mapper), ('compiled', compile_mapper(mapper))):
+            for method in ('build_submit_request', 'build_delete_request'):
+                build = getattr(mapper, method)
+                seconds = _best(
+                    lambda: [build(invoice) for invoice in batch],
+                    args.repeat)
+                report.add(
+                    'mapping.%s.%s.%s' % (book, variant, method[6:-8]),
+                    len(batch) / seconds, 'invoices/s', 'higher')
+        # Columns are read out of the warehouse as such, their building
+        # is left out
+        columns = invoices.to_columns(batch)
+        mapper = _COLUMNAR_MAPPERS[book]()
+        for method in ('build_submit_requests', 'build_delete_requests'):
+            build = getattr(mapper, method)
+            seconds = _best(lambda: build(columns), args.repeat)
+            report.add(
+                'mapping.%s.columnar.%s' % (book, method[6:-9]),
+                len(batch) / seconds, 'invoices/s', 'higher')
+
+
+def bench_serialization(report, args, books):
+    headers = _headers()
+    for book in books:
+        operation = _BOOKS[book][1]
+        records = _records(book, args.batch_size, args.seed)
+        svc = _bind(book, args.cache_path)
+        client = svc.service._client
+
+        def zeep_envelope():
+            return etree.tostring(client.create_message(
+                svc.service, operation, headers, records))
+
+        def streamed_envelope():
+            return b''.join(iter_envelope(operation, headers, records))
+
+        for variant, build in (
+                ('zeep', zeep_envelope), ('stream', streamed_envelope)):
+            report.add(
+                'serialization.%s.%s.seconds' % (book, variant),
+                _best(build, args.repeat), 's', 'lower')
+            report.add(
+                'serialization.%s.%s.size' % (book, variant),
+                len(build()) / _MIB, 'MiB', 'lower')
+
+
+def _submit_peak(book, cache_path, url, count, seed, stream):
+    """RSS before a submission and its peak, in a fresh process"""
+    records = _records(book, count, seed)
+    svc = _bind(book, cache_path, address=url)
+    before = _rss()[0]
+    batch = svc.submit(_headers(), records, stream=stream, result='batch')
+    assert len(batch) == count
+    return before, _rss()[1]
+
+
+def bench_memory(report, args, books):
+    context = multiprocessing.get_context('spawn')
+    with MockSIIServer(max_batch_size=args.batch_size) as server:
+        for book in books:
+            for variant, stream in (('zeep', False), ('stream', True)):
+                server.reset()
+                with context.Pool(1) as pool:
+                    before, peak = pool.apply(_submit_peak, (
+                        book, args.cache_path, server.url,
+                        args.batch_size, args.seed, stream))
+                name = 'memory.%s.%s' % (book, variant)
+                report.add(name + '.peak_rss', peak / _MIB, 'MiB', 'lower')
+                report.add(
+                    name + '.submit_rss', (peak - before) / _MIB, 'MiB',
+                    'lower')
+
+
+def bench_round_trip(report, args, books):
+    headers = _headers()
+    with MockSIIServer(latency=args.latency) as server:
+        for book in books:
+            mapper = compile_mapper(invoices.MAPPERS[book]())
+            batch_count = args.round_trips
+            batch = invoices.generate(
+                args.round_trip_size * batch_count, book, args.seed)
+            batches = [
+                batch[i:i + args.round_trip_size]
+                for i in range(0, len(batch), args.round_trip_size)]
+            svc = _bind(book, args.cache_path, address=server.url)
+            for variant, stream in (('zeep', False), ('stream', True)):
+                server.reset()
+                latencies = []
+                start = time.perf_counter()
+                for invoices_ in batches:
+                    sent = time.perf_counter()
+                    svc.submit(
+                        headers, invoices_, mapper, stream=stream,
+                        result='batch')
+                    latencies.append(time.perf_counter() - sent)
+                elapsed = time.perf_counter() - start
+                name = 'round_trip.%s.%s' % (book, variant)
+                report.add(
+                    name + '.p50', _percentile(latencies, .5), 's', 'lower')
+                report.add(
+                    name + '.p95', _percentile(latencies, .95), 's', 'lower')
+                report.add(
+                    name + '.throughput', len(batch) / elapsed,
+                    'invoices/s', 'higher')
+
+
+def compare(baseline, current, threshold):
+    """Print the change of every metric, return the number of regressions"""
+    regressions = 0
+    print('\n%-48s %12s %12s %8s' % (
+        'metric', 'baseline', 'current', 'change'))
+    for name, metric in sorted(current['metrics'].items()):
+        base = baseline['metrics'].get(name)
+        if base is None or not base['value']:
+            continue
+        change = (metric['value'] - base['value']) / base['value']
+        worse = -change if metric['better'] == 'higher' else change
+        flag = ''
+        if worse > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif worse < -threshold:
+            flag = 'improved'
+        print('%-48s %12.4f %12.4f %+7.1f%% %s' % (
+            name, base['value'], metric['value'], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--only', nargs='+', choices=_SECTIONS, default=list(_SECTIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--invoices', type=int, default=10000,
+        help='invoices mapped per mapping run')
+    parser.add_argument(
+        '--batch-size', type=int, default=service.MAX_BATCH_SIZE,
+        help='records per serialized and memory measured batch')
+    parser.add_argument('--round-trips', type=int, default=20)
+    parser.add_argument('--round-trip-size', type=int, default=500)
+    parser.add_argument(
+        '--latency', type=float, default=0.,
+        help='seconds the mock server waits before answering')
+    parser.add_argument('--cache', help='WsdlCache path holding the WSDLs')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--compare', help='JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=.1)
+    args = parser.parse_args()
+
+    args.cache_path, temporary = _wsdl_cache(args.cache)
+    cache = WsdlCache(args.cache_path)
+    books = [
+        book for book in sorted(_BOOKS)
+        if cache.get(service.wsdl_base + _BOOKS[book][0], expired=True)]
+    report = Report(_meta(args, temporary))
+    try:
+        for section in _SECTIONS:
+            if section in args.only:
+                globals()['bench_' + section](report, args, books)
+    finally:
+        if temporary:
+            shutil.rmtree(args.cache_path)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report.to_json(), fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if compare(baseline, report.to_json(), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Repeatable synthetic invoices for the benchmarks, as dicts read by the
+mappers below.
+
+generate() cycles through every combination of invoice kind, tax mix and
+counterpart type of a book, so any run of at least combinations(book)
+invoices covers them all, while amounts and dates are drawn from a
+random generator seeded with `seed`.
+"""
+import itertools
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from operator import methodcaller
+
+from pyAEATsii import mapping
+
+ISSUED_KINDS = ('F1', 'F2', 'F3', 'F4', 'R1', 'R2', 'R3', 'R4', 'R5')
+RECIEVED_KINDS = ISSUED_KINDS + ('F5', 'F6', 'LC')
+
+# Tax mix: (not exempt kind, exempt kind, special key, taxes as
+# (rate, surcharge rate, REAGYP rate) tuples)
+TAX_MIXES = {
+    'single': ('S1', None, '01', [(Decimal('.21'), None, None)]),
+    'multiple': ('S1', None, '01', [
+        (Decimal('.21'), None, None),
+        (Decimal('.10'), None, None),
+        (Decimal('.04'), None, None)]),
+    'surcharge': ('S1', None, '01', [
+        (Decimal('.21'), Decimal('.052'), None),
+        (Decimal('.10'), Decimal('.014'), None)]),
+    'exempt': (None, 'E1', '01', []),
+    'reverse_charge': ('S2', None, '01', []),
+    'location_rules': (None, None, '08', []),
+    'reagyp': ('S1', None, '02', [(Decimal('.12'), None, Decimal('.12'))]),
+}
+
+# Counterpart: (NIF prefix, IDOtro type, country)
+COUNTERPARTS = {
+    'national': ('', None, 'ES'),
+    'ceuta_melilla': ('N', None, 'ES'),
+    'eu_vat': ('LT', '02', 'LT'),
+    'passport': ('', '03', 'US'),
+    'foreign_id': ('', '04', 'MX'),
+    'residence': ('', '05', 'AR'),
+    'other_document': ('', '06', 'CN'),
+    'not_registered': ('', '07', 'FR'),
+}
+
+_CENT = Decimal('0.01')
+
+
+class _Accessors(object):
+    """Accessors reading the invoice dicts of generate()"""
+    year = methodcaller('get', 'year')
+    period = methodcaller('get', 'period')
+    nif = methodcaller('get', 'nif')
+    serial_number = methodcaller('get', 'serial_number')
+    final_serial_number = methodcaller('get', 'final_serial_number')
+    issue_date = methodcaller('get', 'issue_date')
+    invoice_kind = methodcaller('get', 'invoice_kind')
+    rectified_invoice_kind = methodcaller('get', 'rectified_invoice_kind')
+    rectified_base = methodcaller('get', 'rectified_base')
+    rectified_amount = methodcaller('get', 'rectified_amount')
+    specialkey_or_trascendence = methodcaller(
+        'get', 'specialkey_or_trascendence')
+    description = methodcaller('get', 'description')
+    not_exempt_kind = methodcaller('get', 'not_exempt_kind')
+    exempt_kind = methodcaller('get', 'exempt_kind')
+    counterpart_name = methodcaller('get', 'counterpart_name')
+    counterpart_nif = methodcaller('get', 'counterpart_nif')
+    counterpart_id_type = methodcaller('get', 'counterpart_id_type')
+    counterpart_country = methodcaller('get', 'counterpart_country')
+    counterpart_id = methodcaller('get', 'counterpart_nif')
+    untaxed_amount = methodcaller('get', 'untaxed_amount')
+    total_amount = methodcaller('get', 'total_amount')
+    taxes = methodcaller('get', 'taxes')
+    tax_rate = methodcaller('get', 'tax_rate')
+    tax_base = methodcaller('get', 'tax_base')
+    tax_amount = methodcaller('get', 'tax_amount')
+    tax_equivalence_surcharge_rate = methodcaller(
+        'get', 'tax_equivalence_surcharge_rate')
+    tax_equivalence_surcharge_amount = methodcaller(
+        'get', 'tax_equivalence_surcharge_amount')
+    tax_reagyp_rate = methodcaller('get', 'tax_reagyp_rate')
+    tax_reagyp_amount = methodcaller('get', 'tax_reagyp_amount')
+
+
+class IssuedMapper(_Accessors, mapping.IssuedInvoiceMapper):
+    pass
+
+
+class RecievedMapper(_Accessors, mapping.RecievedInvoiceMapper):
+    move_date = methodcaller('get', 'move_date')
+    sent_date = methodcaller('get', 'move_date')
+    deductible_amount = methodcaller('get', 'deductible_amount')
+
+
+MAPPERS = {
+    'issued': IssuedMapper,
+    'recieved': RecievedMapper,
+}
+
+
+def _combinations(book):
+    kinds = ISSUED_KINDS if book == 'issued' else RECIEVED_KINDS
+    return [
+        combo for combo in itertools.product(
+            kinds, sorted(TAX_MIXES), sorted(COUNTERPARTS))
+        # Simplified rectifications must be subject to VAT
+        if combo[:2] != ('R5', 'location_rules')
+    ]
+
+
+def combinations(book='issued'):
+    """Number of (kind, tax mix, counterpart) combinations of a book"""
+    return len(_combinations(book))
+
+
+def _taxes(rng, rates):
+    taxes = []
+    for rate, surcharge, reagyp in rates:
+        base = (Decimal(rng.randint(100, 1000000)) / 100).quantize(_CENT)
+        tax = {
+            'tax_rate': rate,
+            'tax_base': base,
+            'tax_amount': (base * rate).quantize(_CENT),
+        }
+        if surcharge is not None:
+            tax['tax_equivalence_surcharge_rate'] = surcharge
+            tax['tax_equivalence_surcharge_amount'] = (
+                base * surcharge).quantize(_CENT)
+        if reagyp is not None:
+            tax['tax_reagyp_rate'] = reagyp
+            tax['tax_reagyp_amount'] = (base * reagyp).quantize(_CENT)
+        taxes.append(tax)
+    return taxes
+
+
+def generate(count, book='issued', seed=0, nif='00000010X', year=2017):
+    """List `count` invoices of `book` (issued or recieved)"""
+    rng = random.Random(seed)
+    combos = _combinations(book)
+    start = date(year, 1, 1)
+    invoices = []
+    for n in range(count):
+        kind, mix, counterpart = combos[n % len(combos)]
+        not_exempt, exempt, special_key, rates = TAX_MIXES[mix]
+        prefix, id_type, country = COUNTERPARTS[counterpart]
+        issue_date = start + timedelta(days=rng.randint(0, 364))
+        taxes = _taxes(rng, rates)
+        untaxed = (
+            sum(tax['tax_base'] for tax in taxes)
+            or (Decimal(rng.randint(100, 1000000)) / 100).quantize(_CENT))
+        total = untaxed + sum(
+            tax['tax_amount'] + tax.get(
+                'tax_equivalence_surcharge_amount', 0)
+            for tax in taxes)
+        invoice = {
+            'year': year,
+            'period': issue_date.month,
+            'nif': nif,
+            'serial_number': 'B%d-%08d' % (seed, n),
+            'final_serial_number': 'B%d-%08d-FIN' % (seed, n),
+            'issue_date': issue_date,
+            'move_date': issue_date + timedelta(days=rng.randint(0, 30)),
+            'invoice_kind': kind,
+            'specialkey_or_trascendence': special_key,
+            'description': 'Synthetic %s %s invoice %d' % (kind, mix, n),
+            'not_exempt_kind': not_exempt,
+            'exempt_kind': exempt,
+            'counterpart_name': 'Counterpart %d' % rng.randint(1, 5000),
+            'counterpart_nif': '%s%08dZ' % (prefix, rng.randint(0, 99999999)),
+            'counterpart_id_type': id_type,
+            'counterpart_country': country,
+            'untaxed_amount': untaxed,
+            'total_amount': total,
+            'deductible_amount': sum(tax['tax_amount'] for tax in taxes),
+            'taxes': taxes,
+        }
+        if kind in mapping.RECTIFIED_KINDS:
+            invoice['rectified_invoice_kind'] = rng.choice('SI')
+            invoice['rectified_base'] = untaxed
+            invoice['rectified_amount'] = total - untaxed
+        invoices.append(invoice)
+    return invoices
+
+
+# Columns whose accessor reads another field, as in _Accessors
+_ALIASES = {
+    'counterpart_id': 'counterpart_nif',
+    'sent_date': 'move_date',
+}
+
+_TAX_FIELDS = (
+    'tax_rate',
+    'tax_base',
+    'tax_amount',
+    'tax_equivalence_surcharge_rate',
+    'tax_equivalence_surcharge_amount',
+    'tax_reagyp_rate',
+    'tax_reagyp_amount',
+)
+
+
+def to_columns(invoices):
+    """
+    The columns of `invoices` for pyAEATsii.columnar, as lists: one per
+    accessor, the tax lines flattened with their tax_offsets
+    """
+    names = set(name for invoice in invoices for name in invoice)
+    names.discard('taxes')
+    columns = dict(
+        (name, [invoice.get(name) for invoice in invoices])
+        for name in names)
+    for alias, name in _ALIASES.items():
+        columns[alias] = columns[name]
+    taxes = [tax for invoice in invoices for tax in invoice['taxes']]
+    for name in _TAX_FIELDS:
+        columns[name] = [tax.get(name) for tax in taxes]
+    offsets = columns['tax_offsets'] = [0]
+    for invoice in invoices:
+        offsets.append(offsets[-1] + len(invoice['taxes']))
+    return columns
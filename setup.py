@@ -3,7 +3,10 @@ from setuptools import setup
 from setuptools import find_packages
 
 install_requires = [
-    'zeep>=1.6',
+    # Client.settings, serialize_object(obj, target_cls) and
+    # Binding._create(client=, options=)
+    'zeep>=3.0',
+    'futures; python_version < "3"',
 ]
 
 tests_require = [
@@ -24,6 +27,9 @@ setup(
     tests_require=tests_require,
     extras_require={
         'test': tests_require,
+        'async': ['zeep[async]>=4'],
+        'prometheus': ['prometheus_client'],
+        'numpy': ['numpy'],
     },
     entry_points={},
     package_dir={'': 'src'},
@@ -0,0 +1,147 @@
+"""
+asyncio bindings of the SII services, built on zeep's AsyncTransport.
+
+Requires Python 3 and zeep's async extras (``pip install pyAEATsii[async]``).
+"""
+
+__all__ = [
+    'bind_issued_invoices_service',
+    'bind_recieved_invoices_service',
+]
+
+import ssl
+from logging import getLogger
+
+import httpx
+from zeep import AsyncClient
+from zeep.transports import AsyncTransport
+
+from .cache import OfflineTransportMixin
+from .plugins import LoggingPlugin
+from .plugins import SessionIdPlugin
+from .mapping import build_query_filter
+from .service import _build_body
+from .service import _get_history_plugin
+from .service import _InvoiceService
+from .service import _pagination_key
+from .service import _IssuedInvoiceService
+from .service import _RecievedInvoiceService
+from . import service
+
+_logger = getLogger(__name__)
+
+
+class _OfflineAsyncTransport(OfflineTransportMixin, AsyncTransport):
+    pass
+
+
+def _get_client(
+        wsdl, public_crt, private_key, test=False, cache=None,
+        offline=False, history=None, plugins=None, session_id=True):
+    context = ssl.create_default_context()
+    context.load_cert_chain(public_crt, private_key)
+    transport = (_OfflineAsyncTransport if offline else AsyncTransport)(
+        client=httpx.AsyncClient(verify=context), cache=cache)
+    plugins = list(plugins or [])
+    if history:
+        plugins.append(_get_history_plugin(history))
+    if session_id:
+        plugins.append(SessionIdPlugin(cookies=transport.client.cookies))
+    if test:
+        plugins.append(LoggingPlugin())
+    client = AsyncClient(wsdl=wsdl, transport=transport, plugins=plugins)
+    return client
+
+
+def bind_issued_invoices_service(crt, pkey, test=False, **kwargs):
+    wsdl = service.wsdl_base + 'SuministroFactEmitidas.wsdl'
+    port_name = 'SuministroFactEmitidas'
+    if test:
+        port_name += 'Pruebas'
+
+    cli = _get_client(wsdl, crt, pkey, test, **kwargs)
+
+    return _AsyncIssuedInvoiceService(
+        cli.bind('siiService', port_name))
+
+
+def bind_recieved_invoices_service(crt, pkey, test=False, **kwargs):
+    wsdl = service.wsdl_base + 'SuministroFactRecibidas.wsdl'
+    port_name = 'SuministroFactRecibidas'
+    if test:
+        port_name += 'Pruebas'
+
+    cli = _get_client(wsdl, crt, pkey, test, **kwargs)
+
+    return _AsyncRecievedInvoiceService(
+        cli.bind('siiService', port_name))
+
+
+class _AsyncInvoiceService(object):
+    _submit_operation = None
+    _cancel_operation = None
+    _query_operation = None
+    _query_records = None
+
+    history = _InvoiceService.history
+
+    def __init__(self, service):
+        self.service = service
+
+    async def _call(self, operation, headers, body):
+        _logger.debug(body)
+        response_ = await getattr(self.service, operation)(headers, body)
+        _logger.debug(response_)
+        return response_
+
+    async def submit(self, headers, invoices, mapper=None):
+        body = _build_body(invoices, mapper, 'build_submit_request')
+        return await self._call(self._submit_operation, headers, body)
+
+    async def cancel(self, headers, invoices, mapper=None):
+        body = _build_body(invoices, mapper, 'build_delete_request')
+        return await self._call(self._cancel_operation, headers, body)
+
+    async def query(self, headers, year=None, period=None, **filters):
+        filter_ = build_query_filter(year=year, period=period, **filters)
+        return await self._call(self._query_operation, headers, filter_)
+
+    async def query_iter(self, headers, year=None, period=None, **filters):
+        """Async counterpart of the sync service's query_iter"""
+        key = None
+        while True:
+            response = await self.query(
+                headers, year, period, pagination_key=key, **filters)
+            records = response[self._query_records] or []
+            if not records or response['IndicadorPaginacion'] != 'S':
+                key = None
+            else:
+                key = _pagination_key(records[-1])
+            response = None
+            for record in records:
+                yield record
+            if key is None:
+                return
+
+    async def aclose(self):
+        await self.service._client.transport.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+class _AsyncIssuedInvoiceService(_AsyncInvoiceService):
+    _submit_operation = _IssuedInvoiceService._submit_operation
+    _cancel_operation = _IssuedInvoiceService._cancel_operation
+    _query_operation = _IssuedInvoiceService._query_operation
+    _query_records = _IssuedInvoiceService._query_records
+
+
+class _AsyncRecievedInvoiceService(_AsyncInvoiceService):
+    _submit_operation = _RecievedInvoiceService._submit_operation
+    _cancel_operation = _RecievedInvoiceService._cancel_operation
+    _query_operation = _RecievedInvoiceService._query_operation
+    _query_records = _RecievedInvoiceService._query_records
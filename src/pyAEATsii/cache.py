@@ -0,0 +1,96 @@
+
+__all__ = [
+    'WsdlCache',
+    'OfflineTransport',
+    'default_cache_path',
+]
+
+import errno
+import os
+import tempfile
+import time
+from logging import getLogger
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from zeep.transports import Transport
+
+_logger = getLogger(__name__)
+
+# Python 2 has no os.replace, its os.rename replaces files but on Windows
+_replace = getattr(os, 'replace', os.rename)
+
+
+def default_cache_path():
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'),
+        'pyAEATsii')
+
+
+class WsdlCache(object):
+    """
+    zeep compatible cache that keeps the WSDL and XSD documents as plain
+    files, one per URL, under `path`/`version`. Entries older than
+    `timeout` seconds are refetched; with the default None they never
+    expire, since AEAT publishes every schema version under its own URL.
+    """
+
+    def __init__(self, path=None, timeout=None, version='default'):
+        self.path = os.path.join(path or default_cache_path(), version)
+        self.timeout = timeout
+
+    def _filename(self, url):
+        return os.path.join(self.path, quote(url, safe=''))
+
+    def get(self, url, expired=False):
+        filename = self._filename(url)
+        try:
+            if (
+                    not expired and self.timeout is not None
+                    and time.time() - os.path.getmtime(filename)
+                    > self.timeout):
+                _logger.debug('Cache expired for %s', url)
+                return None
+            with open(filename, 'rb') as fh:
+                return fh.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def add(self, url, content):
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write then rename so concurrent readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(content)
+            _replace(tmp, self._filename(url))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+class OfflineTransportMixin(object):
+    """Serve documents from the cache only, even expired ones"""
+
+    def _load_remote_data(self, url):
+        content = self.cache.get(url, expired=True) if self.cache else None
+        if content is None:
+            raise IOError('%s is not cached and binding is offline' % url)
+        return content
+
+
+class OfflineTransport(OfflineTransportMixin, Transport):
+    pass
@@ -0,0 +1,113 @@
+
+__all__ = [
+    'ChangeIndex',
+    'payload_hash',
+]
+
+import hashlib
+import json
+import sqlite3
+import time
+
+from .results import ACCEPTED_WITH_ERRORS, CORRECT, record_key
+from .service import MAX_BATCH_SIZE, _chunks
+from .storage_utils import json_default, text_key
+
+# Serial numbers looked up per query, under the SQLite variable limit
+_LOOKUP_SIZE = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accepted (
+    operation TEXT NOT NULL,
+    nif TEXT NOT NULL,
+    serial_number TEXT NOT NULL,
+    issue_date TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (operation, nif, serial_number, issue_date)
+);
+'''
+
+
+def payload_hash(record):
+    """Digest of a mapped record, independent of its dicts' order"""
+    return hashlib.sha256(json.dumps(
+        record, default=json_default, sort_keys=True,
+        separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ChangeIndex(object):
+    """
+    Hash of the last record AEAT accepted for each IDFactura, kept in the
+    SQLite database at `path`, to tell new and changed invoices from
+    those already up to date.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+
+    def _hashes(self, operation, keys):
+        """The stored hash of each of `keys` that has one"""
+        hashes = {}
+        for chunk in _chunks(sorted(set(k[1] for k in keys)), _LOOKUP_SIZE):
+            cursor = self._conn.execute(
+                'SELECT nif, serial_number, issue_date, hash FROM accepted '
+                'WHERE operation = ? AND serial_number IN (%s)'
+                % ', '.join('?' * len(chunk)), [operation] + chunk)
+            for row in cursor:
+                hashes[tuple(row[:3])] = row[3]
+        return hashes
+
+    def split(self, service, records, chunk_size=MAX_BATCH_SIZE):
+        """
+        Sort the submit records of `service`, read `chunk_size` at a
+        time, into new and changed ones. Yield, for each chunk, the
+        lists of new and changed records and the number of unchanged
+        records left out.
+        """
+        operation = service._submit_operation
+        for chunk in _chunks(records, chunk_size):
+            keys = [text_key(record_key(record)) for record in chunk]
+            hashes = self._hashes(operation, keys)
+            new, changed = [], []
+            for key, record in zip(keys, chunk):
+                stored = hashes.get(key)
+                if stored is None:
+                    new.append(record)
+                elif stored != payload_hash(record):
+                    changed.append(record)
+            yield new, changed, len(chunk) - len(new) - len(changed)
+
+    def update(self, service, records, response):
+        """
+        Store the hash of the `records` accepted in `response`, the
+        BatchResult they were sent with
+        """
+        lines = dict((text_key(line.key), line) for line in response)
+        now = time.time()
+        rows = []
+        for record in records:
+            key = text_key(record_key(record))
+            line = lines.get(key)
+            if line is not None and line.status in (
+                    CORRECT, ACCEPTED_WITH_ERRORS):
+                rows.append(
+                    (service._submit_operation,) + key
+                    + (payload_hash(record), now))
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO accepted (operation, nif, '
+                'serial_number, issue_date, hash, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,228 @@
+
+__all__ = [
+    'IssuedColumnarMapper',
+    'RecievedColumnarMapper',
+]
+
+from datetime import date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .compiled import _compile_issued, _compile_recieved, _strftime
+from .mapping import _format_period, _rate_to_percent
+
+_DATE_COLUMNS = frozenset({'issue_date', 'move_date', 'sent_date'})
+_PERIOD_COLUMNS = frozenset({'period'})
+_RATE_COLUMNS = frozenset({
+    'tax_rate',
+    'tax_equivalence_surcharge_rate',
+    'tax_reagyp_rate',
+})
+
+# Columns every record needs, AEAT rejects records without them
+_ID_COLUMNS = frozenset({
+    'year', 'period', 'nif', 'serial_number', 'issue_date'})
+_INVOICE_COLUMNS = _ID_COLUMNS | {
+    'invoice_kind', 'specialkey_or_trascendence', 'description'}
+
+# Characters of DD-MM-YYYY within the YYYY-MM-DD of NumPy
+_DMY = [8, 9, 7, 5, 6, 4, 0, 1, 2, 3]
+
+
+def _identity(value):
+    return value
+
+
+def _array(values):
+    """
+    `values` as a NumPy array, if they come as one or as an Arrow or
+    pandas column
+    """
+    if numpy is None:
+        return None
+    if isinstance(values, numpy.ndarray):
+        return values
+    if hasattr(values, 'to_numpy'):
+        try:
+            return values.to_numpy(zero_copy_only=False)
+        except TypeError:
+            return values.to_numpy()
+    return None
+
+
+def _to_list(values):
+    array = _array(values)
+    if array is None:
+        return values if isinstance(values, (list, tuple)) else list(values)
+    if array.dtype.kind == 'f':
+        missing = numpy.isnan(array)
+        if missing.any():
+            array = array.astype(object)
+            array[missing] = None
+    return array.tolist()
+
+
+def _factorized(values, function):
+    """
+    [function(value) for value in values], calling `function` once per
+    distinct value. NaN in NumPy arrays stands for None.
+    """
+    array = _array(values)
+    if array is not None:
+        try:
+            uniques, inverse = numpy.unique(array, return_inverse=True)
+        except TypeError:
+            # Values that can not be sorted, e.g. None among others
+            array = None
+        else:
+            mapped = numpy.empty(len(uniques), dtype=object)
+            mapped[:] = [
+                function(None if value != value else value)
+                for value in uniques.tolist()]
+            return mapped[inverse.ravel()].tolist()
+    values = _to_list(values if array is None else array)
+    try:
+        mapped = dict((value, function(value)) for value in set(values))
+    except TypeError:
+        return [function(value) for value in values]
+    return [mapped[value] for value in values]
+
+
+def _format_dates(values):
+    array = _array(values)
+    if array is None or array.dtype.kind != 'M':
+        return _factorized(values, _strftime)
+    days = array.astype('datetime64[D]')
+    if numpy.isnat(days).any():
+        raise ValueError('Dates are missing')
+    iso = numpy.datetime_as_string(days).astype('U10')
+    dmy = numpy.ascontiguousarray(iso.view('U1').reshape(-1, 10)[:, _DMY])
+    return dmy.view('U10').ravel().tolist()
+
+
+def _constant(value):
+    def accessor(row):
+        return value
+    return accessor
+
+
+class _Columns(object):
+    """
+    Accessors reading the formatted columns by row number, for the
+    compiled builders. Columns not given read as None, unless they are
+    `required`.
+    """
+
+    def __init__(self, columns, defaults, required):
+        self._length = None
+        for name, values in columns.items():
+            if name == 'tax_offsets':
+                self.taxes = self._taxes(_to_list(values))
+                continue
+            if name in _DATE_COLUMNS:
+                values = _format_dates(values)
+            elif name in _PERIOD_COLUMNS:
+                values = _factorized(values, _format_period)
+            elif name in _RATE_COLUMNS:
+                values = _factorized(values, _rate_to_percent)
+            else:
+                values = _to_list(values)
+            if not name.startswith('tax_'):
+                self._check_length(name, len(values))
+            setattr(self, name, values.__getitem__)
+        for name, value in defaults.items():
+            if name not in vars(self):
+                setattr(self, name, _constant(value))
+        missing = sorted(required.difference(vars(self)))
+        if missing and len(self):
+            raise ValueError('Columns missing: %s' % ', '.join(missing))
+
+    def _check_length(self, name, length):
+        if self._length is None:
+            self._length = length
+        elif length != self._length:
+            raise ValueError(
+                'Column %s holds %d values, not %d'
+                % (name, length, self._length))
+
+    def _taxes(self, offsets):
+        # The tax lines of invoice n are offsets[n] to offsets[n + 1]
+        self._check_length('tax_offsets', len(offsets) - 1)
+        return lambda row: range(offsets[row], offsets[row + 1])
+
+    def __len__(self):
+        return self._length or 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _constant(None)
+
+
+class _ColumnarMapper(object):
+    _compile = None
+    # Required columns of the submit and the delete requests
+    _required = (_INVOICE_COLUMNS, _ID_COLUMNS)
+
+    def _defaults(self):
+        """Values of the columns that are not given"""
+        return {'taxes': ()}
+
+    def _build(self, columns, index):
+        columns = _Columns(columns, self._defaults(), self._required[index])
+        build = self._compile(
+            columns, format_date=_identity, format_period=_identity,
+            rate_to_percent=_identity)[index]
+        return [build(row) for row in range(len(columns))]
+
+    def build_submit_requests(self, columns):
+        """The submit request of every invoice of `columns`"""
+        return self._build(columns, 0)
+
+    def build_delete_requests(self, columns):
+        """The delete request of every invoice of `columns`"""
+        return self._build(columns, 1)
+
+
+class IssuedColumnarMapper(_ColumnarMapper):
+    """
+    Map whole batches of issued invoices given as columns rather than
+    one object per invoice: `columns` maps the accessor names of
+    pyAEATsii.mapping.IssuedInvoiceMapper to sequences holding the
+    value of each invoice, e.g. lists, NumPy arrays or Arrow arrays.
+
+    Tax lines come as columns of their own, named after the tax
+    accessors (tax_rate, tax_base...), along with `tax_offsets`: the tax
+    lines of invoice n are rows tax_offsets[n] to tax_offsets[n + 1] of
+    them, as the offsets of an Arrow list array.
+
+    Dates, periods and tax rates are formatted column by column, once
+    per distinct value, with NumPy when it is installed and the columns
+    are arrays. NaN in float arrays stands for a missing value. Then the
+    records are built as by compile_mapper, so they are those the row
+    mappers would build. Columns not given read as None, but for those
+    every record needs (year, period, nif, serial_number, issue_date,
+    and invoice_kind, specialkey_or_trascendence and description to
+    submit), whose absence raises ValueError.
+
+    The records can be passed as invoices, without mapper, to the
+    services.
+    """
+    _compile = staticmethod(_compile_issued)
+
+
+class RecievedColumnarMapper(_ColumnarMapper):
+    """
+    IssuedColumnarMapper for recieved invoices, whose `sent_date`
+    defaults to today's
+    """
+    _compile = staticmethod(_compile_recieved)
+    _required = (_INVOICE_COLUMNS | {'counterpart_name'}, _ID_COLUMNS)
+
+    def _defaults(self):
+        defaults = super(RecievedColumnarMapper, self)._defaults()
+        defaults['sent_date'] = _strftime(date.today())
+        return defaults
@@ -0,0 +1,412 @@
+
+__all__ = [
+    'compile_mapper',
+]
+
+from operator import methodcaller
+
+from .mapping import _DATE_FMT
+from .mapping import _FIRST_SEMESTER_RECORD_DESCRIPTION
+from .mapping import OTHER_ID_TYPES
+from .mapping import RECTIFIED_KINDS
+from .mapping import SEMESTER1_ISSUED_SPECIALKEY
+from .mapping import SEMESTER1_RECIEVED_SPECIALKEY
+from .mapping import IssuedInvoiceMapper
+from .mapping import RecievedInvoiceMapper
+from .mapping import _format_period
+from .mapping import _rate_to_percent
+
+# Methods the compiled builders replace. A mapper overriding any of them
+# is not compiled, as the builders would silently skip the override.
+_ISSUED_BUILDERS = (
+    'build_delete_request',
+    'build_submit_request',
+    'build_issued_invoice',
+    'build_taxes',
+    '_build_period',
+    '_build_invoice_id',
+    '_build_issuer_id',
+    '_build_counterpart',
+    '_description',
+    '_is_first_semester',
+    '_update_counterpart',
+    '_update_total_amount',
+    '_update_rectified_invoice',
+)
+_RECIEVED_BUILDERS = (
+    'build_delete_request',
+    'build_submit_request',
+    'build_named_invoice_id',
+    'build_invoice',
+    'build_taxes',
+    '_build_period',
+    '_build_invoice_id',
+    '_build_issuer_id',
+    '_build_counterpart',
+    '_description',
+    '_is_first_semester',
+    '_deductible_amount',
+    '_move_date',
+    '_update_rectified_invoice',
+)
+
+_missing = object()
+
+_strftime = methodcaller('strftime', _DATE_FMT)
+
+
+def _class_attribute(cls, name):
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            return vars(klass)[name]
+
+
+def _overrides(cls, base, names):
+    return any(
+        _class_attribute(cls, name) is not _class_attribute(base, name)
+        for name in names
+    )
+
+
+def _missing_accessor(mapper, name):
+    def accessor(*args):
+        raise AttributeError(
+            "'%s' object has no attribute '%s'"
+            % (type(mapper).__name__, name))
+    return accessor
+
+
+class _Accessors(object):
+    """The mapper accessors, looked up once"""
+
+    def __init__(self, mapper):
+        self._mapper = mapper
+
+    def __getattr__(self, name):
+        accessor = getattr(self._mapper, name, _missing)
+        if accessor is _missing:
+            accessor = _missing_accessor(self._mapper, name)
+        setattr(self, name, accessor)
+        return accessor
+
+
+def _counterpart(get, invoice):
+    ret = {
+        'NombreRazon': get.counterpart_name(invoice),
+    }
+    id_type = get.counterpart_id_type(invoice)
+    if id_type and id_type in OTHER_ID_TYPES:
+        ret['IDOtro'] = {
+            'IDType': id_type,
+            'CodigoPais': get.counterpart_country(invoice),
+            'ID': get.counterpart_id(invoice),
+        }
+    else:
+        ret['NIF'] = get.counterpart_nif(invoice)
+    return ret
+
+
+def _copy_counterpart(counterpart):
+    ret = dict(counterpart)
+    if 'IDOtro' in ret:
+        ret['IDOtro'] = dict(ret['IDOtro'])
+    return ret
+
+
+def _compile_issued(
+        mapper, format_date=_strftime, format_period=_format_period,
+        rate_to_percent=_rate_to_percent):
+    """
+    The builders of an issued invoice `mapper`. The format functions
+    are applied to the dates, periods and tax rates it gives.
+    """
+    get = _Accessors(mapper)
+    year = get.year
+    period = get.period
+    nif = get.nif
+    serial_number = get.serial_number
+    issue_date = get.issue_date
+    invoice_kind = get.invoice_kind
+    specialkey_or_trascendence = get.specialkey_or_trascendence
+    total_amount = get.total_amount
+    description = get.description
+    issued_by_party = get.issued_by_party
+    not_exempt_kind = get.not_exempt_kind
+    exempt_kind = get.exempt_kind
+    untaxed_amount = get.untaxed_amount
+    taxes = get.taxes
+    tax_rate = get.tax_rate
+    tax_base = get.tax_base
+    tax_amount = get.tax_amount
+    tax_equivalence_surcharge_rate = get.tax_equivalence_surcharge_rate
+    tax_equivalence_surcharge_amount = get.tax_equivalence_surcharge_amount
+
+    def build_taxes(tax):
+        return {
+            'TipoImpositivo': rate_to_percent(tax_rate(tax)),
+            'BaseImponible': tax_base(tax),
+            'CuotaRepercutida': tax_amount(tax),
+            'TipoRecargoEquivalencia':
+                rate_to_percent(tax_equivalence_surcharge_rate(tax)),
+            'CuotaRecargoEquivalencia':
+                tax_equivalence_surcharge_amount(tax),
+        }
+
+    def build_delete_request(invoice, kind=_missing):
+        if kind is _missing:
+            kind = invoice_kind(invoice)
+        invoice_id = {
+            'IDEmisorFactura': {
+                'NIF': nif(invoice),
+            },
+            'NumSerieFacturaEmisor': serial_number(invoice),
+            'FechaExpedicionFacturaEmisor':
+                format_date(issue_date(invoice)),
+        }
+        if kind == 'F4':
+            invoice_id['NumSerieFacturaEmisorResumenFin'] = \
+                get.final_serial_number(invoice)
+        return {
+            'PeriodoLiquidacion': {
+                'Ejercicio': year(invoice),
+                'Periodo': format_period(period(invoice)),
+            },
+            'IDFactura': invoice_id,
+        }
+
+    def build_issued_invoice(invoice, kind):
+        specialkey = specialkey_or_trascendence(invoice)
+        total = total_amount(invoice)
+        ret = {
+            'TipoFactura': kind,
+            'ClaveRegimenEspecialOTrascendencia': specialkey,
+            'ImporteTotal': total,
+            'DescripcionOperacion': (
+                description(invoice)
+                if specialkey != SEMESTER1_ISSUED_SPECIALKEY
+                else _FIRST_SEMESTER_RECORD_DESCRIPTION
+            ),
+            'EmitidaPorTercerosODestinatario':
+                'S' if issued_by_party(invoice) else 'N',
+            'TipoDesglose': {},
+        }
+        must_detail_op = False
+        if kind not in {'F2', 'F4', 'R5'}:
+            counterpart = ret['Contraparte'] = _counterpart(get, invoice)
+            must_detail_op = (
+                'IDOtro' in counterpart
+                or counterpart['NIF'].startswith('N')
+            )
+        not_exempt = not_exempt_kind(invoice)
+        untaxed = _missing
+        detail = {}
+        if must_detail_op:
+            ret['TipoDesglose']['DesgloseTipoOperacion'] = {
+                'Entrega': detail,
+            }
+        else:
+            ret['TipoDesglose']['DesgloseFactura'] = detail
+
+        if not_exempt:
+            if not_exempt == 'S2':
+                untaxed = untaxed_amount(invoice)
+                tax_detail = [{
+                    'TipoImpositivo': 0,
+                    'BaseImponible': untaxed,
+                    'CuotaRepercutida': 0
+                }]
+            else:
+                tax_detail = [build_taxes(t) for t in taxes(invoice)]
+            if tax_detail:
+                detail['Sujeta'] = {
+                    'NoExenta': {
+                        'TipoNoExenta': not_exempt,
+                        'DesgloseIVA': {
+                            'DetalleIVA': tax_detail
+                        }
+                    }
+                }
+        else:
+            exempt = exempt_kind(invoice)
+            if exempt:
+                untaxed = untaxed_amount(invoice)
+                detail['Sujeta'] = {
+                    'Exenta': {
+                        'DetalleExenta': {
+                            'CausaExencion': exempt,
+                            'BaseImponible': untaxed,
+                        }
+                    }
+                }
+        if (
+                specialkey == '08'
+                or must_detail_op and not_exempt == 'S2'):
+            if untaxed is _missing:
+                untaxed = untaxed_amount(invoice)
+            detail['NoSujeta'] = {
+                'ImporteTAIReglasLocalizacion': untaxed
+            }
+
+        if kind == 'R5' and 'Sujeta' not in detail:
+            # _update_total_amount only sets ImporteTotal again, to the
+            # same value, but fails on R5 invoices without Sujeta detail
+            raise KeyError('Sujeta')
+        if kind in RECTIFIED_KINDS:
+            ret['TipoRectificativa'] = rectified_kind = \
+                get.rectified_invoice_kind(invoice)
+            if rectified_kind == 'S':
+                ret['ImporteRectificacion'] = {
+                    'BaseRectificada': get.rectified_base(invoice),
+                    'CuotaRectificada': get.rectified_amount(invoice),
+                }
+        return ret
+
+    def build_submit_request(invoice):
+        kind = invoice_kind(invoice)
+        request = build_delete_request(invoice, kind)
+        request['FacturaExpedida'] = build_issued_invoice(invoice, kind)
+        return request
+
+    return build_submit_request, build_delete_request
+
+
+def _compile_recieved(
+        mapper, format_date=_strftime, format_period=_format_period,
+        rate_to_percent=_rate_to_percent):
+    """Like _compile_issued, for a recieved invoice `mapper`"""
+    get = _Accessors(mapper)
+    year = get.year
+    period = get.period
+    serial_number = get.serial_number
+    issue_date = get.issue_date
+    invoice_kind = get.invoice_kind
+    specialkey_or_trascendence = get.specialkey_or_trascendence
+    total_amount = get.total_amount
+    description = get.description
+    counterpart_name = get.counterpart_name
+    counterpart_nif = get.counterpart_nif
+    untaxed_amount = get.untaxed_amount
+    taxes = get.taxes
+    tax_base = get.tax_base
+
+    def build_taxes(tax, specialkey):
+        ret = {
+            'BaseImponible': tax_base(tax),
+        }
+        if specialkey != '02':
+            ret['TipoImpositivo'] = rate_to_percent(get.tax_rate(tax))
+            ret['CuotaSoportada'] = get.tax_amount(tax)
+            ret['TipoRecargoEquivalencia'] = rate_to_percent(
+                get.tax_equivalence_surcharge_rate(tax))
+            ret['CuotaRecargoEquivalencia'] = \
+                get.tax_equivalence_surcharge_amount(tax)
+        else:
+            ret['PorcentCompensacionREAGYP'] = \
+                rate_to_percent(get.tax_reagyp_rate(tax))
+            ret['ImporteCompensacionREAGYP'] = get.tax_reagyp_amount(tax)
+        return ret
+
+    def build_period(invoice):
+        return {
+            'Ejercicio': year(invoice),
+            'Periodo': format_period(period(invoice)),
+        }
+
+    def build_delete_request(invoice):
+        return {
+            'PeriodoLiquidacion': build_period(invoice),
+            'IDFactura': {
+                'IDEmisorFactura': {
+                    'NombreRazon': counterpart_name(invoice),
+                    'NIF': counterpart_nif(invoice),
+                },
+                'NumSerieFacturaEmisor': serial_number(invoice),
+                'FechaExpedicionFacturaEmisor':
+                    format_date(issue_date(invoice)),
+            },
+        }
+
+    def build_submit_request(invoice):
+        kind = invoice_kind(invoice)
+        counterpart = _counterpart(get, invoice)
+        invoice_id = {
+            'IDEmisorFactura': counterpart,
+            'NumSerieFacturaEmisor': serial_number(invoice),
+            'FechaExpedicionFacturaEmisor':
+                format_date(issue_date(invoice)),
+        }
+        if kind == 'F4':
+            invoice_id['NumSerieFacturaEmisorResumenFin'] = \
+                get.final_serial_number(invoice)
+        specialkey = specialkey_or_trascendence(invoice)
+        first_semester = specialkey == SEMESTER1_RECIEVED_SPECIALKEY
+        tax_detail = []
+        ret = {
+            'TipoFactura': kind,
+            'ClaveRegimenEspecialOTrascendencia': specialkey,
+            'ImporteTotal': total_amount(invoice),
+            'DescripcionOperacion': (
+                description(invoice)
+                if not first_semester
+                else _FIRST_SEMESTER_RECORD_DESCRIPTION
+            ),
+            'DesgloseFactura': {
+                'DesgloseIVA': {
+                    'DetalleIVA': tax_detail
+                }
+            },
+            'Contraparte': _copy_counterpart(counterpart),
+            'FechaRegContable': format_date(
+                get.move_date(invoice)
+                if not first_semester
+                else get.sent_date(invoice)
+            ),
+            'CuotaDeducible': (
+                get.deductible_amount(invoice)
+                if not first_semester
+                else 0
+            ),
+        }
+        _taxes = taxes(invoice)
+        if _taxes:
+            tax_detail.extend(build_taxes(t, specialkey) for t in _taxes)
+        else:
+            tax_detail.append({'BaseImponible': untaxed_amount(invoice)})
+        if kind in RECTIFIED_KINDS:
+            ret['TipoRectificativa'] = get.rectified_invoice_kind(invoice)
+        return {
+            'PeriodoLiquidacion': build_period(invoice),
+            'IDFactura': invoice_id,
+            'FacturaRecibida': ret,
+        }
+
+    return build_submit_request, build_delete_request
+
+
+class _CompiledMapper(object):
+
+    def __init__(self, mapper, build_submit_request, build_delete_request):
+        self.mapper = mapper
+        self.build_submit_request = build_submit_request
+        self.build_delete_request = build_delete_request
+
+
+def compile_mapper(mapper):
+    """
+    Return an object with the build_submit_request and
+    build_delete_request methods of `mapper`, producing the same
+    requests with flat builders: accessors are looked up once, every
+    accessor is called at most once per invoice and there are no
+    intermediate method calls. The result can be passed as `mapper` to
+    the services.
+
+    Mappers overriding any of the build methods are returned as they are.
+    """
+    cls = type(mapper)
+    if isinstance(mapper, IssuedInvoiceMapper):
+        if not _overrides(cls, IssuedInvoiceMapper, _ISSUED_BUILDERS):
+            return _CompiledMapper(mapper, *_compile_issued(mapper))
+    elif isinstance(mapper, RecievedInvoiceMapper):
+        if not _overrides(cls, RecievedInvoiceMapper, _RECIEVED_BUILDERS):
+            return _CompiledMapper(mapper, *_compile_recieved(mapper))
+    return mapper
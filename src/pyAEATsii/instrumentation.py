@@ -0,0 +1,388 @@
+
+__all__ = [
+    'CallMetrics',
+    'MetricsCollector',
+    'PrometheusInstrument',
+    'OpenTelemetryInstrument',
+    'PHASES',
+]
+
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from logging import getLogger
+
+from .results import BatchResult, ResponseLines, _LINES, _get
+
+_logger = getLogger(__name__)
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Phases of a call, in the order they happen:
+# - mapping: building the records from the invoices
+# - serialization: writing the SOAP envelope
+# - transport: connecting, TLS handshake included, and sending the
+#   request, which requests does not tell apart
+# - server_wait: from the request fully sent to the response headers
+# - download: reading the response body
+# - parse: reading the response into zeep objects or a BatchResult
+PHASES = (
+    'mapping',
+    'serialization',
+    'transport',
+    'server_wait',
+    'download',
+    'parse',
+)
+
+
+class CallMetrics(object):
+    """
+    Measurements of one request to AEAT, handed to the service's
+    instruments once its response is read or it fails:
+
+    - `phases`: seconds spent in each of PHASES that the call went
+      through. Phases run inside others, like mapping while the envelope
+      is being streamed, only count towards the innermost one.
+    - `records`: number of records sent, None for queries
+    - `request_bytes` and `response_bytes`: body sizes, the latter None
+      when the body is left for the caller to read
+    - `http_status`, and `status`: EstadoEnvio or ResultadoConsulta
+    - `outcomes`: number of response lines per EstadoRegistro
+    - `error`: the exception the call failed with, if any
+
+    Responses returned as pyAEATsii.results.ResponseLines are parsed
+    while the caller iterates them, so neither their parsing nor their
+    outcomes are measured.
+    """
+    __slots__ = (
+        'operation',
+        'phases',
+        'records',
+        'request_bytes',
+        'response_bytes',
+        'http_status',
+        'status',
+        'outcomes',
+        'error',
+        '_stack',
+        '_mark',
+    )
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.phases = {}
+        self.records = None
+        self.request_bytes = 0
+        self.response_bytes = None
+        self.http_status = None
+        self.status = None
+        self.outcomes = {}
+        self.error = None
+        self._stack = []
+        self._mark = None
+
+    def __repr__(self):
+        return '<CallMetrics %s: %s>' % (self.operation, ', '.join(
+            '%s %.3fs' % (phase, self.phases[phase])
+            for phase in PHASES if phase in self.phases))
+
+    @property
+    def duration(self):
+        """Seconds measured in all"""
+        return sum(self.phases.values())
+
+    def _stop(self, now):
+        phase = self._stack[-1]
+        self.phases[phase] = self.phases.get(phase, 0) + now - self._mark
+
+    def enter(self, phase):
+        """Start `phase`, pausing the current one"""
+        now = _clock()
+        if self._stack:
+            self._stop(now)
+        self._stack.append(phase)
+        self._mark = now
+
+    def exit(self):
+        """End the current phase, resuming the one it paused"""
+        now = _clock()
+        self._stop(now)
+        self._stack.pop()
+        self._mark = now
+
+    def switch(self, phase):
+        """End the current phase and start `phase` in its place"""
+        if self._stack:
+            now = _clock()
+            self._stop(now)
+            self._stack[-1] = phase
+            self._mark = now
+
+    @contextmanager
+    def phase(self, phase):
+        self.enter(phase)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def timed(self, iterable, phase, count=False):
+        """
+        Yield the items of `iterable`, counting the time taken to produce
+        them as `phase`, and their number as `records` with `count`
+        """
+        iterator = iter(iterable)
+        while True:
+            self.enter(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.exit()
+            if count:
+                self.records = (self.records or 0) + 1
+            yield item
+
+    def finish(self):
+        """End any phase left open by a failure"""
+        while self._stack:
+            self.exit()
+
+    def count(self, response):
+        """Read the status and line outcomes of a call's response"""
+        if isinstance(response, ResponseLines):
+            return
+        if isinstance(response, BatchResult):
+            self.status = response.status
+            lines = [line.status for line in response]
+        else:
+            try:
+                self.status = (
+                    _get(response, 'EstadoEnvio')
+                    or _get(response, 'ResultadoConsulta'))
+            except TypeError:
+                # Not a SuministroLR, AnulacionLR or ConsultaLR response
+                return
+            lines = []
+            for name in _LINES:
+                for line in _get(response, name) or []:
+                    state = _get(line, 'EstadoFactura')
+                    lines.append(_get(
+                        line if state is None else state, 'EstadoRegistro'))
+        for status in lines:
+            self.outcomes[status] = self.outcomes.get(status, 0) + 1
+
+
+class _TimedFile(object):
+    """
+    Request body read from a file, switching the call to server_wait
+    once it has all been read
+    """
+
+    def __init__(self, fileobj, metrics):
+        self._file = fileobj
+        self._metrics = metrics
+        position = fileobj.tell()
+        fileobj.seek(0, 2)
+        self._length = fileobj.tell() - position
+        fileobj.seek(position)
+        self._sent = False
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(lambda: self.read(8192), b'')
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        if data:
+            self._metrics.request_bytes += len(data)
+        elif not self._sent:
+            self._sent = True
+            self._metrics.switch('server_wait')
+        return data
+
+
+def _timed_chunks(chunks, metrics):
+    for chunk in chunks:
+        metrics.request_bytes += len(chunk)
+        yield chunk
+    metrics.switch('server_wait')
+
+
+def _post(client, address, body, http_headers, metrics, stream=False):
+    """
+    Post `body` (bytes, a file or an iterator of chunks, which is sent
+    with chunked transfer encoding) through the session of a zeep
+    client, timing its transport, server_wait and download on `metrics`.
+    With `stream` the response body is left to be read.
+    """
+    if isinstance(body, bytes):
+        body = BytesIO(body)
+    body = (
+        _TimedFile(body, metrics) if hasattr(body, 'read')
+        else _timed_chunks(body, metrics))
+    metrics.enter('transport')
+    try:
+        response = client.transport.session.post(
+            address, data=body, headers=http_headers,
+            timeout=client.transport.operation_timeout, stream=True)
+        metrics.http_status = response.status_code
+        if not stream:
+            metrics.switch('download')
+            metrics.response_bytes = len(response.content)
+    finally:
+        metrics.exit()
+    return response
+
+
+class MetricsCollector(object):
+    """
+    Instrument adding up the metrics of every call per operation, e.g.
+    to log where a long run spent its time. It may be shared by several
+    services and threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def __call__(self, metrics):
+        with self._lock:
+            totals = self._totals.get(metrics.operation)
+            if totals is None:
+                totals = self._totals[metrics.operation] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'records': 0,
+                    'request_bytes': 0,
+                    'response_bytes': 0,
+                    'phases': {},
+                    'outcomes': {},
+                }
+            totals['calls'] += 1
+            totals['errors'] += metrics.error is not None
+            totals['records'] += metrics.records or 0
+            totals['request_bytes'] += metrics.request_bytes
+            totals['response_bytes'] += metrics.response_bytes or 0
+            for name in ('phases', 'outcomes'):
+                for key, value in getattr(metrics, name).items():
+                    totals[name][key] = totals[name].get(key, 0) + value
+
+    def summary(self):
+        """Totals per operation, as a dict"""
+        with self._lock:
+            return dict(
+                (operation, dict(
+                    totals,
+                    phases=dict(totals['phases']),
+                    outcomes=dict(totals['outcomes'])))
+                for operation, totals in self._totals.items())
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+
+
+class PrometheusInstrument(object):
+    """
+    Instrument exporting the call metrics through the optional
+    prometheus_client package, to `registry` (its default one unless
+    given):
+
+    - <namespace>_phase_seconds: histogram by operation and phase
+    - <namespace>_request_bytes and <namespace>_response_bytes:
+      histograms by operation
+    - <namespace>_batch_records: histogram by operation
+    - <namespace>_lines_total: counter by operation and line status
+    - <namespace>_calls_total: counter by operation and outcome (ok or
+      error)
+    """
+
+    def __init__(self, namespace='pyaeatsii', registry=None):
+        from prometheus_client import REGISTRY, Counter, Histogram
+        registry = REGISTRY if registry is None else registry
+        size_buckets = tuple(4 ** n * 1024 for n in range(1, 10))
+        self._phases = Histogram(
+            'phase_seconds', 'Seconds spent per phase of the AEAT calls',
+            ['operation', 'phase'], namespace=namespace, registry=registry)
+        self._request_bytes = Histogram(
+            'request_bytes', 'Size of the AEAT requests', ['operation'],
+            namespace=namespace, registry=registry, buckets=size_buckets)
+        self._response_bytes = Histogram(
+            'response_bytes', 'Size of the AEAT responses', ['operation'],
+            namespace=namespace, registry=registry, buckets=size_buckets)
+        self._records = Histogram(
+            'batch_records', 'Records sent per AEAT request', ['operation'],
+            namespace=namespace, registry=registry,
+            buckets=(1, 10, 100, 500, 1000, 2500, 5000, 10000))
+        self._lines = Counter(
+            'lines', 'Response lines per status', ['operation', 'status'],
+            namespace=namespace, registry=registry)
+        self._calls = Counter(
+            'calls', 'AEAT calls per outcome', ['operation', 'outcome'],
+            namespace=namespace, registry=registry)
+
+    def __call__(self, metrics):
+        operation = metrics.operation
+        for phase, seconds in metrics.phases.items():
+            self._phases.labels(operation, phase).observe(seconds)
+        self._request_bytes.labels(operation).observe(metrics.request_bytes)
+        if metrics.response_bytes is not None:
+            self._response_bytes.labels(operation).observe(
+                metrics.response_bytes)
+        if metrics.records is not None:
+            self._records.labels(operation).observe(metrics.records)
+        for status, count in metrics.outcomes.items():
+            self._lines.labels(operation, status).inc(count)
+        self._calls.labels(
+            operation, 'ok' if metrics.error is None else 'error').inc()
+
+
+class OpenTelemetryInstrument(object):
+    """
+    Instrument recording the call metrics with an OpenTelemetry `meter`,
+    as the histograms <prefix>.phase.duration (by operation and phase),
+    <prefix>.request.size, <prefix>.response.size and
+    <prefix>.batch.records, and the counters <prefix>.lines (by status)
+    and <prefix>.calls (by outcome)
+    """
+
+    def __init__(self, meter, prefix='pyaeatsii'):
+        self._phases = meter.create_histogram(
+            prefix + '.phase.duration', unit='s',
+            description='Seconds spent per phase of the AEAT calls')
+        self._request_bytes = meter.create_histogram(
+            prefix + '.request.size', unit='By',
+            description='Size of the AEAT requests')
+        self._response_bytes = meter.create_histogram(
+            prefix + '.response.size', unit='By',
+            description='Size of the AEAT responses')
+        self._records = meter.create_histogram(
+            prefix + '.batch.records', unit='{record}',
+            description='Records sent per AEAT request')
+        self._lines = meter.create_counter(
+            prefix + '.lines', unit='{line}',
+            description='Response lines per status')
+        self._calls = meter.create_counter(
+            prefix + '.calls', unit='{call}',
+            description='AEAT calls per outcome')
+
+    def __call__(self, metrics):
+        attributes = {'operation': metrics.operation}
+        for phase, seconds in metrics.phases.items():
+            self._phases.record(seconds, dict(attributes, phase=phase))
+        self._request_bytes.record(metrics.request_bytes, attributes)
+        if metrics.response_bytes is not None:
+            self._response_bytes.record(metrics.response_bytes, attributes)
+        if metrics.records is not None:
+            self._records.record(metrics.records, attributes)
+        for status, count in metrics.outcomes.items():
+            self._lines.add(count, dict(attributes, status=status))
+        self._calls.add(1, dict(
+            attributes,
+            outcome='ok' if metrics.error is None else 'error'))
@@ -0,0 +1,264 @@
+
+__all__ = [
+    'SubmissionJournal',
+    'PENDING',
+    'IN_FLIGHT',
+    'ACCEPTED',
+    'REJECTED',
+]
+
+import json
+import sqlite3
+import time
+from logging import getLogger
+
+from zeep.exceptions import Fault
+
+from .results import (
+    ACCEPTED_WITH_ERRORS, CORRECT, DUPLICATED, NOT_FOUND, record_key)
+from .retry import fault_code
+from .service import MAX_BATCH_SIZE
+from .storage_utils import json_default, text_key
+
+_logger = getLogger(__name__)
+
+# Record states
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY,
+    operation TEXT NOT NULL,
+    sent REAL NOT NULL,
+    received REAL,
+    status TEXT,
+    csv TEXT
+);
+CREATE TABLE IF NOT EXISTS records (
+    operation TEXT NOT NULL,
+    nif TEXT NOT NULL,
+    serial_number TEXT NOT NULL,
+    issue_date TEXT NOT NULL,
+    state TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    batch INTEGER REFERENCES batches (id),
+    error_code INTEGER,
+    error_description TEXT,
+    csv TEXT,
+    PRIMARY KEY (operation, nif, serial_number, issue_date)
+);
+CREATE INDEX IF NOT EXISTS records_state ON records (operation, state);
+'''
+
+
+class SubmissionJournal(object):
+    """
+    Durable record, in the SQLite database at `path`, of the invoices
+    submitted or cancelled through a service, so an interrupted run can
+    be resumed without sending any invoice twice.
+
+    Mapped records are added as pending and sent in batches by run().
+    Each batch is committed as in flight before it is sent, and its
+    outcome (accepted or rejected) once the response is read. Records
+    still in flight when a run resumes, whose response was lost, are
+    sent first and on their own. An A0 line that AEAT then rejects as
+    duplicated was recorded by the lost attempt and is taken as
+    accepted.
+
+    Records are keyed by operation and invoice id. Adding a record again
+    replaces it only while it is pending or rejected: accepted records
+    are not sent again, nor are in flight ones until resolved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def _operation(service, kind):
+        if kind == 'submit':
+            return service._submit_operation
+        if kind == 'cancel':
+            return service._cancel_operation
+        raise ValueError('Unknown kind: %r' % (kind,))
+
+    def add(self, service, records, kind='submit', chunk_size=1000):
+        """
+        Store mapped `records` (any iterable) as pending for the `kind`
+        (submit or cancel) operation of `service`, in bulk inserts of
+        `chunk_size`. Return the number of records read.
+        """
+        operation = self._operation(service, kind)
+        count = 0
+        rows = []
+        for record in records:
+            rows.append((
+                json.dumps(record, default=json_default, sort_keys=True),
+                operation) + text_key(record_key(record)))
+            if len(rows) >= chunk_size:
+                count += self._insert(rows)
+                rows = []
+        return count + self._insert(rows)
+
+    def _insert(self, rows):
+        with self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO records (payload, operation, nif, '
+                'serial_number, issue_date, state) '
+                "VALUES (?, ?, ?, ?, ?, 'pending')", rows)
+            self._conn.executemany(
+                "UPDATE records SET payload = ?, state = 'pending', "
+                'batch = NULL, error_code = NULL, error_description = NULL '
+                'WHERE operation = ? AND nif = ? AND serial_number = ? '
+                "AND issue_date = ? AND state IN ('pending', 'rejected')",
+                rows)
+        return len(rows)
+
+    def _next_batch(self, operation, state, batch_size):
+        return self._conn.execute(
+            'SELECT nif, serial_number, issue_date, payload FROM records '
+            'WHERE operation = ? AND state = ? LIMIT ?',
+            (operation, state, batch_size)).fetchall()
+
+    def _mark_sent(self, operation, rows):
+        with self._conn:
+            batch = self._conn.execute(
+                'INSERT INTO batches (operation, sent) VALUES (?, ?)',
+                (operation, time.time())).lastrowid
+            self._conn.executemany(
+                "UPDATE records SET state = 'in_flight', batch = ? "
+                'WHERE operation = ? AND nif = ? AND serial_number = ? '
+                'AND issue_date = ?',
+                [(batch, operation) + tuple(row[:3]) for row in rows])
+        return batch
+
+    def _mark_received(self, operation, batch, rows, response, done):
+        """`done` holds the error codes of records already sent"""
+        updates = []
+        for row in rows:
+            line = response.get(tuple(row[:3]))
+            if line is None:
+                updates.append((
+                    REJECTED, None, 'Missing from the response', None,
+                    operation) + tuple(row[:3]))
+                continue
+            accepted = (
+                line.status in (CORRECT, ACCEPTED_WITH_ERRORS)
+                or line.error_code in done)
+            updates.append((
+                ACCEPTED if accepted else REJECTED, line.error_code,
+                line.error_description, line.csv, operation) + tuple(row[:3]))
+        with self._conn:
+            self._conn.execute(
+                'UPDATE batches SET received = ?, status = ?, csv = ? '
+                'WHERE id = ?',
+                (time.time(), response.status, response.csv, batch))
+            self._conn.executemany(
+                'UPDATE records SET state = ?, error_code = ?, '
+                'error_description = ?, csv = ? '
+                'WHERE operation = ? AND nif = ? AND serial_number = ? '
+                'AND issue_date = ?', updates)
+
+    def _mark_faulted(self, operation, batch, rows, fault):
+        with self._conn:
+            self._conn.execute(
+                'UPDATE batches SET received = ? WHERE id = ?',
+                (time.time(), batch))
+            self._conn.executemany(
+                "UPDATE records SET state = 'rejected', error_code = ?, "
+                'error_description = ?, csv = NULL '
+                'WHERE operation = ? AND nif = ? AND serial_number = ? '
+                'AND issue_date = ?',
+                [(fault_code(fault), fault.message, operation)
+                 + tuple(row[:3]) for row in rows])
+
+    def run(
+            self, service, headers, kind='submit',
+            batch_size=MAX_BATCH_SIZE, stream=False):
+        """
+        Send every record in flight or pending for the `kind` operation
+        of `service`, in batches of at most `batch_size`, and return the
+        number of records per state.
+
+        A call without response leaves its batch in flight and is
+        raised: running again resends it, and its records that AEAT
+        reports as duplicated, or as not found when cancelling, are
+        accepted. The records of a batch answered with a SOAP fault are
+        rejected with its code, and the next batches are sent.
+        """
+        operation = self._operation(service, kind)
+        send = getattr(service, kind)
+        # Error codes of the records of a resent batch that AEAT got:
+        # submitted invoices are duplicated, cancelled ones are gone
+        already_done = {NOT_FOUND if kind == 'cancel' else DUPLICATED}
+        for state in (IN_FLIGHT, PENDING):
+            resumed = state == IN_FLIGHT
+            while True:
+                rows = self._next_batch(operation, state, batch_size)
+                if not rows:
+                    break
+                if resumed:
+                    _logger.info(
+                        'Resending %d records left in flight', len(rows))
+                batch = self._mark_sent(operation, rows)
+                try:
+                    response = send(
+                        headers, [json.loads(row[3]) for row in rows],
+                        stream=stream, result='batch')
+                except Fault as fault:
+                    # AEAT answered, sending the batch again would fail
+                    # the same way
+                    _logger.warning(
+                        'Batch of %d records rejected: %s', len(rows),
+                        fault.message)
+                    self._mark_faulted(operation, batch, rows, fault)
+                    continue
+                self._mark_received(
+                    operation, batch, rows, _Lines(response),
+                    already_done if resumed else ())
+        return self.counts(service, kind)
+
+    def counts(self, service, kind='submit'):
+        """Number of records per state"""
+        return dict(self._conn.execute(
+            'SELECT state, COUNT(*) FROM records WHERE operation = ? '
+            'GROUP BY state', (self._operation(service, kind),)))
+
+    def records(self, service, state, kind='submit'):
+        """
+        Yield (key, error code, error description, CSV) of the records
+        in `state`
+        """
+        cursor = self._conn.execute(
+            'SELECT nif, serial_number, issue_date, error_code, '
+            'error_description, csv FROM records '
+            'WHERE operation = ? AND state = ?',
+            (self._operation(service, kind), state))
+        for row in cursor:
+            yield tuple(row[:3]), row[3], row[4], row[5]
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Lines(object):
+    """BatchResult lookup by journal keys, which are all text"""
+
+    def __init__(self, batch):
+        self.status = batch.status
+        self.csv = batch.csv
+        self._lines = dict((text_key(line.key), line) for line in batch)
+
+    def get(self, key):
+        return self._lines.get(key)
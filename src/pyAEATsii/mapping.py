@@ -6,7 +6,9 @@ __all__ = [
     'RecievedInvoiceMapper',
 ]
 
+import copy
 from datetime import date
+from functools import partial, wraps
 
 _DATE_FMT = '%d-%m-%Y'
 _FIRST_SEMESTER_RECORD_DESCRIPTION = "Registro del Primer semestre"
@@ -26,16 +28,50 @@ def _rate_to_percent(rate):
     return None if rate is None else abs(round(100 * rate, 2))
 
 
-def build_query_filter(year=None, period=None):
+def _format_date(value):
+    return value.strftime(_DATE_FMT) if isinstance(value, date) else value
+
+
+def _format_date_range(value):
+    start, end = value
+    # AEAT requires both bounds, an open range ends today
     return {
+        'Desde': _format_date(start),
+        'Hasta': _format_date(date.today() if end is None else end),
+    }
+
+
+def build_query_filter(
+        year=None, period=None, invoice_id=None, counterpart=None,
+        presentation_date=None, balance_date=None, modified_invoice=None,
+        balance_state=None, pagination_key=None):
+    """
+    Dates may be given as date objects. presentation_date and
+    balance_date are (from, to) tuples, `to` defaulting to today.
+    """
+    ret = {
         'PeriodoLiquidacion': {
             'Ejercicio': year,
             'Periodo': _format_period(period),
         }
-        # TODO: IDFactura, Contraparte,
-        # FechaPresentacion, FechaCuadre, FacturaModificada,
-        # EstadoCuadre, ClavePaginacion
     }
+    if invoice_id:
+        ret['IDFactura'] = {
+            k: _format_date(v) for k, v in invoice_id.items()
+        }
+    if counterpart:
+        ret['Contraparte'] = counterpart
+    if presentation_date:
+        ret['FechaPresentacion'] = _format_date_range(presentation_date)
+    if balance_date:
+        ret['FechaCuadre'] = _format_date_range(balance_date)
+    if modified_invoice is not None:
+        ret['FacturaModificada'] = 'S' if modified_invoice else 'N'
+    if balance_state:
+        ret['EstadoCuadre'] = balance_state
+    if pagination_key:
+        ret['ClavePaginacion'] = pagination_key
+    return ret
 
 
 def get_headers(name=None, vat=None, comm_kind=None, version='1.1'):
@@ -50,7 +86,79 @@ def get_headers(name=None, vat=None, comm_kind=None, version='1.1'):
     }
 
 
+def _call_memoized(accessor, name, invoice, results, *args):
+    if len(args) != 1 or args[0] is not invoice:
+        return accessor(*args)
+    if name not in results:
+        results[name] = accessor(invoice)
+    return results[name]
+
+
+def _invoice_scope(method):
+    """
+    Run a build method, on mappers that memoize accessors, on a copy of
+    the mapper whose memoized accessors are called at most once per
+    invoice.
+    """
+    @wraps(method)
+    def wrapper(self, invoice):
+        return method(self._scoped(invoice), invoice)
+    return wrapper
+
+
 class BaseInvoiceMapper(object):
+    """
+    Accessors listed in `_memoized_accessors`, none by default, are
+    called at most once per mapped invoice. Each build call then runs on
+    a copy of the mapper made with copy.copy, so attributes set on the
+    mapper during a build are set on the copy.
+    """
+    # Accessors that only depend on the invoice. Subclasses may extend
+    # the list.
+    _invoice_accessors = (
+        'year',
+        'period',
+        'nif',
+        'serial_number',
+        'final_serial_number',
+        'issue_date',
+        'invoice_kind',
+        'rectified_invoice_kind',
+        'rectified_base',
+        'rectified_amount',
+        'total_amount',
+        'untaxed_amount',
+        'specialkey_or_trascendence',
+        'description',
+        'not_exempt_kind',
+        'exempt_kind',
+        'counterpart_name',
+        'counterpart_nif',
+        'counterpart_id_type',
+        'counterpart_country',
+        'counterpart_id',
+        'taxes',
+    )
+    # Worth it for accessors that cost more than the copy, e.g. database
+    # lookups: set to _invoice_accessors, or part of it
+    _memoized_accessors = ()
+
+    _scope_invoice = None
+
+    def _scoped(self, invoice):
+        if not self._memoized_accessors or self._scope_invoice is invoice:
+            return self
+        # A shallow copy keeps the results away from other threads
+        # sharing the mapper and drops them once the invoice is mapped
+        scoped = copy.copy(self)
+        scoped._scope_invoice = invoice
+        results = {}
+        for name in self._memoized_accessors:
+            accessor = getattr(scoped, name, None)
+            if accessor is not None:
+                setattr(scoped, name, partial(
+                    _call_memoized, accessor, name, invoice, results))
+        return scoped
 
     def _build_period(self, invoice):
         return {
@@ -94,17 +202,22 @@ class BaseInvoiceMapper(object):
 
 
 class IssuedInvoiceMapper(BaseInvoiceMapper):
+    _invoice_accessors = BaseInvoiceMapper._invoice_accessors + (
+        'issued_by_party',
+    )
 
     def _is_first_semester(self, invoice):
         return self.specialkey_or_trascendence(invoice) == \
             SEMESTER1_ISSUED_SPECIALKEY
 
+    @_invoice_scope
     def build_delete_request(self, invoice):
         return {
             'PeriodoLiquidacion': self._build_period(invoice),
             'IDFactura': self._build_invoice_id(invoice),
         }
 
+    @_invoice_scope
     def build_submit_request(self, invoice):
         request = self.build_delete_request(invoice)
         request['FacturaExpedida'] = self.build_issued_invoice(invoice)
@@ -115,6 +228,7 @@ class IssuedInvoiceMapper(BaseInvoiceMapper):
             'NIF': self.nif(invoice),
         }
 
+    @_invoice_scope
     def build_issued_invoice(self, invoice):
         ret = {
             'TipoFactura': self.invoice_kind(invoice),
@@ -270,6 +384,11 @@ class IssuedInvoiceMapper(BaseInvoiceMapper):
 
 
 class RecievedInvoiceMapper(BaseInvoiceMapper):
+    _invoice_accessors = BaseInvoiceMapper._invoice_accessors + (
+        'move_date',
+        'sent_date',
+        'deductible_amount',
+    )
 
     def _is_first_semester(self, invoice):
         return self.specialkey_or_trascendence(invoice) == \
@@ -294,12 +413,14 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
         # is assumed to be the date it is being mapped
         return date.today()
 
+    @_invoice_scope
     def build_delete_request(self, invoice):
         return {
             'PeriodoLiquidacion': self._build_period(invoice),
             'IDFactura': self.build_named_invoice_id(invoice),
         }
 
+    @_invoice_scope
     def build_submit_request(self, invoice):
         return {
             'PeriodoLiquidacion': self._build_period(invoice),
@@ -309,6 +430,7 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
 
     _build_issuer_id = BaseInvoiceMapper._build_counterpart
 
+    @_invoice_scope
     def build_named_invoice_id(self, invoice):
         return {
             'IDEmisorFactura': {
@@ -320,6 +442,7 @@ class RecievedInvoiceMapper(BaseInvoiceMapper):
                 self.issue_date(invoice).strftime(_DATE_FMT),
         }
 
+    @_invoice_scope
     def build_invoice(self, invoice):
         ret = {
             'TipoFactura': self.invoice_kind(invoice),
@@ -0,0 +1,422 @@
+
+__all__ = [
+    'MockSIIServer',
+    'NOT_FOUND',
+    'SCHEMA_ERROR',
+]
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from datetime import datetime
+from logging import getLogger
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+from .results import (
+    CORRECT, INCORRECT, DUPLICATED, NOT_FOUND, batch_status)
+from .results import _children, _localname, _text
+from .serializer import SOAP_ENV_NS, SII_NS, _NS_BASE
+from .service import MAX_BATCH_SIZE
+
+_logger = getLogger(__name__)
+
+SII_R_NS = _NS_BASE + 'RespuestaSuministro.xsd'
+SII_LRRC_NS = _NS_BASE + 'RespuestaConsultaLR.xsd'
+
+# Fault code of a request that does not conform to the XSD, e.g. with
+# more than MAX_BATCH_SIZE records
+SCHEMA_ERROR = 4102
+
+# EstadoRegistro of a recorded invoice in query responses
+_RECORDED = 'Correcta'
+
+# Invoice book: (record element of submissions, element of its data in
+# query records)
+_BOOKS = {
+    'Emitidas': ('FacturaExpedida', 'DatosFacturaEmitida'),
+    'Recibidas': ('FacturaRecibida', 'DatosFacturaRecibida'),
+}
+
+# Request element prefix: kind of call
+_KINDS = (
+    ('SuministroLRFacturas', 'submit'),
+    ('BajaLRFacturas', 'cancel'),
+    ('ConsultaLRFacturas', 'query'),
+)
+
+
+class _Fault(Exception):
+
+    def __init__(self, code, message):
+        super(_Fault, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _request_kind(name):
+    for prefix, kind in _KINDS:
+        book = name[len(prefix):]
+        if name.startswith(prefix) and book in _BOOKS:
+            return kind, book
+    raise _Fault('Client', 'Unknown request: %s' % name)
+
+
+def _invoice_key(invoice_id):
+    """(issuer NIF or foreign ID, serial number, issue date) of an id"""
+    children = _children(invoice_id)
+    issuer = _children(children['IDEmisorFactura'])
+    nif = _text(issuer, 'NIF')
+    if nif is None and 'IDOtro' in issuer:
+        nif = _text(_children(issuer['IDOtro']), 'ID')
+    return (
+        nif,
+        _text(children, 'NumSerieFacturaEmisor'),
+        _text(children, 'FechaExpedicionFacturaEmisor'),
+    )
+
+
+def _period(element):
+    children = _children(element)
+    return _text(children, 'Ejercicio'), _text(children, 'Periodo')
+
+
+def _copy_into(parent, ns, name, source):
+    """Append `name` to `parent`, with copies of the children of `source`"""
+    element = etree.SubElement(parent, '{%s}%s' % (ns, name))
+    for child in source:
+        element.append(deepcopy(child))
+    return element
+
+
+def _sub(parent, ns, name, text=None):
+    element = etree.SubElement(parent, '{%s}%s' % (ns, name))
+    if text is not None:
+        element.text = u'%s' % text
+    return element
+
+
+def _envelope():
+    envelope = etree.Element(
+        '{%s}Envelope' % SOAP_ENV_NS,
+        nsmap={'env': SOAP_ENV_NS, 'sii': SII_NS})
+    return envelope, _sub(envelope, SOAP_ENV_NS, 'Body')
+
+
+def _fault(code, message):
+    envelope, body = _envelope()
+    fault = _sub(body, SOAP_ENV_NS, 'Fault')
+    etree.SubElement(fault, 'faultcode').text = 'env:' + code
+    etree.SubElement(fault, 'faultstring').text = message
+    return etree.tostring(envelope, xml_declaration=True, encoding='UTF-8')
+
+
+def _timestamp():
+    return datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _read_body(self):
+        encoding = self.headers.get('Transfer-Encoding') or ''
+        if 'chunked' not in encoding.lower():
+            return self.rfile.read(
+                int(self.headers.get('Content-Length') or 0))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if not size:
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        # Skip the trailers, up to the blank line
+        while self.rfile.readline().strip():
+            pass
+        return b''.join(chunks)
+
+    def do_POST(self):
+        status, content = self.server.mock.respond(self._read_body())
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class MockSIIServer(object):
+    """
+    Local stand-in for the SII endpoints, to test the services end to end
+    and load-test them without certificates or network. Bind a service to
+    it with the `address` client option, e.g.
+    bind_issued_invoices_service(None, None, cache=cache, offline=True,
+    address=server.url): the client still loads the AEAT WSDLs from its
+    cache and only its requests are sent here.
+
+    Suministro, Anulacion and Consulta requests of both books are
+    answered as AEAT does, from an in-memory record of the invoices:
+
+    - a request with more than `max_batch_size` records, or not valid
+      against `schema` (e.g. pyAEATsii.validation.load_schema(cache))
+      when given, is a Client fault with code SCHEMA_ERROR
+    - an A0 line of an invoice already recorded is rejected as
+      duplicated (DUPLICATED), and a modification or cancellation of one
+      that is not as NOT_FOUND
+    - queries return the invoices of the requested period in pages of
+      `page_size`, following ClavePaginacion
+
+    Failures are injected at random, from `seed` when given: every call
+    waits `latency` seconds (or a uniform amount between a (min, max)
+    pair), and is answered with HTTP 503 with probability
+    `unavailable_rate`, or with a Server fault with `fault_rate`. Each
+    line is rejected with `reject_code`, a transient error by default,
+    with probability `reject_rate`.
+
+    `calls` counts the requests answered per kind (submit, cancel, query
+    and fault) and `peak_concurrency` the most handled at once.
+    """
+
+    def __init__(
+            self, host='127.0.0.1', port=0, max_batch_size=MAX_BATCH_SIZE,
+            page_size=10000, schema=None, latency=0, unavailable_rate=0,
+            fault_rate=0, reject_rate=0, reject_code=3500, seed=None):
+        self.max_batch_size = max_batch_size
+        self.page_size = page_size
+        self.schema = schema
+        self.latency = latency
+        self.unavailable_rate = unavailable_rate
+        self.fault_rate = fault_rate
+        self.reject_rate = reject_rate
+        self.reject_code = reject_code
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._books = dict((book, OrderedDict()) for book in _BOOKS)
+        self._active = 0
+        self.calls = {}
+        self.peak_concurrency = 0
+        self._server = _HTTPServer((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+        self.url = 'http://%s:%d/' % self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def invoices(self, book='Emitidas'):
+        """Keys of the invoices recorded in `book`, in submission order"""
+        with self._lock:
+            return list(self._books[book])
+
+    def reset(self):
+        """Forget every recorded invoice and call"""
+        with self._lock:
+            for invoices in self._books.values():
+                invoices.clear()
+            self.calls = {}
+            self.peak_concurrency = 0
+
+    def _count(self, kind):
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+
+    def _chance(self, rate):
+        return rate > 0 and self._random.random() < rate
+
+    def _wait(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self._random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def respond(self, body):
+        """(HTTP status, content) of the answer to a request `body`"""
+        with self._lock:
+            self._active += 1
+            self.peak_concurrency = max(self.peak_concurrency, self._active)
+        try:
+            self._wait()
+            if self._chance(self.unavailable_rate):
+                self._count('unavailable')
+                return 503, b'Service Unavailable'
+            if self._chance(self.fault_rate):
+                raise _Fault('Server', 'Error interno simulado')
+            try:
+                envelope = etree.fromstring(body)
+                request = next(iter(
+                    envelope.find('{%s}Body' % SOAP_ENV_NS)))
+                kind, book = _request_kind(_localname(request))
+                content = getattr(self, '_' + kind)(request, book)
+            except (etree.XMLSyntaxError, TypeError, StopIteration) as e:
+                raise _Fault('Client', 'Malformed request: %s' % e)
+            except KeyError as e:
+                raise _Fault('Client', 'Missing element: %s' % e)
+            self._count(kind)
+            return 200, content
+        except _Fault as fault:
+            self._count('fault')
+            return 500, _fault(fault.code, fault.message)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _records(self, request):
+        records = [
+            child for child in request
+            if _localname(child).startswith('Registro')]
+        if len(records) > self.max_batch_size:
+            raise _Fault('Client', (
+                'Codigo[%d].El XML no cumple con el esquema: %d registros, '
+                'maximo %d' % (
+                    SCHEMA_ERROR, len(records), self.max_batch_size)))
+        if self.schema is not None and not self.schema.validate(request):
+            raise _Fault('Client', 'Codigo[%d].El XML no cumple con el '
+                         'esquema: %s' % (
+                             SCHEMA_ERROR, self.schema.error_log.last_error))
+        return records
+
+    def _lines_response(self, name, request, lines):
+        envelope, body = _envelope()
+        response = _sub(body, SII_R_NS, name)
+        if any(line[1] == CORRECT for line in lines):
+            _sub(response, SII_R_NS, 'CSV', 'MOCK%012X' % (
+                self._random.getrandbits(48)))
+        _copy_into(
+            response, SII_R_NS, 'Cabecera',
+            _children(request)['Cabecera'])
+        _sub(response, SII_R_NS, 'EstadoEnvio', batch_status(
+            line[1] for line in lines))
+        for invoice_id, status, code, description, duplicated in lines:
+            line = _sub(response, SII_R_NS, 'RespuestaLinea')
+            _copy_into(line, SII_R_NS, 'IDFactura', invoice_id)
+            _sub(line, SII_R_NS, 'EstadoRegistro', status)
+            if code is not None:
+                _sub(line, SII_R_NS, 'CodigoErrorRegistro', code)
+                _sub(line, SII_R_NS, 'DescripcionErrorRegistro', description)
+            if duplicated:
+                duplicate = _sub(line, SII_R_NS, 'RegistroDuplicado')
+                _sub(duplicate, SII_NS, 'EstadoRegistroDuplicado', _RECORDED)
+        return etree.tostring(
+            envelope, xml_declaration=True, encoding='UTF-8')
+
+    def _line(self, book, comm_kind, key, record):
+        """(status, error code, description, duplicated) of a record"""
+        if self._chance(self.reject_rate):
+            return INCORRECT, self.reject_code, 'Error simulado', False
+        invoices = self._books[book]
+        with self._lock:
+            if record is None:
+                if invoices.pop(key, None) is None:
+                    return INCORRECT, NOT_FOUND, 'No existe la factura', False
+                return CORRECT, None, None, False
+            if comm_kind == 'A0' and key in invoices:
+                return INCORRECT, DUPLICATED, 'Factura duplicada', True
+            if comm_kind != 'A0' and key not in invoices:
+                return INCORRECT, NOT_FOUND, 'No existe la factura', False
+            invoices[key] = (record, _timestamp())
+        return CORRECT, None, None, False
+
+    def _submit(self, request, book):
+        comm_kind = _text(
+            _children(_children(request)['Cabecera']), 'TipoComunicacion')
+        lines = []
+        for record in self._records(request):
+            invoice_id = _children(record)['IDFactura']
+            lines.append((invoice_id,) + self._line(
+                book, comm_kind, _invoice_key(invoice_id), record))
+        return self._lines_response(
+            'RespuestaLRFacturas' + book, request, lines)
+
+    def _cancel(self, request, book):
+        lines = []
+        for record in self._records(request):
+            invoice_id = _children(record)['IDFactura']
+            lines.append((invoice_id,) + self._line(
+                book, None, _invoice_key(invoice_id), None))
+        return self._lines_response(
+            'RespuestaLRBajaFacturas' + book, request, lines)
+
+    def _query(self, request, book):
+        children = _children(request)
+        filter_ = _children(children['FiltroConsulta'])
+        period = _period(filter_['PeriodoLiquidacion'])
+        after = filter_.get('ClavePaginacion')
+        after = None if after is None else _invoice_key(after)
+        with self._lock:
+            invoices = list(self._books[book].items())
+        page = []
+        more = False
+        for key, (record, timestamp) in invoices:
+            if after is not None:
+                if key == after:
+                    after = None
+                continue
+            record_children = _children(record)
+            if _period(record_children['PeriodoLiquidacion']) != period:
+                continue
+            if len(page) == self.page_size:
+                more = True
+                break
+            page.append((record_children, timestamp))
+
+        envelope, body = _envelope()
+        response = _sub(
+            body, SII_LRRC_NS, 'RespuestaConsultaLRFacturas' + book)
+        _copy_into(response, SII_LRRC_NS, 'Cabecera', children['Cabecera'])
+        _copy_into(
+            response, SII_LRRC_NS, 'PeriodoLiquidacion',
+            filter_['PeriodoLiquidacion'])
+        _sub(
+            response, SII_LRRC_NS, 'IndicadorPaginacion',
+            'S' if more else 'N')
+        _sub(
+            response, SII_LRRC_NS, 'ResultadoConsulta',
+            'ConDatos' if page else 'SinDatos')
+        invoice_element, data_element = _BOOKS[book]
+        for record_children, timestamp in page:
+            line = _sub(
+                response, SII_LRRC_NS,
+                'RegistroRespuestaConsultaLRFacturas' + book)
+            _copy_into(
+                line, SII_LRRC_NS, 'IDFactura', record_children['IDFactura'])
+            _copy_into(
+                line, SII_LRRC_NS, data_element,
+                record_children[invoice_element])
+            state = _sub(line, SII_LRRC_NS, 'EstadoFactura')
+            _sub(state, SII_LRRC_NS, 'TimestampUltimaModificacion', timestamp)
+            _sub(state, SII_LRRC_NS, 'EstadoRegistro', _RECORDED)
+        return etree.tostring(
+            envelope, xml_declaration=True, encoding='UTF-8')
@@ -0,0 +1,105 @@
+
+__all__ = [
+    'MapperSpec',
+    'ParallelMapper',
+]
+
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .compiled import compile_mapper
+from .service import _chunks
+
+# Mapper built by this worker process: (ParallelMapper token, mapper)
+_worker_mapper = (None, None)
+
+
+class MapperSpec(object):
+    """
+    Picklable recipe of a mapper, built in each worker process as
+    factory(*args, **kwargs). `factory` must be importable by the
+    workers, e.g. a mapper class defined at module level, and so must
+    its arguments. With `compiled`, the mapper is passed through
+    pyAEATsii.compiled.compile_mapper.
+    """
+
+    def __init__(self, factory, args=(), kwargs=None, compiled=False):
+        self.factory = factory
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.compiled = compiled
+
+    def build(self):
+        mapper = self.factory(*self.args, **self.kwargs)
+        return compile_mapper(mapper) if self.compiled else mapper
+
+
+def _map_chunk(token, spec, method, invoices):
+    global _worker_mapper
+    if _worker_mapper[0] != token:
+        _worker_mapper = (token, spec.build())
+    build = getattr(_worker_mapper[1], method)
+    return [build(invoice) for invoice in invoices]
+
+
+class ParallelMapper(object):
+    """
+    Map invoices on a pool of processes, for batches big enough for the
+    mapping to keep one core busy. Invoices are sent to the workers in
+    chunks of `chunk_size`, so they must be picklable, and the mapper is
+    built once per worker from `spec`, a MapperSpec.
+
+    Pass it as the `pool` of the services' batch methods, which then
+    send each batch while the next ones are being mapped. A pool is
+    created for `max_workers` processes unless an `executor` is given.
+    """
+
+    def __init__(
+            self, spec, max_workers=None, chunk_size=500, executor=None):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be a positive integer')
+        self.spec = spec
+        self.chunk_size = chunk_size
+        self._token = uuid.uuid4().hex
+        self._own_executor = executor is None
+        self._executor = executor or ProcessPoolExecutor(max_workers)
+
+    def map(self, invoices, method='build_submit_request', ahead=4):
+        """
+        Yield the records built by `method` for each invoice, in input
+        order. Up to `ahead` chunks are being mapped ahead of the records
+        consumed so far, even while the generator is suspended.
+        """
+        pending = deque()
+        for chunk in _chunks(invoices, self.chunk_size):
+            if len(pending) >= ahead:
+                for record in pending.popleft().result():
+                    yield record
+            pending.append(self._executor.submit(
+                _map_chunk, self._token, self.spec, method, chunk))
+        while pending:
+            for record in pending.popleft().result():
+                yield record
+
+    def batches(
+            self, invoices, batch_size, method='build_submit_request',
+            prefetch=1):
+        """
+        Yield lists of at most `batch_size` mapped records, with the
+        following `prefetch` batches being mapped meanwhile
+        """
+        per_batch = -(-batch_size // self.chunk_size)
+        return _chunks(
+            self.map(invoices, method, ahead=per_batch * (prefetch + 1)),
+            batch_size)
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
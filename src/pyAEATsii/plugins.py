@@ -1,30 +1,261 @@
 
 __all__ = [
     'LoggingPlugin',
+    'BoundedHistoryPlugin',
+    'PayloadFilePlugin',
+    'SessionIdPlugin',
 ]
 
-from logging import getLogger
+import os
+import re
+import threading
+import time
+from collections import deque
+from logging import DEBUG, getLogger
 from lxml import etree
+from requests.cookies import create_cookie
 from zeep import Plugin
 
+from .cache import _replace
+
 _logger = getLogger(__name__)
 
 
+class _LazyEnvelope(object):
+    """Serialize an envelope only when the log record is formatted"""
+    __slots__ = ('envelope', 'pretty_print', 'max_bytes')
+
+    def __init__(self, envelope, pretty_print=True, max_bytes=None):
+        self.envelope = envelope
+        self.pretty_print = pretty_print
+        self.max_bytes = max_bytes
+
+    def __str__(self):
+        data = etree.tostring(self.envelope, pretty_print=self.pretty_print)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            data = data[:self.max_bytes] + b'...'
+        return data.decode('utf-8', 'replace')
+
+
 class LoggingPlugin(Plugin):
+    """
+    Log http headers, operation and envelope of every call at DEBUG
+    level. Envelopes are only serialized when that level is enabled, and
+    cut to `max_bytes` when given.
+    """
 
-    def ingress(self, envelope, http_headers, operation):
+    def __init__(self, max_bytes=None, pretty_print=True):
+        self.max_bytes = max_bytes
+        self.pretty_print = pretty_print
+
+    def _log(self, envelope, http_headers, operation):
+        if not _logger.isEnabledFor(DEBUG):
+            return
         _logger.debug('http_headers: %s', http_headers)
         _logger.debug('operation: %s', operation)
-        _logger.debug('envelope: %s', etree.tostring(
-            envelope, pretty_print=True))
+        _logger.debug('envelope: %s', _LazyEnvelope(
+            envelope, self.pretty_print, self.max_bytes))
+
+    def ingress(self, envelope, http_headers, operation):
+        self._log(envelope, http_headers, operation)
         return envelope, http_headers
 
     def egress(self, envelope, http_headers, operation, binding_options):
-        _logger.debug('http_headers: %s', http_headers)
-        _logger.debug('operation: %s', operation)
-        _logger.debug('envelope: %s', etree.tostring(
-            envelope, pretty_print=True))
+        self._log(envelope, http_headers, operation)
         return envelope, http_headers
 
 
-# TODO: JSESSIONID Plugin
+def _timestamp():
+    """Current local time as in the logging asctime"""
+    now = time.time()
+    return '%s,%03d' % (
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+        now % 1 * 1000)
+
+
+class PayloadFilePlugin(Plugin):
+    """
+    Write every sent and received envelope, as is, to `filename`, which
+    is rotated once it would grow past `max_bytes` keeping
+    `backup_count` old files, as logging's RotatingFileHandler does.
+    Meant for audit capture, it does not go through the module loggers.
+    """
+
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, backup_count=10):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        self._file.seek(0, os.SEEK_END)
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backup_count - 1, 0, -1):
+            name = '%s.%d' % (self.filename, n)
+            if os.path.exists(name):
+                _replace(name, '%s.%d' % (self.filename, n + 1))
+        _replace(self.filename, self.filename + '.1')
+        self._open()
+
+    def _write(self, kind, envelope, operation):
+        header = '%s %s %s\n' % (
+            _timestamp(), kind, getattr(operation, 'name', operation))
+        data = header.encode('utf-8') + etree.tostring(envelope) + b'\n'
+        with self._lock:
+            if self._file is None:
+                self._open()
+            size = self._file.tell()
+            if (self.max_bytes and self.backup_count and size
+                    and size + len(data) > self.max_bytes):
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+
+    def ingress(self, envelope, http_headers, operation):
+        self._write('received', envelope, operation)
+        return envelope, http_headers
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        self._write('sent', envelope, operation)
+        return envelope, http_headers
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class BoundedHistoryPlugin(Plugin):
+    """
+    Keep the last `maxlen` envelopes (by default the last sent and
+    received pair), serialized to bytes so no lxml tree outlives its
+    call. When `max_bytes` is set,
+    older entries are dropped to keep the total size under it and a
+    single larger envelope is truncated.
+    """
+
+    def __init__(self, maxlen=2, max_bytes=None):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self._entries = deque()
+        self._size = 0
+
+    def _add(self, kind, envelope, http_headers, operation):
+        data = etree.tostring(envelope)
+        if self.max_bytes is not None:
+            data = data[:self.max_bytes]
+        self._entries.append({
+            'kind': kind,
+            'operation': getattr(operation, 'name', operation),
+            'http_headers': dict(http_headers or {}),
+            'envelope': data,
+        })
+        self._size += len(data)
+        while (
+                len(self._entries) > self.maxlen or
+                self.max_bytes is not None and self._size > self.max_bytes):
+            self._size -= len(self._entries.popleft()['envelope'])
+
+    def ingress(self, envelope, http_headers, operation):
+        self._add('received', envelope, http_headers, operation)
+        return envelope, http_headers
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        self._add('sent', envelope, http_headers, operation)
+        return envelope, http_headers
+
+    @property
+    def entries(self):
+        """Kept entries, oldest first"""
+        return list(self._entries)
+
+    def _last(self, kind):
+        for entry in reversed(self._entries):
+            if entry['kind'] == kind:
+                return entry['envelope']
+
+    @property
+    def last_sent(self):
+        return self._last('sent')
+
+    @property
+    def last_received(self):
+        return self._last('received')
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+
+def _needs_envelopes(plugins):
+    """
+    Whether any of `plugins` reads the envelope trees, rather than the
+    HTTP headers alone as SessionIdPlugin does
+    """
+    return any(not isinstance(plugin, SessionIdPlugin) for plugin in plugins)
+
+
+class SessionIdPlugin(Plugin):
+    """
+    Reuse the server session across calls, as recommended by AEAT: the
+    session cookies set by a response are sent back on every later
+    request made through this plugin, even when the request goes through
+    another connection.
+
+    They are put in `cookies`, the cookie jar of the transport session,
+    replacing any other value, so the jar still sends its other cookies,
+    e.g. those of load balancers. Without a jar they are sent in the
+    Cookie header, which then takes the place of any jar.
+    """
+    # http://www.agenciatributaria.es/AEAT.internet/Inicio/Ayuda/Modelos__Procedimientos_y_Servicios/Ayuda_P_G417____IVA__Llevanza_de_libros_registro__SII_/Ayuda_tecnica/Informacion_tecnica_SII/Preguntas_tecnicas_frecuentes/1__Cuestiones_Generales/16___Como_se_debe_utilizar_el_dato_sesionId__.shtml  # noqa: E501
+
+    def __init__(self, cookie_names=('JSESSIONID', 'sesionId'), cookies=None):
+        self._pattern = re.compile(
+            r'(?:^|[,;]\s*)(%s)=([^;,\s]+)'
+            % '|'.join(re.escape(n) for n in cookie_names))
+        self._lock = threading.Lock()
+        # httpx keeps the cookielib jar of its Cookies in `jar`
+        self._jar = getattr(cookies, 'jar', cookies)
+        self.cookies = {}
+
+    def ingress(self, envelope, http_headers, operation):
+        set_cookie = (http_headers or {}).get('Set-Cookie')
+        if set_cookie:
+            found = dict(self._pattern.findall(set_cookie))
+            if found:
+                with self._lock:
+                    self.cookies.update(found)
+        return envelope, http_headers
+
+    def _store(self, cookies):
+        for name, value in cookies.items():
+            held = [c for c in self._jar if c.name == name]
+            if len(held) == 1 and held[0].value == value:
+                continue
+            for cookie in held:
+                self._jar.clear(cookie.domain, cookie.path, cookie.name)
+            self._jar.set_cookie(create_cookie(name, value))
+
+    def egress(self, envelope, http_headers, operation, binding_options):
+        with self._lock:
+            cookies = dict(self.cookies)
+        if cookies and self._jar is not None:
+            self._store(cookies)
+        elif cookies:
+            current = [
+                c for c in http_headers.get('Cookie', '').split('; ')
+                if c and c.split('=', 1)[0] not in cookies
+            ]
+            http_headers['Cookie'] = '; '.join(current + [
+                '%s=%s' % item for item in sorted(cookies.items())
+            ])
+        return envelope, http_headers
+
+    def reset(self):
+        with self._lock:
+            self.cookies.clear()
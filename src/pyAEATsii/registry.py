@@ -0,0 +1,80 @@
+
+__all__ = [
+    'ClientRegistry',
+    'default_registry',
+]
+
+import threading
+from collections import OrderedDict
+from logging import getLogger
+
+from requests.adapters import DEFAULT_POOLSIZE
+from zeep.transports import Transport
+from zeep.wsdl import Document
+
+from .cache import OfflineTransport
+from .service import _get_session
+
+_logger = getLogger(__name__)
+
+
+class ClientRegistry(object):
+    """
+    Shares parsed WSDL documents and pooled certificate sessions between
+    bindings.
+
+    Every WSDL is parsed once for the whole registry, with zeep 4.2 or
+    later, and one connection-pooled session is kept per (certificate,
+    key) pair. Only
+    the `max_sessions` most recently used sessions are kept open; older
+    ones are closed, which just drops their idle connections should a
+    service bound to them still be in use.
+    """
+
+    def __init__(
+            self, max_sessions=32, pool_maxsize=DEFAULT_POOLSIZE,
+            cache=None, offline=False):
+        self.max_sessions = max_sessions
+        self.pool_maxsize = pool_maxsize
+        self.cache = cache
+        self.offline = offline
+        self._lock = threading.RLock()
+        self._documents = {}
+        self._sessions = OrderedDict()
+
+    def document(self, wsdl):
+        with self._lock:
+            document = self._documents.get(wsdl)
+            if document is None:
+                # The documents are public, no client certificate needed
+                transport = (OfflineTransport if self.offline else Transport)(
+                    cache=self.cache)
+                document = self._documents[wsdl] = Document(wsdl, transport)
+            return document
+
+    def session(self, public_crt, private_key):
+        key = (public_crt, private_key)
+        with self._lock:
+            session = self._sessions.pop(key, None)
+            if session is None:
+                session = _get_session(
+                    public_crt, private_key, self.pool_maxsize)
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                evicted_key, evicted = self._sessions.popitem(last=False)
+                _logger.debug('Closing session for %s', evicted_key[0])
+                evicted.close()
+            return session
+
+    def transport(self, public_crt, private_key):
+        return (OfflineTransport if self.offline else Transport)(
+            session=self.session(public_crt, private_key), cache=self.cache)
+
+    def close(self):
+        with self._lock:
+            while self._sessions:
+                self._sessions.popitem()[1].close()
+            self._documents.clear()
+
+
+default_registry = ClientRegistry()
@@ -0,0 +1,396 @@
+
+__all__ = [
+    'BatchResult',
+    'InvoiceResult',
+    'ResponseLines',
+    'batch_status',
+    'record_key',
+    'CORRECT',
+    'ACCEPTED_WITH_ERRORS',
+    'INCORRECT',
+    'BATCH_CORRECT',
+    'BATCH_PARTIALLY_CORRECT',
+    'BATCH_INCORRECT',
+    'DUPLICATED',
+    'NOT_FOUND',
+    'TRANSIENT_ERRORS',
+]
+
+from io import BytesIO
+
+from lxml import etree
+from zeep.exceptions import Fault, TransportError
+
+from .mapping import _format_date
+
+# EstadoRegistro of a line
+CORRECT = 'Correcto'
+ACCEPTED_WITH_ERRORS = 'AceptadoConErrores'
+INCORRECT = 'Incorrecto'
+
+# EstadoEnvio of a batch
+BATCH_CORRECT = 'Correcto'
+BATCH_PARTIALLY_CORRECT = 'ParcialmenteCorrecto'
+BATCH_INCORRECT = 'Incorrecto'
+
+# CodigoErrorRegistro of an invoice already recorded by AEAT
+DUPLICATED = 3000
+
+# CodigoErrorRegistro of a modification or cancellation of an invoice
+# that is not recorded
+NOT_FOUND = 3002
+
+# CodigoErrorRegistro of technical (database) errors on AEAT's side: the
+# line may be recorded if sent again, unlike with validation errors
+TRANSIENT_ERRORS = frozenset({3500, 3501})
+
+# Per invoice elements of the SuministroLR/AnulacionLR and ConsultaLR
+# responses
+_LINES = frozenset({
+    'RespuestaLinea',
+    'RegistroRespuestaConsultaLRFacturasEmitidas',
+    'RegistroRespuestaConsultaLRFacturasRecibidas',
+})
+
+
+def _localname(element):
+    tag = element.tag
+    return tag[tag.index('}') + 1:] if tag[0] == '{' else tag
+
+
+def _children(element):
+    return dict((_localname(child), child) for child in element)
+
+
+def _text(children, name):
+    child = children.get(name)
+    return None if child is None else child.text
+
+
+def record_key(record):
+    """
+    The key of a record built by the mappers, matching the key of its
+    InvoiceResult
+    """
+    invoice_id = record['IDFactura']
+    issuer = invoice_id['IDEmisorFactura']
+    nif = issuer.get('NIF')
+    if nif is None and issuer.get('IDOtro'):
+        nif = issuer['IDOtro'].get('ID')
+    # Serial numbers are text in the responses, whatever the mappers gave
+    return (
+        nif,
+        u'%s' % invoice_id['NumSerieFacturaEmisor'],
+        _format_date(invoice_id['FechaExpedicionFacturaEmisor']),
+    )
+
+
+def batch_status(statuses):
+    """The EstadoEnvio of a batch whose lines have `statuses`"""
+    statuses = set(statuses)
+    if statuses <= {CORRECT}:
+        return BATCH_CORRECT
+    if statuses == {INCORRECT}:
+        return BATCH_INCORRECT
+    return BATCH_PARTIALLY_CORRECT
+
+
+def _get(value, name):
+    """Item of a zeep response value or dict, None when missing"""
+    if value is None:
+        return None
+    try:
+        return value[name]
+    except KeyError:
+        return None
+
+
+class InvoiceResult(object):
+    """
+    The outcome of one invoice of a response: a RespuestaLinea, or the
+    EstadoFactura of a query record
+    """
+    __slots__ = (
+        'nif',
+        'serial_number',
+        'issue_date',
+        'status',
+        'error_code',
+        'error_description',
+        'csv',
+        'duplicated',
+    )
+
+    def __init__(
+            self, nif, serial_number, issue_date, status, error_code=None,
+            error_description=None, csv=None, duplicated=False):
+        self.nif = nif
+        self.serial_number = serial_number
+        self.issue_date = issue_date
+        self.status = status
+        self.error_code = error_code
+        self.error_description = error_description
+        self.csv = csv
+        self.duplicated = duplicated
+
+    @property
+    def key(self):
+        """(issuer NIF or foreign ID, serial number, issue date)"""
+        return (self.nif, self.serial_number, self.issue_date)
+
+    def __repr__(self):
+        return '<InvoiceResult %s %s %s: %s%s>' % (
+            self.nif, self.serial_number, self.issue_date, self.status,
+            '' if self.error_code is None else ' (%s)' % self.error_code)
+
+    @classmethod
+    def from_element(cls, line):
+        """Build the result of a RespuestaLinea or query record element"""
+        children = _children(line)
+        state = children.get('EstadoFactura')
+        if state is not None:
+            children = dict(children, **_children(state))
+        invoice_id = _children(children['IDFactura'])
+        issuer = _children(invoice_id['IDEmisorFactura'])
+        nif = _text(issuer, 'NIF')
+        if nif is None and 'IDOtro' in issuer:
+            nif = _text(_children(issuer['IDOtro']), 'ID')
+        error_code = _text(children, 'CodigoErrorRegistro')
+        return cls(
+            nif,
+            _text(invoice_id, 'NumSerieFacturaEmisor'),
+            _text(invoice_id, 'FechaExpedicionFacturaEmisor'),
+            _text(children, 'EstadoRegistro'),
+            error_code=None if error_code is None else int(error_code),
+            error_description=_text(children, 'DescripcionErrorRegistro'),
+            csv=_text(children, 'CSV'),
+            duplicated='RegistroDuplicado' in children,
+        )
+
+    @classmethod
+    def from_value(cls, line):
+        """Build the result of a RespuestaLinea as processed by zeep"""
+        invoice_id = line['IDFactura']
+        issuer = invoice_id['IDEmisorFactura']
+        nif = _get(issuer, 'NIF')
+        if nif is None:
+            nif = _get(_get(issuer, 'IDOtro'), 'ID')
+        error_code = _get(line, 'CodigoErrorRegistro')
+        return cls(
+            nif,
+            invoice_id['NumSerieFacturaEmisor'],
+            invoice_id['FechaExpedicionFacturaEmisor'],
+            line['EstadoRegistro'],
+            error_code=None if error_code is None else int(error_code),
+            error_description=_get(line, 'DescripcionErrorRegistro'),
+            csv=_get(line, 'CSV'),
+            duplicated=_get(line, 'RegistroDuplicado') is not None,
+        )
+
+
+class ResponseLines(object):
+    """
+    Iterate the per invoice results of a SuministroLR/AnulacionLR
+    response while it is parsed, without building the whole tree:
+    `source` is a file-like object, e.g. the raw stream of an HTTP
+    response. Each RespuestaLinea is dropped once its InvoiceResult is
+    yielded.
+
+    Query responses are read the same way, their records being yielded
+    with the state of each invoice.
+
+    The batch status (EstadoEnvio, or ResultadoConsulta for queries) and
+    CSV come before the lines in the response, so they are set on the
+    `status` and `csv` attributes once iteration has started, as is
+    `more` when a query has further pages. A SOAP fault is raised as a
+    zeep Fault.
+    """
+
+    def __init__(self, source, close=None):
+        self.status = None
+        self.csv = None
+        self.more = False
+        self._source = source
+        self._close = close
+
+    @classmethod
+    def from_response(cls, response, streamed=False):
+        """
+        Read the lines of a requests response. If it was `streamed`, they
+        are parsed from the connection as they arrive and the response is
+        closed once they are exhausted.
+        """
+        if response.status_code not in (200, 500):
+            content = response.content
+            response.close()
+            raise TransportError(
+                'Server returned HTTP status %d' % response.status_code,
+                status_code=response.status_code, content=content)
+        if response.status_code == 500:
+            # Raise the fault now rather than once the lines are iterated
+            content = response.content
+            for line in cls(BytesIO(content)):
+                pass
+            return cls(BytesIO(content))
+        if streamed:
+            response.raw.decode_content = True
+            return cls(response.raw, close=response.close)
+        return cls(BytesIO(response.content))
+
+    def __iter__(self):
+        try:
+            for event, element in etree.iterparse(
+                    self._source, events=('end',)):
+                name = _localname(element)
+                if name in _LINES:
+                    yield InvoiceResult.from_element(element)
+                elif name in ('EstadoEnvio', 'ResultadoConsulta'):
+                    self.status = element.text
+                elif name == 'IndicadorPaginacion':
+                    self.more = element.text == 'S'
+                elif name == 'CSV' and self.status is None:
+                    self.csv = element.text
+                elif name == 'Fault':
+                    children = _children(element)
+                    raise Fault(
+                        _text(children, 'faultstring'),
+                        code=_text(children, 'faultcode'))
+                else:
+                    continue
+                # Lines are yielded as soon as they are complete, drop
+                # their elements along with anything already processed
+                parent = element.getparent()
+                element.clear()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+        finally:
+            self.close()
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BatchResult(object):
+    """
+    The outcome of a SuministroLR/AnulacionLR batch: its `status`
+    (EstadoEnvio) and `csv`, and the InvoiceResult of each line, in
+    response order and indexed by their key.
+
+    Lookup takes the (issuer NIF, serial number, issue date) key, the
+    issue date either as in the response (DD-MM-YYYY) or as a date.
+    """
+    __slots__ = ('status', 'csv', 'lines', '_index')
+
+    def __init__(self, status, csv, lines):
+        self.status = status
+        self.csv = csv
+        self.lines = list(lines)
+        self._index = dict(
+            (line.key, i) for i, line in enumerate(self.lines))
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Read a whole ResponseLines"""
+        lines_ = list(lines)
+        return cls(lines.status, lines.csv, lines_)
+
+    @classmethod
+    def from_response(cls, response):
+        """Read a response processed by zeep"""
+        return cls(
+            response['EstadoEnvio'], _get(response, 'CSV'),
+            [
+                InvoiceResult.from_value(line)
+                for line in _get(response, 'RespuestaLinea') or []
+            ])
+
+    @staticmethod
+    def _key(key):
+        nif, serial_number, issue_date = key
+        return (nif, serial_number, _format_date(issue_date))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __contains__(self, key):
+        return self._key(key) in self._index
+
+    def __getitem__(self, key):
+        return self.lines[self._index[self._key(key)]]
+
+    def get(self, key, default=None):
+        i = self._index.get(self._key(key))
+        return default if i is None else self.lines[i]
+
+    def __repr__(self):
+        return '<BatchResult %s: %d lines>' % (self.status, len(self.lines))
+
+    def merge(self, other):
+        """
+        Take the outcome of lines sent again from `other`, another
+        BatchResult or InvoiceResults, and update the batch status
+        """
+        for line in other:
+            i = self._index.get(line.key)
+            if i is None:
+                self._index[line.key] = len(self.lines)
+                self.lines.append(line)
+            else:
+                self.lines[i] = line
+        self.status = batch_status(line.status for line in self.lines)
+        return self
+
+    def with_status(self, *statuses):
+        return [line for line in self.lines if line.status in statuses]
+
+    @property
+    def accepted(self):
+        """Lines recorded, with or without errors"""
+        return self.with_status(CORRECT, ACCEPTED_WITH_ERRORS)
+
+    @property
+    def correct(self):
+        return self.with_status(CORRECT)
+
+    @property
+    def accepted_with_errors(self):
+        return self.with_status(ACCEPTED_WITH_ERRORS)
+
+    @property
+    def rejected(self):
+        return self.with_status(INCORRECT)
+
+    def retryable(self, codes=TRANSIENT_ERRORS):
+        """Rejected lines whose error is transient"""
+        return [
+            line for line in self.rejected if line.error_code in codes]
+
+    def permanently_rejected(self, codes=TRANSIENT_ERRORS):
+        """Rejected lines whose error is not transient"""
+        return [
+            line for line in self.rejected if line.error_code not in codes]
+
+    def with_error(self, *codes):
+        """Lines holding any of the error `codes`"""
+        codes = set(codes)
+        return [line for line in self.lines if line.error_code in codes]
+
+    def error_codes(self):
+        """Number of lines per error code"""
+        counts = {}
+        for line in self.lines:
+            if line.error_code is not None:
+                counts[line.error_code] = counts.get(line.error_code, 0) + 1
+        return counts
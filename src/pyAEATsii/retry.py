@@ -0,0 +1,174 @@
+
+__all__ = [
+    'RetryPolicy',
+    'CircuitBreaker',
+    'CircuitOpenError',
+    'fault_code',
+]
+
+import random
+import re
+import threading
+import time
+from logging import getLogger
+
+from requests.exceptions import ConnectionError, Timeout
+from zeep.exceptions import Fault, TransportError
+
+_logger = getLogger(__name__)
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_FAULT_CODE = re.compile(r'Codigo\[(\d+)\]')
+
+
+def fault_code(fault):
+    """The AEAT error code (Codigo[NNNN]) of a fault, if any"""
+    match = _FAULT_CODE.search(fault.message or '')
+    return int(match.group(1)) if match else None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the service while the breaker is open"""
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a degraded service: after `failure_threshold` failed
+    attempts in a row the circuit opens and calls fail right away with
+    CircuitOpenError, or wait if `block` is set, for `reset_timeout`
+    seconds. Then a single trial call is let through, which closes the
+    circuit again on success or reopens it on failure.
+
+    A breaker may be shared by several policies and threads.
+    """
+
+    def __init__(
+            self, failure_threshold=5, reset_timeout=60.0, block=False,
+            clock=_clock, sleep=time.sleep):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.block = block
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_call(self):
+        while True:
+            with self._lock:
+                if self._opened_at is None:
+                    return
+                remaining = (
+                    self._opened_at + self.reset_timeout - self._clock())
+                if remaining <= 0 and not self._trial:
+                    self._trial = True
+                    return
+            if not self.block:
+                raise CircuitOpenError(
+                    'Circuit open, AEAT calls paused for %.1fs'
+                    % max(remaining, 0))
+            self._sleep(max(remaining, 0.1))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    _logger.warning(
+                        'Opening circuit after %d failures', self._failures)
+                self._opened_at = self._clock()
+                self._trial = False
+
+
+class RetryPolicy(object):
+    """
+    Retry failed AEAT calls up to `max_attempts` times in all, sleeping
+    between attempts with exponential backoff (`backoff` seconds doubled
+    each attempt, at most `max_backoff`) and full jitter.
+
+    A failure is retried when it is:
+
+    - a SOAP fault whose faultcode is a Server one, or whose AEAT error
+      code is in `fault_codes`
+    - a zeep TransportError with a status in `http_statuses`
+    - an instance of `exceptions`, connection errors and timeouts by
+      default
+
+    Any other exception is raised right away. An optional `breaker`
+    (see CircuitBreaker) is told about every attempt.
+    """
+
+    def __init__(
+            self, max_attempts=5, backoff=0.5, max_backoff=30.0,
+            fault_codes=(), http_statuses=(500, 502, 503, 504),
+            exceptions=(ConnectionError, Timeout), breaker=None,
+            sleep=time.sleep):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be a positive integer')
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fault_codes = frozenset(fault_codes)
+        self.http_statuses = frozenset(http_statuses)
+        self.exceptions = tuple(exceptions)
+        self.breaker = breaker
+        self._sleep = sleep
+
+    def is_retryable(self, exc):
+        if isinstance(exc, Fault):
+            return (
+                (exc.code or '').endswith('Server')
+                or fault_code(exc) in self.fault_codes)
+        if isinstance(exc, TransportError):
+            return exc.status_code in self.http_statuses
+        return isinstance(exc, self.exceptions)
+
+    def delay(self, attempt):
+        """Seconds to wait after the failed `attempt` (1 based)"""
+        ceiling = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call `function` until it succeeds or fails for good, return its
+        result along with the number of attempts made.
+        """
+        attempt = 1
+        while True:
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as exc:
+                retryable = self.is_retryable(exc)
+                if self.breaker is not None:
+                    # Anything else means the service did answer
+                    if retryable:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                if not retryable or attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt)
+                _logger.warning(
+                    'Attempt %d failed (%r), retrying in %.2fs',
+                    attempt, exc, delay)
+                self._sleep(delay)
+                attempt += 1
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result, attempt
@@ -0,0 +1,301 @@
+
+__all__ = [
+    'iter_envelope',
+    'post_envelope',
+]
+
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+from logging import getLogger
+
+from lxml import etree
+from zeep.plugins import apply_egress
+from zeep.wsdl.utils import etree_to_string
+
+from .instrumentation import _post
+from .plugins import _needs_envelopes
+
+_logger = getLogger(__name__)
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+_NS_BASE = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/'
+    'internet/dep/aplicaciones/es/aeat/ssii/fact/ws/')
+SII_LR_NS = _NS_BASE + 'SuministroLR.xsd'
+SII_NS = _NS_BASE + 'SuministroInformacion.xsd'
+
+_NSMAP = {
+    'soapenv': SOAP_ENV_NS,
+    'siiLR': SII_LR_NS,
+    'sii': SII_NS,
+}
+
+# operation: (request element, record element)
+OPERATIONS = {
+    'SuministroLRFacturasEmitidas':
+        ('SuministroLRFacturasEmitidas', 'RegistroLRFacturasEmitidas'),
+    'SuministroLRFacturasRecibidas':
+        ('SuministroLRFacturasRecibidas', 'RegistroLRFacturasRecibidas'),
+    'AnulacionLRFacturasEmitidas':
+        ('BajaLRFacturasEmitidas', 'RegistroLRBajaExpedidas'),
+    'AnulacionLRFacturasRecibidas':
+        ('BajaLRFacturasRecibidas', 'RegistroLRBajaRecibidas'),
+}
+
+# Record children declared in SuministroLR.xsd, the rest of the tree
+# belongs to SuministroInformacion.xsd
+_LR_ELEMENTS = frozenset({'IDFactura', 'FacturaExpedida', 'FacturaRecibida'})
+
+# Element order of the XSD sequences, children missing here are written
+# after the known ones in the order the mappers produce them
+_ORDER = {
+    'Cabecera': (
+        'IDVersionSii', 'Titular', 'TipoComunicacion'),
+    'Titular': (
+        'NombreRazon', 'NIFRepresentante', 'NIF'),
+    'Registro': (
+        'PeriodoLiquidacion', 'IDFactura', 'FacturaExpedida',
+        'FacturaRecibida'),
+    'PeriodoLiquidacion': (
+        'Ejercicio', 'Periodo'),
+    'IDFactura': (
+        'IDEmisorFactura', 'NumSerieFacturaEmisor',
+        'NumSerieFacturaEmisorResumenFin', 'FechaExpedicionFacturaEmisor'),
+    'IDEmisorFactura': (
+        'NombreRazon', 'NIFRepresentante', 'NIF', 'IDOtro'),
+    'Contraparte': (
+        'NombreRazon', 'NIFRepresentante', 'NIF', 'IDOtro'),
+    'IDOtro': (
+        'CodigoPais', 'IDType', 'ID'),
+    'FacturaExpedida': (
+        'TipoFactura', 'TipoRectificativa', 'FacturasAgrupadas',
+        'FacturasRectificadas', 'ImporteRectificacion', 'FechaOperacion',
+        'ClaveRegimenEspecialOTrascendencia',
+        'ClaveRegimenEspecialOTrascendenciaAdicional1',
+        'ClaveRegimenEspecialOTrascendenciaAdicional2',
+        'NumRegistroAcuerdoFacturacion', 'ImporteTotal',
+        'BaseImponibleACoste', 'DescripcionOperacion', 'RefExterna',
+        'FacturaSimplificadaArticulos7.2_7.3', 'EntidadSucedida',
+        'RegPrevioGGEEoREDEMEoCompetencia', 'Macrodato', 'DatosInmueble',
+        'ImporteTransmisionInmueblesSujetoAIVA',
+        'EmitidaPorTercerosODestinatario',
+        'FacturacionDispAdicionalTerceraYsextayDelMercadoOrganizadoDelGas',
+        'VariosDestinatarios', 'Cupon',
+        'FacturaSinIdentifDestinatarioArticulo6.1.d', 'Contraparte',
+        'TipoDesglose'),
+    'FacturaRecibida': (
+        'TipoFactura', 'TipoRectificativa', 'FacturasAgrupadas',
+        'FacturasRectificadas', 'ImporteRectificacion', 'FechaOperacion',
+        'ClaveRegimenEspecialOTrascendencia',
+        'ClaveRegimenEspecialOTrascendenciaAdicional1',
+        'ClaveRegimenEspecialOTrascendenciaAdicional2',
+        'NumRegistroAcuerdoFacturacion', 'ImporteTotal',
+        'BaseImponibleACoste', 'DescripcionOperacion', 'RefExterna',
+        'FacturaSimplificadaArticulos7.2_7.3', 'EntidadSucedida',
+        'RegPrevioGGEEoREDEMEoCompetencia', 'Macrodato', 'DesgloseFactura',
+        'Contraparte', 'FechaRegContable', 'CuotaDeducible',
+        'ADeducirEnPeriodoPosterior', 'EjercicioDeduccion',
+        'PeriodoDeduccion'),
+    'ImporteRectificacion': (
+        'BaseRectificada', 'CuotaRectificada', 'CuotaRecargoRectificado'),
+    'TipoDesglose': (
+        'DesgloseFactura', 'DesgloseTipoOperacion'),
+    'DesgloseTipoOperacion': (
+        'PrestacionServicios', 'Entrega'),
+    'DesgloseFactura': (
+        'Sujeta', 'NoSujeta', 'InversionSujetoPasivo', 'DesgloseIVA'),
+    'Entrega': (
+        'Sujeta', 'NoSujeta'),
+    'PrestacionServicios': (
+        'Sujeta', 'NoSujeta'),
+    'Sujeta': (
+        'Exenta', 'NoExenta'),
+    'DetalleExenta': (
+        'CausaExencion', 'BaseImponible'),
+    'NoExenta': (
+        'TipoNoExenta', 'DesgloseIVA'),
+    'NoSujeta': (
+        'ImportePorArticulos7_14_Otros', 'ImporteTAIReglasLocalizacion'),
+    'DetalleIVA': (
+        'TipoImpositivo', 'BaseImponible', 'CuotaSoportada',
+        'CuotaRepercutida', 'TipoRecargoEquivalencia',
+        'CuotaRecargoEquivalencia', 'PorcentCompensacionREAGYP',
+        'ImporteCompensacionREAGYP'),
+}
+_POSITIONS = dict(
+    (parent, dict((name, i) for i, name in enumerate(children)))
+    for parent, children in _ORDER.items()
+)
+
+
+def _ordered_items(parent, value):
+    positions = _POSITIONS.get(parent)
+    items = value.items()
+    if positions is None:
+        return items
+    last = len(positions)
+    return sorted(items, key=lambda item: positions.get(item[0], last))
+
+
+def _text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return str(Decimal(repr(value)))
+    return u'%s' % value
+
+
+def _write(xf, ns, name, value):
+    if value is None:
+        return
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _write(xf, ns, name, item)
+        return
+    with xf.element('{%s}%s' % (ns, name)):
+        if isinstance(value, dict):
+            for child, child_value in _ordered_items(name, value):
+                _write(xf, SII_NS, child, child_value)
+        else:
+            xf.write(_text(value))
+
+
+class _Buffer(object):
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        del self._chunks[:]
+        return data
+
+
+def iter_envelope(operation, headers, records, flush_every=100):
+    """
+    Write the SOAP request of a SuministroLR/AnulacionLR `operation`
+    straight from the `headers` and record dicts built by the mappers,
+    yielding the encoded envelope in chunks of about `flush_every`
+    records. `records` may be any iterable, e.g. a generator mapping
+    invoices one at a time.
+    """
+    request, record_name = OPERATIONS[operation]
+    buf = _Buffer()
+    with etree.xmlfile(buf, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('{%s}Envelope' % SOAP_ENV_NS, nsmap=_NSMAP):
+            with xf.element('{%s}Body' % SOAP_ENV_NS):
+                with xf.element('{%s}%s' % (SII_LR_NS, request)):
+                    _write(xf, SII_NS, 'Cabecera', headers)
+                    for count, record in enumerate(records, 1):
+                        with xf.element('{%s}%s' % (SII_LR_NS, record_name)):
+                            for name, value in _ordered_items(
+                                    'Registro', record):
+                                _write(
+                                    xf,
+                                    SII_LR_NS if name in _LR_ELEMENTS
+                                    else SII_NS,
+                                    name, value)
+                        if count % flush_every == 0:
+                            xf.flush()
+                            yield buf.drain()
+    yield buf.drain()
+
+
+def _spooled(chunks, max_size=8 * 1024 * 1024):
+    spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def _prepare(service, operation, chunks, http_headers, chunked):
+    """
+    The body of a request written as `chunks`, spooled unless `chunked`,
+    and its headers once through the client plugins
+    """
+    client = service._client
+    if not _needs_envelopes(client.plugins):
+        # Only header plugins apply, there is no envelope tree to hand
+        for plugin in client.plugins:
+            plugin.egress(None, http_headers, operation, {})
+        return (chunks if chunked else _spooled(chunks)), http_headers
+    # The plugins get the envelope tree zeep would have built, so the
+    # request is written whole first
+    spool = _spooled(chunks)
+    try:
+        envelope = etree.parse(spool).getroot()
+    finally:
+        spool.close()
+    envelope, http_headers = apply_egress(
+        client, envelope, http_headers, service._binding.get(operation),
+        service._binding_options)
+    return BytesIO(etree_to_string(envelope)), http_headers
+
+
+def post_envelope(
+        service, operation, headers, records, chunked=False,
+        raw_response=False, metrics=None):
+    """
+    Send `operation` through a bound zeep service proxy with its request
+    written by iter_envelope, and return the reply processed by zeep as
+    if the call had been made through the proxy.
+
+    With `chunked` the envelope is streamed as it is written, using
+    chunked transfer encoding. Otherwise it is spooled, to disk past a
+    few megabytes, and sent with a Content-Length.
+
+    Client plugins other than SessionIdPlugin, e.g. history or payload
+    capture, are handed the envelope as a tree, as zeep does. The
+    request is then built in memory and never chunked.
+
+    With `raw_response` the requests response is returned unread, with
+    its body left to be streamed from `response.raw`.
+
+    The call is timed on `metrics`, a
+    pyAEATsii.instrumentation.CallMetrics, when given.
+    """
+    client = service._client
+    binding = service._binding
+    http_headers = {
+        'Content-Type': 'text/xml; charset=utf-8',
+        'SOAPAction': '""',
+    }
+    address = service._binding_options['address']
+    body = iter_envelope(operation, headers, records)
+    if metrics is None:
+        body, http_headers = _prepare(
+            service, operation, body, http_headers, chunked)
+        try:
+            response = client.transport.session.post(
+                address, data=body, headers=http_headers,
+                timeout=client.transport.operation_timeout,
+                stream=raw_response)
+        finally:
+            body.close()
+    else:
+        # Chunks are timed as they are written, even while being sent
+        with metrics.phase('serialization'):
+            body, http_headers = _prepare(
+                service, operation, metrics.timed(body, 'serialization'),
+                http_headers, chunked)
+        try:
+            response = _post(
+                client, address, body, http_headers, metrics,
+                stream=raw_response)
+        finally:
+            body.close()
+    _logger.debug('HTTP %s from %s', response.status_code, operation)
+    if raw_response:
+        return response
+    if metrics is None:
+        return binding.process_reply(
+            client, binding.get(operation), response)
+    with metrics.phase('parse'):
+        return binding.process_reply(
+            client, binding.get(operation), response)
@@ -2,17 +2,34 @@
 __all__ = [
     'bind_issued_invoices_service',
     'bind_recieved_invoices_service',
+    'MAX_BATCH_SIZE',
 ]
 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from logging import getLogger
 from requests import Session
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
 
+import zeep
+from lxml import etree
 from zeep import Client
+from zeep.helpers import serialize_object
+from zeep.plugins import apply_ingress
 from zeep.transports import Transport
-from zeep.plugins import HistoryPlugin
+from zeep.wsdl.utils import etree_to_string
 
+from .cache import OfflineTransport
+from .instrumentation import CallMetrics, _post
+from .plugins import BoundedHistoryPlugin
 from .plugins import LoggingPlugin
+from .plugins import SessionIdPlugin
+from .plugins import _needs_envelopes
 from .mapping import build_query_filter
+from .results import BatchResult, InvoiceResult, ResponseLines
+from .results import DUPLICATED, TRANSIENT_ERRORS, batch_status, record_key
+from .serializer import post_envelope
 
 
 _logger = getLogger(__name__)
@@ -21,113 +38,738 @@ wsdl_base = (
     'https://www2.agenciatributaria.gob.es/static_files/common/'
     'internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/')
 
+# AEAT rejects any SuministroLR/AnulacionLR request holding more records
+MAX_BATCH_SIZE = 10000
 
-def _get_client(wsdl, public_crt, private_key, test=False):
+# Kinds of result the calls may return instead of zeep's response
+_RESULTS = (None, 'lines', 'batch')
+
+# zeep takes an already parsed WSDL Document as `wsdl` from 4.2 on
+_TAKES_DOCUMENTS = tuple(
+    int(n) for n in zeep.__version__.split('.')[:2]) >= (4, 2)
+
+
+def _get_history_plugin(history):
+    return (
+        history
+        if isinstance(history, BoundedHistoryPlugin)
+        else BoundedHistoryPlugin()
+    )
+
+
+def _get_session(public_crt, private_key, pool_maxsize=DEFAULT_POOLSIZE):
     session = Session()
     session.cert = (public_crt, private_key)
-    transport = Transport(session=session)
-    plugins = [HistoryPlugin()]
-    # TODO: manually handle sessionId? Not mandatory yet recommended...
-    # http://www.agenciatributaria.es/AEAT.internet/Inicio/Ayuda/Modelos__Procedimientos_y_Servicios/Ayuda_P_G417____IVA__Llevanza_de_libros_registro__SII_/Ayuda_tecnica/Informacion_tecnica_SII/Preguntas_tecnicas_frecuentes/1__Cuestiones_Generales/16___Como_se_debe_utilizar_el_dato_sesionId__.shtml
+    # Keep enough pooled connections for concurrent batch submissions
+    session.mount('https://', HTTPAdapter(pool_maxsize=pool_maxsize))
+    return session
+
+
+def _get_client(
+        wsdl, public_crt, private_key, test=False,
+        pool_maxsize=DEFAULT_POOLSIZE, cache=None, offline=False,
+        registry=None, history=None, plugins=None, session_id=True):
+    if registry is not None:
+        transport = registry.transport(public_crt, private_key)
+        if _TAKES_DOCUMENTS:
+            # Older zeep parses the WSDL again for each client, which
+            # then loads it through the transport
+            wsdl = registry.document(wsdl)
+    else:
+        session = _get_session(public_crt, private_key, pool_maxsize)
+        transport = (OfflineTransport if offline else Transport)(
+            session=session, cache=cache)
+    plugins = list(plugins or [])
+    if history:
+        plugins.append(_get_history_plugin(history))
+    if session_id:
+        plugins.append(SessionIdPlugin(cookies=transport.session.cookies))
     if test:
         plugins.append(LoggingPlugin())
-    client = Client(wsdl=wsdl, transport=transport, plugins=plugins)
-    return client
+    return Client(wsdl=wsdl, transport=transport, plugins=plugins)
+
+
+def _bind(client, port_name, address=None):
+    if address is None:
+        return client.bind('siiService', port_name)
+    port = client.wsdl.services['siiService'].ports[port_name]
+    return client.create_service(port.binding.name, address)
+
 
+def bind_issued_invoices_service(crt, pkey, test=False, **kwargs):
+    """
+    Bind the issued invoices service. Extra keyword arguments are client
+    options:
 
-def bind_issued_invoices_service(crt, pkey, test=False):
+    - pool_maxsize: pooled connections kept for concurrent calls
+    - cache: a zeep cache (see pyAEATsii.cache.WsdlCache) for the WSDL
+      and XSD documents
+    - offline: only load those documents from `cache`
+    - registry: a pyAEATsii.registry.ClientRegistry to share the parsed
+      WSDL (with zeep 4.2 or later) and the certificate sessions with
+      other bindings, in which case the options above are taken from
+      the registry
+    - history: True, or a pyAEATsii.plugins.BoundedHistoryPlugin, to keep
+      the last envelopes (see the service's `history` attribute)
+    - plugins: extra zeep plugins, e.g. pyAEATsii.plugins.PayloadFilePlugin
+    - session_id: reuse the AEAT session cookie across calls (default)
+    - retry: a pyAEATsii.retry.RetryPolicy for the service calls
+    - address: send the requests to this URL instead of the port's, e.g.
+      that of a pyAEATsii.mockserver.MockSIIServer
+    - instruments: callables handed a
+      pyAEATsii.instrumentation.CallMetrics after every request, with
+      its timings per phase, sizes and outcomes
+    """
     wsdl = wsdl_base + 'SuministroFactEmitidas.wsdl'
     port_name = 'SuministroFactEmitidas'
     if test:
         port_name += 'Pruebas'
 
-    cli = _get_client(wsdl, crt, pkey, test)
+    retry = kwargs.pop('retry', None)
+    address = kwargs.pop('address', None)
+    instruments = kwargs.pop('instruments', ())
+    cli = _get_client(wsdl, crt, pkey, test, **kwargs)
 
     return _IssuedInvoiceService(
-        cli.bind('siiService', port_name))
+        _bind(cli, port_name, address), retry=retry,
+        instruments=instruments)
 
 
-def bind_recieved_invoices_service(crt, pkey, test=False):
+def bind_recieved_invoices_service(crt, pkey, test=False, **kwargs):
+    """
+    Bind the recieved invoices service. See bind_issued_invoices_service
+    for the accepted client options.
+    """
     wsdl = wsdl_base + 'SuministroFactRecibidas.wsdl'
     port_name = 'SuministroFactRecibidas'
     if test:
         port_name += 'Pruebas'
 
-    cli = _get_client(wsdl, crt, pkey, test)
+    retry = kwargs.pop('retry', None)
+    address = kwargs.pop('address', None)
+    instruments = kwargs.pop('instruments', ())
+    cli = _get_client(wsdl, crt, pkey, test, **kwargs)
 
     return _RecievedInvoiceService(
-        cli.bind('siiService', port_name))
+        _bind(cli, port_name, address), retry=retry,
+        instruments=instruments)
 
 
-class _IssuedInvoiceService(object):
-    def __init__(self, service):
-        self.service = service
+def _chunks(iterable, size):
+    """Split any iterable into lists of at most `size` items, lazily."""
+    if size < 1:
+        raise ValueError('Batch size must be a positive integer')
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
 
-    def submit(self, headers, invoices, mapper=None):
-        body = (
-            [mapper.build_submit_request(i) for i in invoices]
+
+def _map_ordered(function, iterable, max_workers):
+    """
+    Run `function` over `iterable` on a pool of `max_workers` threads
+    and return the results in input order. At most `max_workers` items
+    are taken from `iterable` ahead of the results collected so far.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be a positive integer')
+    results = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for item in iterable:
+            if len(pending) >= max_workers:
+                results.append(pending.popleft().result())
+            pending.append(executor.submit(function, item))
+        while pending:
+            results.append(pending.popleft().result())
+    return results
+
+
+def _plain(value):
+    """Turn a zeep response value into dicts without the unset fields"""
+    if isinstance(value, dict):
+        return {
+            k: _plain(v)
+            for k, v in value.items()
+            if v is not None
+        }
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _pagination_key(record):
+    invoice_id = serialize_object(record['IDFactura'], dict)
+    return _plain({
+        'IDEmisorFactura': invoice_id['IDEmisorFactura'],
+        'NumSerieFacturaEmisor': invoice_id['NumSerieFacturaEmisor'],
+        'FechaExpedicionFacturaEmisor':
+            invoice_id['FechaExpedicionFacturaEmisor'],
+    })
+
+
+def _merge_response(response, resent):
+    """Replace the lines of a zeep response with those sent again"""
+    lines = dict(
+        (InvoiceResult.from_value(line).key, line)
+        for line in resent['RespuestaLinea'] or [])
+    response_lines = response['RespuestaLinea']
+    for i, line in enumerate(response_lines):
+        response_lines[i] = lines.get(
+            InvoiceResult.from_value(line).key, line)
+    response['EstadoEnvio'] = batch_status(
+        line['EstadoRegistro'] for line in response_lines)
+    return response
+
+
+def _rejected_records(batch, invoices, mapper, codes):
+    """
+    Records of the lines of `batch` rejected with any of the error
+    `codes`, by key. Lines come back in request order, so only the
+    invoices in their positions are mapped, unless they turn out not to
+    match.
+    """
+    keys = set(line.key for line in batch.retryable(codes))
+    if not keys:
+        return OrderedDict()
+    invoices = list(invoices)
+
+    def build(invoice):
+        return mapper.build_submit_request(invoice) if mapper else invoice
+
+    records = OrderedDict()
+    if len(invoices) == len(batch):
+        for invoice, line in zip(invoices, batch):
+            if line.key in keys:
+                record = build(invoice)
+                if record_key(record) == line.key:
+                    records[line.key] = record
+    if len(records) < len(keys):
+        records = OrderedDict()
+        for invoice in invoices:
+            record = build(invoice)
+            key = record_key(record)
+            if key in keys:
+                records[key] = record
+    return records
+
+
+def _batches(invoices, mapper, method, batch_size, pool):
+    """(batches, mapper to apply to them) for the batch methods"""
+    if pool is None:
+        return _chunks(invoices, batch_size), mapper
+    return pool.batches(invoices, batch_size, method), None
+
+
+def _build_body(invoices, mapper, method, metrics=None):
+    if metrics is None:
+        return (
+            [getattr(mapper, method)(i) for i in invoices]
             if mapper
             else invoices
         )
-        _logger.debug(body)
-        response_ = self.service.SuministroLRFacturasEmitidas(
-            headers, body)
-        _logger.debug(response_)
-        return response_
-
-    def cancel(self, headers, invoices, mapper=None):
+    with metrics.phase('mapping'):
         body = (
-            [mapper.build_delete_request(i) for i in invoices]
+            [getattr(mapper, method)(i) for i in invoices]
             if mapper
-            else invoices
+            else list(invoices)
         )
-        _logger.debug(body)
-        response_ = self.service.AnulacionLRFacturasEmitidas(
-            headers, body)
-        _logger.debug(response_)
-        return response_
+    metrics.records = len(body)
+    return body
 
-    def query(self, headers, year=None, period=None):
-        filter_ = build_query_filter(year=year, period=period)
-        _logger.debug(filter_)
-        response_ = self.service.ConsultaLRFacturasEmitidas(
-            headers, filter_)
-        _logger.debug(response_)
-        return response_
 
+class _InvoiceService(object):
+    _submit_operation = None
+    _cancel_operation = None
+    _query_operation = None
+    _query_records = None
 
-class _RecievedInvoiceService(object):
-    def __init__(self, service):
+    def __init__(self, service, retry=None, instruments=()):
         self.service = service
+        self.retry = retry
+        self.instruments = tuple(instruments)
 
-    def submit(self, headers, invoices, mapper=None):
-        body = (
-            [mapper.build_submit_request(i) for i in invoices]
-            if mapper
-            else invoices
-        )
+    @property
+    def history(self):
+        """The client's BoundedHistoryPlugin, if history was enabled"""
+        for plugin in self.service._client.plugins:
+            if isinstance(plugin, BoundedHistoryPlugin):
+                return plugin
+
+    def _metrics(self, operation):
+        """CallMetrics for a request, None unless instrumented"""
+        return CallMetrics(operation) if self.instruments else None
+
+    def _measure(self, metrics, function, *args):
+        """Make a call timed on `metrics`, then hand them to instruments"""
+        try:
+            response = function(*args)
+        except Exception as e:
+            metrics.error = e
+            raise
+        else:
+            metrics.count(response)
+            return response
+        finally:
+            metrics.finish()
+            for instrument in self.instruments:
+                try:
+                    instrument(metrics)
+                except Exception:
+                    _logger.exception('Instrument %r failed', instrument)
+
+    def _ingress(self, operation, response, metrics=None):
+        """
+        Hand the envelope of a response to the client plugins, as zeep
+        does, which means reading it whole
+        """
+        if metrics is None:
+            content = response.content
+        else:
+            with metrics.phase('download'):
+                content = response.content
+                metrics.response_bytes = len(content)
+        try:
+            envelope = etree.fromstring(
+                content, etree.XMLParser(resolve_entities=False))
+        except etree.XMLSyntaxError:
+            # Not a SOAP response, ResponseLines raises on its status
+            return
+        apply_ingress(
+            self.service._client, envelope, response.headers,
+            self.service._binding.get(operation))
+
+    def _result(
+            self, operation, response, result, streamed=False,
+            metrics=None):
+        if result is None:
+            return response
+        # zeep's ingress plugins are skipped along with process_reply
+        client = self.service._client
+        if _needs_envelopes(client.plugins):
+            self._ingress(operation, response, metrics)
+            streamed = False
+        else:
+            for plugin in client.plugins:
+                plugin.ingress(None, response.headers, operation)
+        if metrics is None:
+            lines = ResponseLines.from_response(response, streamed)
+            return (
+                BatchResult.from_lines(lines) if result == 'batch'
+                else lines)
+        if streamed and result == 'batch':
+            # Read it all first, to time download and parse apart
+            with metrics.phase('download'):
+                metrics.response_bytes = len(response.content)
+            streamed = False
+        lines = ResponseLines.from_response(response, streamed)
+        if result == 'lines':
+            return lines
+        with metrics.phase('parse'):
+            return BatchResult.from_lines(lines)
+
+    def _measured_call(self, operation, headers, body, result, metrics):
+        """The steps of a zeep call, each one timed on `metrics`"""
+        client = self.service._client
+        binding = self.service._binding
+        options = self.service._binding_options
+        with metrics.phase('serialization'):
+            envelope, http_headers = binding._create(
+                operation, (headers, body), {}, client=client,
+                options=options)
+            message = etree_to_string(envelope)
+        response = _post(
+            client, options['address'], message, http_headers, metrics)
+        if result is not None:
+            return self._result(operation, response, result, metrics=metrics)
+        with metrics.phase('parse'):
+            return binding.process_reply(
+                client, binding.get(operation), response)
+
+    def _call(self, operation, headers, body, result=None, metrics=None):
+        if result not in _RESULTS:
+            raise ValueError('Unknown result kind: %r' % (result,))
         _logger.debug(body)
-        response_ = self.service.SuministroLRFacturasRecibidas(
-            headers, body)
+        if metrics is None:
+            metrics = self._metrics(operation)
+        if metrics is not None:
+            return self._measure(
+                metrics, self._measured_call, operation, headers, body,
+                result, metrics)
+        if result is None:
+            response_ = getattr(self.service, operation)(headers, body)
+        else:
+            with self.service._client.settings(raw_response=True):
+                response_ = getattr(self.service, operation)(headers, body)
         _logger.debug(response_)
-        return response_
+        return self._result(operation, response_, result)
 
-    def cancel(self, headers, invoices, mapper=None):
-        body = (
-            [mapper.build_delete_request(i) for i in invoices]
+    def _stream(
+            self, operation, headers, invoices, mapper, method,
+            result=None, metrics=None, chunked=False):
+        if result not in _RESULTS:
+            raise ValueError('Unknown result kind: %r' % (result,))
+        records = (
+            (getattr(mapper, method)(i) for i in invoices)
             if mapper
             else invoices
         )
-        _logger.debug(body)
-        response_ = self.service.AnulacionLRFacturasRecibidas(
-            headers, body)
-        _logger.debug(response_)
-        return response_
+        if metrics is None:
+            metrics = self._metrics(operation)
+        if metrics is None:
+            return self._post_stream(
+                operation, headers, records, result, chunked=chunked)
+        return self._measure(
+            metrics, self._post_stream, operation, headers,
+            metrics.timed(records, 'mapping', count=True), result, metrics,
+            chunked)
 
-    def query(self, headers, year=None, period=None):
-        filter_ = build_query_filter(year=year, period=period)
-        _logger.debug(filter_)
-        response_ = self.service.ConsultaLRFacturasRecibidas(
-            headers, filter_)
-        _logger.debug(response_)
-        return response_
+    def _post_stream(
+            self, operation, headers, records, result, metrics=None,
+            chunked=False):
+        response_ = post_envelope(
+            self.service, operation, headers, records, chunked=chunked,
+            raw_response=result is not None, metrics=metrics)
+        return self._result(
+            operation, response_, result, streamed=True, metrics=metrics)
+
+    def _send(self, operation, headers, records, stream, result, metrics=None):
+        if stream:
+            return self._stream(
+                operation, headers, records, None, None, result, metrics,
+                stream == 'chunked')
+        return self._call(operation, headers, records, result, metrics)
+
+    def _retrying(
+            self, operation, headers, invoices, mapper, method, stream,
+            result):
+        # Attempts need the records again, map them once
+        metrics = [self._metrics(operation)]
+        records = list(_build_body(invoices, mapper, method, metrics[0]))
+
+        def send():
+            # The mapping is reported along with the first attempt
+            return self._send(
+                operation, headers, records, stream, result,
+                metrics.pop() if metrics else None)
+
+        response, attempts = self.retry.call(send)
+        return records, response, attempts
+
+    def _resend_duplicated(self, headers, records, response, stream, result):
+        """
+        A retried A0 may have been recorded by an attempt whose response
+        was lost, in which case AEAT rejects its lines as duplicated. Send
+        those again as A1 and merge their outcome into the response.
+        """
+        if result == 'lines':
+            # Its lines can only be read once, by the caller
+            return response
+        batch = (
+            response if result == 'batch'
+            else BatchResult.from_response(response))
+        keys = set(line.key for line in batch.with_error(DUPLICATED))
+        if not keys:
+            return response
+        _logger.info('Sending %d duplicated lines again as A1', len(keys))
+        resent, _ = self.retry.call(
+            self._send, self._submit_operation,
+            dict(headers, TipoComunicacion='A1'),
+            [r for r in records if record_key(r) in keys], stream, result)
+        if result == 'batch':
+            return batch.merge(resent)
+        return _merge_response(response, resent)
+
+    def submit(
+            self, headers, invoices, mapper=None, stream=False, result=None):
+        """
+        With `stream`, the request is written straight to XML while the
+        invoices are mapped, one at a time, instead of being built by zeep
+        from the whole list of mapped dicts. It is spooled, to disk past
+        a few megabytes, to be sent with its length, unless
+        `stream='chunked'`: it is then sent as it is written, with
+        chunked transfer encoding. Plugins reading envelopes, like
+        history, still get it as a tree, which is then parsed back from
+        the written XML, so it is never chunked with them.
+
+        With `result='lines'` the response is not processed by zeep but
+        returned as a pyAEATsii.results.ResponseLines, yielding the outcome
+        of each invoice as it is parsed. `result='batch'` reads them all
+        into a pyAEATsii.results.BatchResult. Plugins reading envelopes
+        still get the response as a tree, so it is then read whole
+        before its lines are.
+
+        When the service has a retry policy, failed calls are retried
+        with the invoices mapped once beforehand. If an A0 submission only
+        succeeded after retrying, lines rejected as duplicated are sent
+        again as A1, unless `result='lines'`.
+        """
+        if self.retry is not None:
+            records, response, attempts = self._retrying(
+                self._submit_operation, headers, invoices, mapper,
+                'build_submit_request', stream, result)
+            if attempts > 1 and headers.get('TipoComunicacion') == 'A0':
+                response = self._resend_duplicated(
+                    headers, records, response, stream, result)
+            return response
+        metrics = self._metrics(self._submit_operation)
+        if stream:
+            return self._stream(
+                self._submit_operation, headers, invoices, mapper,
+                'build_submit_request', result, metrics, stream == 'chunked')
+        body = _build_body(
+            invoices, mapper, 'build_submit_request', metrics)
+        return self._call(
+            self._submit_operation, headers, body, result, metrics)
+
+    def resubmit_rejected(
+            self, headers, invoices, response, mapper=None, rounds=1,
+            codes=TRANSIENT_ERRORS, stream=False):
+        """
+        Send again the lines of a submission of `invoices` that were
+        rejected with a transient error (see
+        pyAEATsii.results.TRANSIENT_ERRORS), rather than the whole batch.
+        Lines rejected for any other reason are left as they are.
+
+        `response` is the submission's zeep response or BatchResult. The
+        lines still failing with a transient error are sent again up to
+        `rounds` times, reusing their mapped records. Return a BatchResult
+        with the final outcome of every invoice.
+        """
+        batch = (
+            response if isinstance(response, BatchResult)
+            else BatchResult.from_response(response))
+        pending = _rejected_records(batch, invoices, mapper, codes)
+        for round_ in range(rounds):
+            if not pending:
+                break
+            _logger.info(
+                'Sending %d rejected lines again (round %d)',
+                len(pending), round_ + 1)
+            resent = self.submit(
+                headers, list(pending.values()), stream=stream,
+                result='batch')
+            batch.merge(resent)
+            retryable = set(line.key for line in resent.retryable(codes))
+            pending = OrderedDict(
+                (key, record) for key, record in pending.items()
+                if key in retryable)
+        return batch
+
+    def cancel(
+            self, headers, invoices, mapper=None, stream=False, result=None):
+        if self.retry is not None:
+            return self._retrying(
+                self._cancel_operation, headers, invoices, mapper,
+                'build_delete_request', stream, result)[1]
+        metrics = self._metrics(self._cancel_operation)
+        if stream:
+            return self._stream(
+                self._cancel_operation, headers, invoices, mapper,
+                'build_delete_request', result, metrics, stream == 'chunked')
+        body = _build_body(
+            invoices, mapper, 'build_delete_request', metrics)
+        return self._call(
+            self._cancel_operation, headers, body, result, metrics)
+
+    def query(self, headers, year=None, period=None, result=None, **filters):
+        """
+        Query the invoices of a period. Further filters (invoice_id,
+        counterpart, presentation_date...) are those of
+        pyAEATsii.mapping.build_query_filter.
+
+        `result` works as in submit, with the state of each invoice read
+        from its record.
+        """
+        filter_ = build_query_filter(year=year, period=period, **filters)
+        if self.retry is not None:
+            return self.retry.call(
+                self._call, self._query_operation, headers, filter_,
+                result)[0]
+        return self._call(self._query_operation, headers, filter_, result)
+
+    def query_iter(
+            self, headers, year=None, period=None, prefetch=False,
+            **filters):
+        """
+        Yield the records of a query one by one, following ClavePaginacion
+        through every page. Only the page being consumed is kept in
+        memory, plus the next one when `prefetch` is set, which requests
+        it in the background as soon as its key is known.
+        """
+        def fetch(key):
+            return self.query(
+                headers, year, period, pagination_key=key, **filters)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            response = fetch(None)
+            while True:
+                records = response[self._query_records] or []
+                more = response['IndicadorPaginacion'] == 'S'
+                response = None
+                next_ = None
+                if records and more:
+                    next_ = _pagination_key(records[-1])
+                    if executor:
+                        next_ = executor.submit(fetch, next_)
+                for record in records:
+                    yield record
+                if next_ is None:
+                    return
+                records = None
+                response = next_.result() if executor else fetch(next_)
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    def submit_batches(
+            self, headers, invoices, mapper=None,
+            batch_size=MAX_BATCH_SIZE, stream=False, result=None,
+            pool=None):
+        """
+        Submit any iterable of invoices in sequential requests of at most
+        `batch_size` records and return the list of responses, one per
+        batch. Each batch is only mapped right before being sent.
+
+        With a pyAEATsii.parallel.ParallelMapper `pool`, invoices are
+        mapped by its workers instead of `mapper`, the next batch being
+        prepared while the current one is sent.
+        """
+        batches, mapper = _batches(
+            invoices, mapper, 'build_submit_request', batch_size, pool)
+        return [
+            self.submit(headers, batch, mapper, stream, result)
+            for batch in batches
+        ]
+
+    def cancel_batches(
+            self, headers, invoices, mapper=None,
+            batch_size=MAX_BATCH_SIZE, stream=False, result=None,
+            pool=None):
+        """
+        Cancel any iterable of invoices in sequential requests of at most
+        `batch_size` records and return the list of responses, one per
+        batch. `pool` works as in submit_batches.
+        """
+        batches, mapper = _batches(
+            invoices, mapper, 'build_delete_request', batch_size, pool)
+        return [
+            self.cancel(headers, batch, mapper, stream, result)
+            for batch in batches
+        ]
+
+    def submit_journaled(
+            self, headers, invoices, journal, mapper=None,
+            batch_size=MAX_BATCH_SIZE, stream=False):
+        """
+        Submit through a pyAEATsii.journal.SubmissionJournal: invoices
+        are mapped and stored as pending, then every record pending or
+        left in flight by an interrupted run is sent. Return the number of
+        records per state.
+        """
+        journal.add(self, (
+            (mapper.build_submit_request(i) for i in invoices)
+            if mapper else invoices), 'submit')
+        return journal.run(self, headers, 'submit', batch_size, stream)
+
+    def cancel_journaled(
+            self, headers, invoices, journal, mapper=None,
+            batch_size=MAX_BATCH_SIZE, stream=False):
+        """Like submit_journaled, for cancellations"""
+        journal.add(self, (
+            (mapper.build_delete_request(i) for i in invoices)
+            if mapper else invoices), 'cancel')
+        return journal.run(self, headers, 'cancel', batch_size, stream)
+
+    def submit_changed(
+            self, headers, invoices, index, mapper=None,
+            batch_size=MAX_BATCH_SIZE, stream=False):
+        """
+        Submit only the invoices whose mapped record is new or differs
+        from the last one accepted, according to a
+        pyAEATsii.changes.ChangeIndex: new ones as A0 and changed ones as
+        A1. New lines AEAT rejects as duplicated, i.e. recorded before the
+        index was, are sent again as A1. The index is updated with every
+        accepted record.
+
+        Return a BatchResult merging the outcome of the lines sent, and
+        the number of unchanged invoices left out.
+        """
+        records = (
+            (mapper.build_submit_request(i) for i in invoices)
+            if mapper else invoices)
+        batch = BatchResult(None, None, [])
+        counts = [0, 0, 0]
+
+        def send(comm_kind, records):
+            response = self.submit(
+                dict(headers, TipoComunicacion=comm_kind), records,
+                stream=stream, result='batch')
+            index.update(self, records, response)
+            batch.merge(response)
+            return response
+
+        # Records are read and sent a batch at a time
+        for new, changed, unchanged in index.split(self, records, batch_size):
+            if new:
+                keys = set(
+                    line.key
+                    for line in send('A0', new).with_error(DUPLICATED))
+                if keys:
+                    send('A1', [r for r in new if record_key(r) in keys])
+            if changed:
+                send('A1', changed)
+            counts[0] += len(new)
+            counts[1] += len(changed)
+            counts[2] += unchanged
+        _logger.info(
+            '%d new, %d changed and %d unchanged invoices', *counts)
+        return batch, counts[2]
+
+    def submit_many(
+            self, headers, invoices, mapper=None,
+            batch_size=MAX_BATCH_SIZE, max_workers=4, stream=False,
+            result=None, pool=None):
+        """
+        Like submit_batches, but sends up to `max_workers` batches at the
+        same time over the bound client's connection pool. Responses are
+        returned in input order.
+        """
+        batches, mapper = _batches(
+            invoices, mapper, 'build_submit_request', batch_size, pool)
+        return _map_ordered(
+            lambda batch: self.submit(
+                headers, batch, mapper, stream, result),
+            batches, max_workers)
+
+    def cancel_many(
+            self, headers, invoices, mapper=None,
+            batch_size=MAX_BATCH_SIZE, max_workers=4, stream=False,
+            result=None, pool=None):
+        """
+        Like cancel_batches, but sends up to `max_workers` batches at the
+        same time over the bound client's connection pool. Responses are
+        returned in input order.
+        """
+        batches, mapper = _batches(
+            invoices, mapper, 'build_delete_request', batch_size, pool)
+        return _map_ordered(
+            lambda batch: self.cancel(
+                headers, batch, mapper, stream, result),
+            batches, max_workers)
+
+
+class _IssuedInvoiceService(_InvoiceService):
+    _submit_operation = 'SuministroLRFacturasEmitidas'
+    _cancel_operation = 'AnulacionLRFacturasEmitidas'
+    _query_operation = 'ConsultaLRFacturasEmitidas'
+    _query_records = 'RegistroRespuestaConsultaLRFacturasEmitidas'
+
+
+class _RecievedInvoiceService(_InvoiceService):
+    _submit_operation = 'SuministroLRFacturasRecibidas'
+    _cancel_operation = 'AnulacionLRFacturasRecibidas'
+    _query_operation = 'ConsultaLRFacturasRecibidas'
+    _query_records = 'RegistroRespuestaConsultaLRFacturasRecibidas'
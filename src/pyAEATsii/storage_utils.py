@@ -0,0 +1,22 @@
+
+__all__ = [
+    'json_default',
+    'text_key',
+]
+
+from datetime import date
+from decimal import Decimal
+
+
+def json_default(value):
+    """JSON of the values of mapped records that json does not know"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def text_key(key):
+    """A record key with every part as text, as stored by SQLite"""
+    return tuple(u'%s' % part for part in key)
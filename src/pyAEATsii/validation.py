@@ -0,0 +1,281 @@
+
+__all__ = [
+    'Validator',
+    'InvoiceError',
+    'load_schema',
+    'RULES',
+    'SCHEMA_URL',
+]
+
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from lxml import etree
+
+from .mapping import RECTIFIED_KINDS, get_headers
+from .results import record_key
+from .serializer import iter_envelope
+
+SCHEMA_URL = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/'
+    'internet/dep/aplicaciones/es/aeat/ssii_1_1_bis/fact/ws/'
+    'SuministroLR.xsd')
+
+# Issued invoice kinds that must identify the counterpart, and those
+# that must not
+COUNTERPART_KINDS = frozenset({'F1', 'F3', 'R1', 'R2', 'R3', 'R4'})
+NO_COUNTERPART_KINDS = frozenset({'F2', 'F4', 'R5'})
+
+_PERIODS = frozenset(
+    ['%02d' % month for month in range(1, 13)]
+    + ['1T', '2T', '3T', '4T', '0A'])
+_YEAR = re.compile(r'^\d{4}$')
+_PREFIX = re.compile(r'^[^:/\[]+:')
+
+
+class InvoiceError(object):
+    """
+    A problem found in the record at `index` of a batch: `key` is its
+    (issuer id, serial number, issue date) and `path` the slash separated
+    path of the field within the record.
+    """
+    __slots__ = ('index', 'key', 'path', 'message')
+
+    def __init__(self, index, key, path, message):
+        self.index = index
+        self.key = key
+        self.path = path
+        self.message = message
+
+    def __repr__(self):
+        return '<InvoiceError #%d %s: %s>' % (
+            self.index, self.path, self.message)
+
+
+class _CacheResolver(etree.Resolver):
+
+    def __init__(self, cache):
+        super(_CacheResolver, self).__init__()
+        self.cache = cache
+
+    def resolve(self, url, pubid, context):
+        content = self.cache.get(url, expired=True)
+        if content is not None:
+            return self.resolve_string(content, context, base_url=url)
+
+
+def load_schema(cache, url=SCHEMA_URL):
+    """
+    Load the SuministroLR XSD, and the schemas it imports, from a
+    pyAEATsii.cache.WsdlCache filled by binding the services
+    """
+    content = cache.get(url, expired=True)
+    if content is None:
+        raise IOError('%s is not cached' % url)
+    parser = etree.XMLParser(no_network=True)
+    parser.resolvers.add(_CacheResolver(cache))
+    return etree.XMLSchema(etree.fromstring(content, parser, base_url=url))
+
+
+def _invoice(record):
+    for name in ('FacturaExpedida', 'FacturaRecibida'):
+        if record.get(name) is not None:
+            return name, record[name]
+    return None, None
+
+
+def check_period(record):
+    period = record.get('PeriodoLiquidacion') or {}
+    if not _YEAR.match(str(period.get('Ejercicio'))):
+        yield 'PeriodoLiquidacion/Ejercicio', 'Must be a four digit year'
+    if period.get('Periodo') not in _PERIODS:
+        yield (
+            'PeriodoLiquidacion/Periodo',
+            'Must be a zero filled month, a quarter (1T-4T) or 0A')
+
+
+def check_invoice_id(record):
+    invoice_id = record.get('IDFactura') or {}
+    serial_number = invoice_id.get('NumSerieFacturaEmisor')
+    if serial_number is None or serial_number == '':
+        yield 'IDFactura/NumSerieFacturaEmisor', 'Required'
+    elif len(u'%s' % serial_number) > 60:
+        yield 'IDFactura/NumSerieFacturaEmisor', 'Longer than 60 characters'
+    try:
+        datetime.strptime(
+            invoice_id.get('FechaExpedicionFacturaEmisor') or '', '%d-%m-%Y')
+    except (TypeError, ValueError):
+        yield (
+            'IDFactura/FechaExpedicionFacturaEmisor',
+            'Must be a DD-MM-YYYY date')
+
+
+def check_counterpart(record):
+    name, invoice = _invoice(record)
+    if invoice is None:
+        return
+    kind = invoice.get('TipoFactura')
+    counterpart = invoice.get('Contraparte')
+    if name == 'FacturaRecibida' or kind in COUNTERPART_KINDS:
+        if not counterpart:
+            yield name + '/Contraparte', 'Required for %s invoices' % kind
+        elif not (counterpart.get('NIF') or counterpart.get('IDOtro')):
+            yield name + '/Contraparte', 'Needs either NIF or IDOtro'
+    elif counterpart and kind in NO_COUNTERPART_KINDS:
+        yield name + '/Contraparte', 'Not allowed for %s invoices' % kind
+
+
+def check_rectification(record):
+    name, invoice = _invoice(record)
+    if invoice is None:
+        return
+    kind = invoice.get('TipoFactura')
+    rectification = invoice.get('TipoRectificativa')
+    if kind in RECTIFIED_KINDS:
+        if rectification not in ('S', 'I'):
+            yield (
+                name + '/TipoRectificativa',
+                'Must be S or I for %s invoices' % kind)
+        elif rectification == 'S':
+            amounts = invoice.get('ImporteRectificacion') or {}
+            for field in ('BaseRectificada', 'CuotaRectificada'):
+                if amounts.get(field) is None:
+                    yield (
+                        name + '/ImporteRectificacion/' + field,
+                        'Required for substitutive rectifications')
+    elif rectification is not None:
+        yield (
+            name + '/TipoRectificativa',
+            'Only allowed for rectifying invoices')
+
+
+def check_description(record):
+    name, invoice = _invoice(record)
+    if invoice is None:
+        return
+    description = invoice.get('DescripcionOperacion')
+    if not description:
+        yield name + '/DescripcionOperacion', 'Required'
+    elif len(description) > 500:
+        yield (
+            name + '/DescripcionOperacion', 'Longer than 500 characters')
+
+
+# Business rules: functions taking a mapped submit record and yielding
+# (path, message) for every problem found
+RULES = (
+    check_period,
+    check_invoice_id,
+    check_counterpart,
+    check_rectification,
+    check_description,
+)
+
+
+def _record_path(path):
+    """Path of an XSD error relative to the record element"""
+    steps = [_PREFIX.sub('', step) for step in path.split('/')]
+    for i, step in enumerate(steps):
+        if step.startswith('Registro'):
+            return '/'.join(steps[i + 1:])
+    return '/'.join(steps)
+
+
+class Validator(object):
+    """
+    Check mapped submit records before sending them: against the
+    business `rules` and, when a WSDL `cache` holding the SII schemas is
+    given, against SuministroLR.xsd as written by the streaming
+    serializer for `operation`.
+
+    Validators may be used from several threads, each one loading its
+    own copy of the schema.
+    """
+
+    def __init__(
+            self, rules=RULES, cache=None, schema_url=SCHEMA_URL,
+            operation='SuministroLRFacturasEmitidas', headers=None):
+        self.rules = tuple(rules)
+        self.cache = cache
+        self.schema_url = schema_url
+        self.operation = operation
+        self.headers = headers or get_headers(
+            name='VALIDATION', vat='00000000T', comm_kind='A0')
+        self._local = threading.local()
+
+    @property
+    def schema(self):
+        if self.cache is None:
+            return None
+        schema = getattr(self._local, 'schema', None)
+        if schema is None:
+            schema = self._local.schema = load_schema(
+                self.cache, self.schema_url)
+        return schema
+
+    def _xsd_errors(self, schema, record):
+        envelope = etree.fromstring(b''.join(
+            iter_envelope(self.operation, self.headers, [record])))
+        request = envelope[0][0]
+        if schema.validate(request):
+            return
+        for entry in schema.error_log:
+            yield _record_path(entry.path), entry.message
+
+    def validate(self, record, index=0):
+        """List the InvoiceErrors of a record"""
+        errors = []
+        for rule in self.rules:
+            errors.extend(rule(record))
+        schema = self.schema
+        if schema is not None:
+            errors.extend(self._xsd_errors(schema, record))
+        if not errors:
+            return []
+        try:
+            key = record_key(record)
+        except (KeyError, TypeError, AttributeError):
+            key = None
+        return [
+            InvoiceError(index, key, path, message)
+            for path, message in errors
+        ]
+
+    def _validate_chunk(self, chunk):
+        start, records = chunk
+        errors = []
+        for index, record in enumerate(records, start):
+            errors.extend(self.validate(record, index))
+        return errors
+
+    def validate_all(self, records, max_workers=1, chunk_size=500):
+        """
+        List the InvoiceErrors of a batch of records, in record order,
+        checking chunks of `chunk_size` records on `max_workers` threads
+        """
+        records = list(records)
+        chunks = [
+            (start, records[start:start + chunk_size])
+            for start in range(0, len(records), chunk_size)
+        ]
+        if max_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(self._validate_chunk, chunks))
+        else:
+            results = [self._validate_chunk(chunk) for chunk in chunks]
+        return [error for errors in results for error in errors]
+
+    def partition(self, records, max_workers=1, chunk_size=500):
+        """
+        Split a batch of records into the list of valid ones, ready to be
+        submitted, and the InvoiceErrors of the rest
+        """
+        records = list(records)
+        errors = self.validate_all(records, max_workers, chunk_size)
+        invalid = set(error.index for error in errors)
+        return [
+            record for index, record in enumerate(records)
+            if index not in invalid
+        ], errors
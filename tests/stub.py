@@ -0,0 +1,82 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from pyAEATsii import cache
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+BASE = 'https://sii.invalid/ws/'
+
+
+def seeded_cache(path, base=BASE, **kwargs):
+    wsdl_cache = cache.WsdlCache(str(path), **kwargs)
+    for name in os.listdir(DATA):
+        with open(os.path.join(DATA, name), 'rb') as fh:
+            wsdl_cache.add(base + name, fh.read())
+    return wsdl_cache
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _read_body(self):
+        if 'chunked' not in self.headers.get('Transfer-Encoding', ''):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if not size:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.requests.append((dict(self.headers), body))
+        status, headers, content = self.server.respond(self, body)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def serve(respond):
+    """
+    Run a local HTTP endpoint answering every POST with
+    respond(handler, body) -> (status, headers, content). Yields the
+    server, whose `url` and `requests` (headers, body) are recorded.
+    """
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    server.respond = respond
+    server.requests = []
+    server.url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def echo_response(value):
+    return (
+        '<soap-env:Envelope '
+        'xmlns:soap-env="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<soap-env:Body>'
+        '<EchoResponse xmlns="urn:pyAEATsii:stub"><Value>%s</Value>'
+        '</EchoResponse>'
+        '</soap-env:Body></soap-env:Envelope>' % value
+    ).encode('utf-8')
@@ -0,0 +1,92 @@
+import sys
+
+import pytest
+
+if sys.version_info < (3, 8):
+    pytest.skip(
+        'asyncio bindings need Python 3.8+', allow_module_level=True)
+
+import asyncio  # noqa: E402
+from unittest import mock  # noqa: E402
+
+aio = pytest.importorskip('pyAEATsii.aio')
+
+
+class _Mapper(object):
+
+    def build_submit_request(self, invoice):
+        return {'submit': invoice}
+
+    def build_delete_request(self, invoice):
+        return {'delete': invoice}
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_issued_submit():
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas = mock.AsyncMock(
+        return_value='RESPONSE')
+    svc = aio._AsyncIssuedInvoiceService(proxy)
+    assert _run(svc.submit('HEADERS', [1], _Mapper())) == 'RESPONSE'
+    proxy.SuministroLRFacturasEmitidas.assert_awaited_once_with(
+        'HEADERS', [{'submit': 1}])
+
+
+def test_async_recieved_cancel_and_query():
+    proxy = mock.MagicMock()
+    proxy.AnulacionLRFacturasRecibidas = mock.AsyncMock()
+    proxy.ConsultaLRFacturasRecibidas = mock.AsyncMock()
+    svc = aio._AsyncRecievedInvoiceService(proxy)
+    _run(svc.cancel('HEADERS', [1], _Mapper()))
+    _run(svc.query('HEADERS', year=2017, period=1))
+    proxy.AnulacionLRFacturasRecibidas.assert_awaited_once_with(
+        'HEADERS', [{'delete': 1}])
+    headers, filter_ = proxy.ConsultaLRFacturasRecibidas.await_args[0]
+    assert filter_['PeriodoLiquidacion']['Periodo'] == '01'
+
+
+def test_async_close():
+    proxy = mock.MagicMock()
+    proxy._client.transport.aclose = mock.AsyncMock()
+    svc = aio._AsyncIssuedInvoiceService(proxy)
+    assert _run(svc.__aenter__()) is svc
+    _run(svc.__aexit__(None, None, None))
+    proxy._client.transport.aclose.assert_awaited_once_with()
+
+
+def test_async_query_iter():
+    pages = [
+        {
+            'IndicadorPaginacion': 'S',
+            'RegistroRespuestaConsultaLRFacturasEmitidas': [{'IDFactura': {
+                'IDEmisorFactura': {'NIF': '00000010X'},
+                'NumSerieFacturaEmisor': '1',
+                'FechaExpedicionFacturaEmisor': '31-12-2017',
+            }}],
+        },
+        {
+            'IndicadorPaginacion': 'N',
+            'RegistroRespuestaConsultaLRFacturasEmitidas': None,
+        },
+    ]
+    proxy = mock.MagicMock()
+    proxy.ConsultaLRFacturasEmitidas = mock.AsyncMock(side_effect=pages)
+    svc = aio._AsyncIssuedInvoiceService(proxy)
+    records = svc.query_iter('HEADERS', 2017, 12)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(records.__anext__()) == pages[0][
+            'RegistroRespuestaConsultaLRFacturasEmitidas'][0]
+        with pytest.raises(StopAsyncIteration):
+            loop.run_until_complete(records.__anext__())
+    finally:
+        loop.close()
+    headers, filter_ = proxy.ConsultaLRFacturasEmitidas.await_args[0]
+    assert filter_['ClavePaginacion']['NumSerieFacturaEmisor'] == '1'
@@ -0,0 +1,60 @@
+import os
+import time
+
+import pytest
+
+from pyAEATsii import cache
+from pyAEATsii import service
+
+from .stub import BASE, seeded_cache
+
+
+def test_cache_roundtrip(tmpdir):
+    wsdl_cache = cache.WsdlCache(str(tmpdir), version='1.1')
+    assert wsdl_cache.get(BASE + 'stub.wsdl') is None
+    wsdl_cache.add(BASE + 'stub.wsdl', b'<wsdl/>')
+    assert wsdl_cache.get(BASE + 'stub.wsdl') == b'<wsdl/>'
+    assert os.listdir(str(tmpdir)) == ['1.1']
+
+
+def test_cache_timeout(tmpdir):
+    wsdl_cache = cache.WsdlCache(str(tmpdir), timeout=60)
+    wsdl_cache.add(BASE + 'stub.wsdl', b'<wsdl/>')
+    old = time.time() - 120
+    os.utime(wsdl_cache._filename(BASE + 'stub.wsdl'), (old, old))
+    assert wsdl_cache.get(BASE + 'stub.wsdl') is None
+    assert wsdl_cache.get(BASE + 'stub.wsdl', expired=True) == b'<wsdl/>'
+
+
+def test_cache_add_replaces(tmpdir, monkeypatch):
+    wsdl_cache = cache.WsdlCache(str(tmpdir), version='1.1')
+    wsdl_cache.add(BASE + 'stub.wsdl', b'<wsdl/>')
+    wsdl_cache.add(BASE + 'stub.wsdl', b'<wsdl></wsdl>')
+    assert wsdl_cache.get(BASE + 'stub.wsdl') == b'<wsdl></wsdl>'
+
+    def fail(src, dst):
+        raise OSError(13, 'Permission denied')
+
+    # Failed writes leave neither the entry changed nor temporary files
+    monkeypatch.setattr(cache, '_replace', fail)
+    with pytest.raises(OSError):
+        wsdl_cache.add(BASE + 'stub.wsdl', b'<new/>')
+    with pytest.raises(TypeError):
+        wsdl_cache.add(BASE + 'other.wsdl', None)
+    assert wsdl_cache.get(BASE + 'stub.wsdl') == b'<wsdl></wsdl>'
+    assert os.listdir(wsdl_cache.path) == [
+        os.path.basename(wsdl_cache._filename(BASE + 'stub.wsdl'))]
+
+
+def test_offline_transport_misses(tmpdir):
+    transport = cache.OfflineTransport(cache=cache.WsdlCache(str(tmpdir)))
+    with pytest.raises(IOError):
+        transport.load(BASE + 'stub.wsdl')
+
+
+def test_offline_binding(tmpdir):
+    wsdl_cache = seeded_cache(tmpdir, timeout=0)
+    client = service._get_client(
+        BASE + 'stub.wsdl', 'crt', 'key',
+        cache=wsdl_cache, offline=True)
+    assert client.bind('siiService', 'Stub').Echo
@@ -0,0 +1,103 @@
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import changes
+from pyAEATsii import service
+from pyAEATsii.results import BatchResult, InvoiceResult
+
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+
+class _FakeAEAT(object):
+
+    def __init__(self, recorded=()):
+        self.recorded = set(recorded)
+        self.sent = []
+
+    def submit(self, headers, records, stream=False, result=None):
+        comm_kind = headers['TipoComunicacion']
+        serials = [r['IDFactura']['NumSerieFacturaEmisor'] for r in records]
+        self.sent.append((comm_kind, serials))
+        lines = []
+        for serial in serials:
+            if comm_kind == 'A0' and serial in self.recorded:
+                line = ('Incorrecto', 3000)
+            else:
+                self.recorded.add(serial)
+                line = ('Correcto', None)
+            lines.append(InvoiceResult(
+                '00000010X', str(serial), '31-12-2017', *line))
+        return BatchResult('Correcto', None, lines)
+
+
+def _service(aeat):
+    svc = service._IssuedInvoiceService(mock.MagicMock())
+    svc.submit = aeat.submit
+    return svc
+
+
+def _invoices(count, **values):
+    return [
+        dict(_INVOICE, serial_number=n, **values) for n in range(count)]
+
+
+def test_payload_hash():
+    record = IssuedTestInvoiceMapper().build_submit_request(_INVOICE)
+    reordered = dict(reversed(list(record.items())))
+    digest = changes.payload_hash(record)
+    assert changes.payload_hash(reordered) == digest
+    record['FacturaExpedida']['ImporteTotal'] += 1
+    assert changes.payload_hash(record) != digest
+
+
+def test_submit_changed(tmpdir):
+    aeat = _FakeAEAT()
+    svc = _service(aeat)
+    mapper = IssuedTestInvoiceMapper()
+    headers = {'TipoComunicacion': 'A0'}
+    with changes.ChangeIndex(str(tmpdir.join('index.db'))) as index:
+        batch, unchanged = svc.submit_changed(
+            headers, _invoices(4), index, mapper, batch_size=3)
+        assert unchanged == 0
+        assert len(batch.accepted) == 4
+        assert aeat.sent == [('A0', [0, 1, 2]), ('A0', [3])]
+
+        del aeat.sent[:]
+        invoices = _invoices(5)
+        invoices[1]['total_amount'] = 1000
+        batch, unchanged = svc.submit_changed(
+            headers, invoices, index, mapper)
+        assert unchanged == 3
+        assert [line.serial_number for line in batch] == ['4', '1']
+        assert aeat.sent == [('A0', [4]), ('A1', [1])]
+
+
+def test_submit_changed_already_recorded(tmpdir):
+    aeat = _FakeAEAT(recorded=[1])
+    svc = _service(aeat)
+    with changes.ChangeIndex(str(tmpdir.join('index.db'))) as index:
+        batch, unchanged = svc.submit_changed(
+            {'TipoComunicacion': 'A0'}, _invoices(3), index,
+            IssuedTestInvoiceMapper())
+        assert aeat.sent == [('A0', [0, 1, 2]), ('A1', [1])]
+        assert batch.status == 'Correcto'
+        assert list(index.split(svc, [
+            IssuedTestInvoiceMapper().build_submit_request(i)
+            for i in _invoices(3)])) == [([], [], 3)]
+
+
+def test_split_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr(changes, '_LOOKUP_SIZE', 2)
+    svc = _service(_FakeAEAT())
+    mapper = IssuedTestInvoiceMapper()
+    with changes.ChangeIndex(str(tmpdir.join('index.db'))) as index:
+        svc.submit_changed(
+            {'TipoComunicacion': 'A0'}, _invoices(3), index, mapper)
+        records = [mapper.build_submit_request(i) for i in _invoices(5)]
+        records[2]['FacturaExpedida']['ImporteTotal'] += 1
+        chunks = list(index.split(svc, iter(records), chunk_size=2))
+    assert [(len(n), len(c), u) for n, c, u in chunks] == [
+        (0, 0, 2), (1, 1, 0), (1, 0, 0)]
+    assert chunks[1][1] == [records[2]]
@@ -0,0 +1,122 @@
+from datetime import date
+
+import pytest
+
+from pyAEATsii import columnar
+
+from .test_compiled import (
+    IssuedTestInvoiceMapper, RecievedTestInvoiceMapper, _INVOICE, _VARIANTS)
+
+_TAX_FIELDS = (
+    'tax_rate',
+    'tax_base',
+    'tax_amount',
+    'tax_equivalence_surcharge_rate',
+    'tax_equivalence_surcharge_amount',
+    'tax_reagyp_rate',
+    'tax_reagyp_amount',
+)
+
+
+def _invoices():
+    return [
+        dict(_INVOICE, serial_number=n, **variant)
+        for n, variant in enumerate(_VARIANTS)]
+
+
+def _columns(invoices):
+    names = set(name for invoice in invoices for name in invoice)
+    names.discard('taxes')
+    columns = dict(
+        (name, [invoice.get(name) for invoice in invoices])
+        for name in names)
+    columns['counterpart_id'] = columns['counterpart_nif']
+    columns['sent_date'] = columns['move_date']
+    taxes = [tax for invoice in invoices for tax in invoice['taxes']]
+    for name in _TAX_FIELDS:
+        columns[name] = [tax.get(name) for tax in taxes]
+    columns['tax_offsets'] = [0]
+    for invoice in invoices:
+        columns['tax_offsets'].append(
+            columns['tax_offsets'][-1] + len(invoice['taxes']))
+    return columns
+
+
+_MAPPERS = [
+    (IssuedTestInvoiceMapper, columnar.IssuedColumnarMapper),
+    (RecievedTestInvoiceMapper, columnar.RecievedColumnarMapper),
+]
+
+
+@pytest.mark.parametrize('mapper_class, columnar_class', _MAPPERS)
+def test_columnar_output(mapper_class, columnar_class):
+    invoices = _invoices()
+    mapper = mapper_class()
+    columns = _columns(invoices)
+    assert columnar_class().build_submit_requests(columns) == [
+        mapper.build_submit_request(invoice) for invoice in invoices]
+    assert columnar_class().build_delete_requests(columns) == [
+        mapper.build_delete_request(invoice) for invoice in invoices]
+
+
+@pytest.mark.parametrize('mapper_class, columnar_class', _MAPPERS)
+def test_numpy_columns(mapper_class, columnar_class):
+    numpy = pytest.importorskip('numpy')
+    invoices = _invoices()
+    columns = _columns(invoices)
+    expected = columnar_class().build_submit_requests(columns)
+    for name in ('issue_date', 'move_date', 'sent_date'):
+        columns[name] = numpy.array(columns[name], dtype='datetime64[D]')
+    for name in ('year', 'period', 'tax_offsets'):
+        columns[name] = numpy.array(columns[name])
+    for name in ('tax_rate', 'tax_equivalence_surcharge_rate'):
+        columns[name] = numpy.array(columns[name], dtype=float)
+    columns['tax_reagyp_rate'] = numpy.array(
+        columns['tax_reagyp_rate'], dtype=object)
+    assert numpy.isnan(columns['tax_equivalence_surcharge_rate']).any()
+    assert columnar_class().build_submit_requests(columns) == expected
+
+
+def test_missing_columns():
+    columns = _columns([dict(_INVOICE, taxes=[])])
+    del columns['tax_offsets']
+    del columns['total_amount']
+    record, = columnar.IssuedColumnarMapper().build_submit_requests(columns)
+    issued = record['FacturaExpedida']
+    assert issued['ImporteTotal'] is None
+    assert 'Sujeta' not in issued['TipoDesglose']['DesgloseFactura']
+
+    columns['specialkey_or_trascendence'] = ['14']
+    del columns['sent_date']
+    record, = columnar.RecievedColumnarMapper().build_submit_requests(
+        columns)
+    assert record['FacturaRecibida']['FechaRegContable'] == (
+        date.today().strftime('%d-%m-%Y'))
+
+
+def test_required_columns():
+    columns = _columns(_invoices())
+    del columns['serial_number']
+    del columns['description']
+    with pytest.raises(ValueError) as excinfo:
+        columnar.IssuedColumnarMapper().build_submit_requests(columns)
+    assert 'description, serial_number' in str(excinfo.value)
+    with pytest.raises(ValueError):
+        columnar.IssuedColumnarMapper().build_delete_requests(columns)
+
+    # Deleting only needs the invoice ids
+    columns = _columns(_invoices())
+    del columns['description']
+    assert len(columnar.RecievedColumnarMapper().build_delete_requests(
+        columns)) == len(_invoices())
+
+
+def test_column_lengths():
+    columns = _columns(_invoices())
+    columns['year'] = columns['year'][1:]
+    with pytest.raises(ValueError):
+        columnar.IssuedColumnarMapper().build_submit_requests(columns)
+
+
+def test_no_invoices():
+    assert columnar.IssuedColumnarMapper().build_submit_requests({}) == []
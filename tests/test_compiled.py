@@ -0,0 +1,129 @@
+from datetime import date
+from operator import methodcaller
+
+import pytest
+
+from pyAEATsii import mapping
+from pyAEATsii.compiled import compile_mapper
+
+from .mapping import BaseTestInvoiceMapper
+
+
+class IssuedTestInvoiceMapper(
+        mapping.IssuedInvoiceMapper,
+        BaseTestInvoiceMapper
+):
+    pass
+
+
+class RecievedTestInvoiceMapper(
+        mapping.RecievedInvoiceMapper,
+        BaseTestInvoiceMapper
+):
+    move_date = methodcaller('get', 'move_date')
+    deductible_amount = methodcaller('get', 'deductible_amount')
+    tax_reagyp_rate = methodcaller('get', 'tax_reagyp_rate')
+    tax_reagyp_amount = methodcaller('get', 'tax_reagyp_amount')
+    sent_date = methodcaller('get', 'move_date')
+
+
+_INVOICE = {
+    'year': 2017,
+    'period': 5,
+    'nif': '00000010X',
+    'serial_number': 1,
+    'final_serial_number': 'FINAL_ID',
+    'issue_date': date(year=2017, month=12, day=31),
+    'move_date': date(year=2018, month=1, day=2),
+    'deductible_amount': 21,
+    'invoice_kind': 'F1',
+    'rectified_invoice_kind': 'S',
+    'rectified_base': 100,
+    'rectified_amount': 21,
+    'specialkey_or_trascendence': '01',
+    'description': 'My Description',
+    'not_exempt_kind': 'S1',
+    'counterpart_name': 'Counterpart',
+    'counterpart_nif': '00000011B',
+    'counterpart_id_type': '01',
+    'counterpart_country': 'ES',
+    'untaxed_amount': 110,
+    'total_amount': 132,
+    'taxes': [{
+        'tax_rate': .21,
+        'tax_base': 100,
+        'tax_amount': 21,
+        'tax_equivalence_surcharge_rate': .052,
+        'tax_equivalence_surcharge_amount': 5.2,
+        'tax_reagyp_rate': .12,
+        'tax_reagyp_amount': 12,
+    }, {
+        'tax_rate': .10,
+        'tax_base': 10,
+        'tax_amount': 1,
+    }],
+}
+
+_FOREIGN = {
+    'counterpart_nif': 'LT00000011B',
+    'counterpart_id_type': '02',
+    'counterpart_country': 'LT',
+}
+
+_VARIANTS = [
+    {},
+    {'invoice_kind': 'F2'},
+    {'invoice_kind': 'F4'},
+    {'invoice_kind': 'R1'},
+    {'invoice_kind': 'R1', 'rectified_invoice_kind': 'I'},
+    {'invoice_kind': 'R5', 'rectified_invoice_kind': 'I',
+     'taxes': [{'tax_rate': .21, 'tax_base': 0, 'tax_amount': 0}]},
+    {'not_exempt_kind': 'S2', 'taxes': []},
+    dict(_FOREIGN, not_exempt_kind='S2', taxes=[]),
+    dict(_FOREIGN, not_exempt_kind=None, exempt_kind='E5'),
+    dict(_FOREIGN, specialkey_or_trascendence='02'),
+    {'not_exempt_kind': None, 'exempt_kind': 'E1'},
+    {'not_exempt_kind': None, 'exempt_kind': None,
+     'specialkey_or_trascendence': '08'},
+    {'specialkey_or_trascendence': '08'},
+    {'specialkey_or_trascendence': '14'},
+    {'specialkey_or_trascendence': '16'},
+    {'counterpart_nif': 'N0000001B'},
+    {'taxes': []},
+]
+
+
+@pytest.mark.parametrize('variant', _VARIANTS)
+@pytest.mark.parametrize('mapper_class', [
+    IssuedTestInvoiceMapper, RecievedTestInvoiceMapper,
+])
+def test_compiled_mapper_output(mapper_class, variant):
+    invoice = dict(_INVOICE, **variant)
+    mapper = mapper_class()
+    compiled = compile_mapper(mapper)
+    assert compiled is not mapper
+    assert (
+        compiled.build_submit_request(invoice)
+        == mapper.build_submit_request(invoice))
+    assert (
+        compiled.build_delete_request(invoice)
+        == mapper.build_delete_request(invoice))
+
+
+def test_compiled_mapper_failures():
+    invoice = dict(
+        _INVOICE, invoice_kind='R5', not_exempt_kind=None, exempt_kind=None)
+    mapper = IssuedTestInvoiceMapper()
+    with pytest.raises(KeyError):
+        mapper.build_submit_request(invoice)
+    with pytest.raises(KeyError):
+        compile_mapper(mapper).build_submit_request(invoice)
+
+
+def test_compile_overridden_mapper():
+    class CustomMapper(IssuedTestInvoiceMapper):
+        def build_taxes(self, tax):
+            return {}
+
+    mapper = CustomMapper()
+    assert compile_mapper(mapper) is mapper
@@ -0,0 +1,238 @@
+import pytest
+from zeep.exceptions import Fault
+
+from pyAEATsii import mapping
+from pyAEATsii import mockserver
+from pyAEATsii import service
+from pyAEATsii.instrumentation import (
+    PHASES, CallMetrics, MetricsCollector, OpenTelemetryInstrument)
+from pyAEATsii.retry import RetryPolicy
+
+from .stub import seeded_cache
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+
+def _headers(comm_kind='A0'):
+    return mapping.get_headers(
+        name='Company', vat='00000010X', comm_kind=comm_kind)
+
+
+def _invoices(count):
+    return [
+        dict(_INVOICE, serial_number=n) for n in range(1, count + 1)]
+
+
+@pytest.fixture
+def wsdl_cache(tmpdir):
+    return seeded_cache(tmpdir, base=service.wsdl_base)
+
+
+def _bind(wsdl_cache, server, instruments, **kwargs):
+    return service.bind_issued_invoices_service(
+        None, None, cache=wsdl_cache, offline=True, address=server.url,
+        instruments=instruments, **kwargs)
+
+
+@pytest.mark.parametrize('stream, result', [
+    (False, None),
+    (False, 'batch'),
+    (True, None),
+    (True, 'batch'),
+])
+def test_submit_phases(wsdl_cache, stream, result):
+    calls = []
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(wsdl_cache, server, [calls.append])
+        svc.submit(_headers(), _invoices(2), IssuedTestInvoiceMapper())
+        svc.submit(
+            _headers(), _invoices(3), IssuedTestInvoiceMapper(),
+            stream=stream, result=result)
+
+    assert len(calls) == 2
+    metrics = calls[1]
+    assert metrics.operation == 'SuministroLRFacturasEmitidas'
+    assert sorted(metrics.phases) == sorted(PHASES)
+    assert all(seconds >= 0 for seconds in metrics.phases.values())
+    assert metrics.records == 3
+    assert metrics.request_bytes > 0
+    assert metrics.response_bytes > 0
+    assert metrics.http_status == 200
+    assert metrics.error is None
+    if result == 'batch':
+        assert metrics.status == 'ParcialmenteCorrecto'
+        assert metrics.outcomes == {'Correcto': 1, 'Incorrecto': 2}
+
+
+def test_streamed_lines(wsdl_cache):
+    calls = []
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(wsdl_cache, server, [calls.append])
+        lines = svc.submit(
+            _headers(), _invoices(2), IssuedTestInvoiceMapper(),
+            stream=True, result='lines')
+        assert len(list(lines)) == 2
+
+    metrics, = calls
+    # The lines are read by the caller, after the call is over
+    assert 'parse' not in metrics.phases
+    assert metrics.response_bytes is None
+    assert metrics.records == 2
+    assert metrics.outcomes == {}
+
+
+def test_query(wsdl_cache):
+    collector = MetricsCollector()
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(wsdl_cache, server, [collector])
+        svc.submit(_headers(), _invoices(3), IssuedTestInvoiceMapper())
+        svc.query(_headers(None), 2017, 5, result='batch')
+
+    summary = collector.summary()
+    query = summary['ConsultaLRFacturasEmitidas']
+    assert query['calls'] == 1
+    assert query['records'] == 0
+    assert query['outcomes'] == {'Correcta': 3}
+    assert 'mapping' not in query['phases']
+    assert summary['SuministroLRFacturasEmitidas']['records'] == 3
+
+    collector.reset()
+    assert collector.summary() == {}
+
+
+def test_fault(wsdl_cache):
+    calls = []
+    with mockserver.MockSIIServer(max_batch_size=1) as server:
+        svc = _bind(wsdl_cache, server, [calls.append])
+        with pytest.raises(Fault):
+            svc.submit(_headers(), _invoices(2), IssuedTestInvoiceMapper())
+
+    metrics, = calls
+    assert isinstance(metrics.error, Fault)
+    assert metrics.http_status == 500
+    assert metrics.status is None
+    assert not metrics._stack
+
+
+def test_retry_reports_every_attempt(wsdl_cache):
+    collector = MetricsCollector()
+    retry = RetryPolicy(max_attempts=3, backoff=0, sleep=lambda seconds: None)
+    with mockserver.MockSIIServer(unavailable_rate=1, seed=0) as server:
+        svc = _bind(wsdl_cache, server, [collector], retry=retry)
+        with pytest.raises(Exception):
+            svc.submit(_headers(), _invoices(2), IssuedTestInvoiceMapper())
+
+    totals = collector.summary()['SuministroLRFacturasEmitidas']
+    assert totals['calls'] == totals['errors'] == 3
+    # Invoices are mapped once, before the first attempt
+    assert totals['records'] == 2
+
+
+def test_failing_instrument(wsdl_cache):
+    def broken(metrics):
+        raise RuntimeError
+
+    calls = []
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(wsdl_cache, server, [broken, calls.append])
+        batch = svc.submit(
+            _headers(), _invoices(1), IssuedTestInvoiceMapper(),
+            result='batch')
+    assert batch.status == 'Correcto'
+    assert len(calls) == 1
+
+
+def test_uninstrumented(wsdl_cache):
+    with mockserver.MockSIIServer() as server:
+        svc = service.bind_issued_invoices_service(
+            None, None, cache=wsdl_cache, offline=True, address=server.url)
+        assert svc.instruments == ()
+        assert svc._metrics('SuministroLRFacturasEmitidas') is None
+        batch = svc.submit(
+            _headers(), _invoices(1), IssuedTestInvoiceMapper(),
+            result='batch')
+    assert batch.status == 'Correcto'
+
+
+def test_nested_phases(monkeypatch):
+    now = [0]
+    monkeypatch.setattr(
+        'pyAEATsii.instrumentation._clock', lambda: now[0])
+    metrics = CallMetrics('op')
+    metrics.enter('serialization')
+    now[0] = 1
+    for _ in metrics.timed(range(2), 'mapping', count=True):
+        now[0] += 1
+    now[0] += 2
+    metrics.switch('server_wait')
+    now[0] += 4
+    metrics.finish()
+    # Mapping is the innermost phase, nothing is counted twice
+    assert metrics.phases == {
+        'serialization': 5, 'mapping': 0, 'server_wait': 4}
+    assert metrics.records == 2
+    assert metrics.duration == 9
+
+
+class _Instrument(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.values = []
+
+    def record(self, value, attributes):
+        self.values.append((value, attributes))
+
+    add = record
+
+
+class _Meter(object):
+
+    def __init__(self):
+        self.instruments = {}
+
+    def create_histogram(self, name, unit='', description=''):
+        return self.instruments.setdefault(name, _Instrument(name))
+
+    create_counter = create_histogram
+
+
+def test_opentelemetry():
+    meter = _Meter()
+    instrument = OpenTelemetryInstrument(meter)
+    metrics = CallMetrics('op')
+    metrics.phases = {'transport': .5}
+    metrics.records = 2
+    metrics.request_bytes = 100
+    metrics.outcomes = {'Correcto': 2}
+    instrument(metrics)
+
+    values = dict(
+        (name, i.values) for name, i in meter.instruments.items())
+    assert values['pyaeatsii.phase.duration'] == [
+        (.5, {'operation': 'op', 'phase': 'transport'})]
+    assert values['pyaeatsii.request.size'] == [(100, {'operation': 'op'})]
+    assert values['pyaeatsii.response.size'] == []
+    assert values['pyaeatsii.batch.records'] == [(2, {'operation': 'op'})]
+    assert values['pyaeatsii.lines'] == [
+        (2, {'operation': 'op', 'status': 'Correcto'})]
+    assert values['pyaeatsii.calls'] == [
+        (1, {'operation': 'op', 'outcome': 'ok'})]
+
+
+def test_prometheus():
+    prometheus_client = pytest.importorskip('prometheus_client')
+    from pyAEATsii.instrumentation import PrometheusInstrument
+
+    registry = prometheus_client.CollectorRegistry()
+    instrument = PrometheusInstrument(registry=registry)
+    metrics = CallMetrics('op')
+    metrics.phases = {'transport': .5}
+    metrics.error = Fault('Codigo[4102]')
+    instrument(metrics)
+
+    assert registry.get_sample_value(
+        'pyaeatsii_phase_seconds_sum',
+        {'operation': 'op', 'phase': 'transport'}) == .5
+    assert registry.get_sample_value(
+        'pyaeatsii_calls_total',
+        {'operation': 'op', 'outcome': 'error'}) == 1
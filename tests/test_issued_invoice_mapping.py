@@ -1,4 +1,5 @@
 
+from collections import Counter
 from datetime import date
 
 try:
@@ -422,3 +423,59 @@ def test_issued_invoice_issued_by_party_mapping():
         request_['FacturaExpedida']['EmitidaPorTercerosODestinatario']
         == 'S'
     )
+
+
+_INVOICE = {
+    'year': 2017,
+    'period': 5,
+    'nif': '00000010X',
+    'serial_number': 1,
+    'issue_date': date(year=2017, month=12, day=31),
+    'invoice_kind': 'F1',
+    'specialkey_or_trascendence': '01',
+    'description': 'My Description',
+    'not_exempt_kind': 'S2',
+    'counterpart_name': 'Counterpart',
+    'counterpart_nif': 'LT00000011B',
+    'counterpart_id_type': '02',
+    'counterpart_country': 'LT',
+    'untaxed_amount': 100,
+    'total_amount': 100,
+    'taxes': [],
+}
+
+
+def _counting_mapper(calls, **attrs):
+    def counted(name):
+        def accessor(invoice):
+            calls[name] += 1
+            return invoice.get(name)
+        return staticmethod(accessor)
+
+    for name in ('not_exempt_kind', 'specialkey_or_trascendence',
+                 'counterpart_id_type'):
+        attrs[name] = counted(name)
+    return type('CountingMapper', (IssuedTestInvoiceMapper,), attrs)()
+
+
+def test_accessors_called_once():
+    calls = Counter()
+    mapper = _counting_mapper(
+        calls,
+        _memoized_accessors=IssuedTestInvoiceMapper._invoice_accessors)
+    request_ = mapper.build_submit_request(_INVOICE)
+    assert request_ == \
+        IssuedTestInvoiceMapper().build_submit_request(_INVOICE)
+    assert calls['not_exempt_kind'] == 1
+    assert calls['specialkey_or_trascendence'] == 1
+    assert calls['counterpart_id_type'] == 1
+    assert '_scope_invoice' not in mapper.__dict__
+
+
+def test_accessors_not_memoized_by_default():
+    calls = Counter()
+    mapper = _counting_mapper(calls)
+    assert mapper._scoped(_INVOICE) is mapper
+    assert mapper.build_submit_request(_INVOICE) == \
+        IssuedTestInvoiceMapper().build_submit_request(_INVOICE)
+    assert calls['specialkey_or_trascendence'] > 1
@@ -0,0 +1,174 @@
+import pytest
+import requests
+from zeep.exceptions import Fault
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import journal
+from pyAEATsii import mapping
+from pyAEATsii import mockserver
+from pyAEATsii import service
+from pyAEATsii.results import BatchResult, InvoiceResult
+
+from .stub import seeded_cache
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+
+def _record(serial):
+    return {
+        'PeriodoLiquidacion': {'Ejercicio': 2017, 'Periodo': '12'},
+        'IDFactura': {
+            'IDEmisorFactura': {'NIF': 'B12345678'},
+            'NumSerieFacturaEmisor': serial,
+            'FechaExpedicionFacturaEmisor': '31-12-2017',
+        },
+    }
+
+
+class _FakeAEAT(object):
+    """Records every invoice it is sent, failing as told"""
+    _submit_operation = 'SuministroLRFacturasEmitidas'
+    _cancel_operation = 'AnulacionLRFacturasEmitidas'
+
+    def __init__(self):
+        self.recorded = set()
+        self.sent = []
+        self.lose_response = None
+        self.fault = None
+        self.reject = set()
+
+    def submit(self, headers, records, stream=False, result=None):
+        assert result == 'batch'
+        serials = [r['IDFactura']['NumSerieFacturaEmisor'] for r in records]
+        self.sent.append(serials)
+        if self.fault == len(self.sent):
+            raise Fault('Codigo[4102].El XML no cumple con el esquema')
+        lines = []
+        for serial in serials:
+            if serial in self.recorded:
+                line = ('Incorrecto', 3000)
+            elif serial in self.reject:
+                line = ('Incorrecto', 1100)
+            else:
+                self.recorded.add(serial)
+                line = ('Correcto', None)
+            lines.append(InvoiceResult(
+                'B12345678', serial, '31-12-2017', *line))
+        if self.lose_response == len(self.sent):
+            raise requests.ConnectionError()
+        return BatchResult('ParcialmenteCorrecto', 'CSV', lines)
+
+
+def test_run(tmpdir):
+    aeat = _FakeAEAT()
+    aeat.reject.add(3)
+    with journal.SubmissionJournal(str(tmpdir.join('j.db'))) as journal_:
+        assert journal_.add(aeat, (_record(n) for n in range(5)),
+                            chunk_size=2) == 5
+        assert journal_.counts(aeat) == {'pending': 5}
+        counts = journal_.run(aeat, {'TipoComunicacion': 'A0'}, batch_size=2)
+        assert counts == {'accepted': 4, 'rejected': 1}
+        assert list(journal_.records(aeat, journal.REJECTED)) == [
+            (('B12345678', '3', '31-12-2017'), 1100, None, None)]
+    assert sorted(sum(aeat.sent, [])) == [0, 1, 2, 3, 4]
+
+
+def test_resume_after_crash(tmpdir):
+    path = str(tmpdir.join('j.db'))
+    aeat = _FakeAEAT()
+    # AEAT records the second batch but its response is lost
+    aeat.lose_response = 2
+    with journal.SubmissionJournal(path) as journal_:
+        journal_.add(aeat, [_record(n) for n in range(6)])
+        with pytest.raises(requests.ConnectionError):
+            journal_.run(aeat, {'TipoComunicacion': 'A0'}, batch_size=2)
+        assert journal_.counts(aeat) == {
+            'accepted': 2, 'in_flight': 2, 'pending': 2}
+
+    aeat.lose_response = None
+    with journal.SubmissionJournal(path) as journal_:
+        # Adding the whole run again does not resend anything
+        journal_.add(aeat, [_record(n) for n in range(6)])
+        counts = journal_.run(aeat, {'TipoComunicacion': 'A0'}, batch_size=2)
+    assert counts == {'accepted': 6}
+    # Only the batch left in flight was sent twice, and accepted as
+    # duplicated, before the pending one
+    assert aeat.sent == [[0, 1], [2, 3], [2, 3], [4, 5]]
+
+
+def test_fault_rejects_batch(tmpdir):
+    aeat = _FakeAEAT()
+    aeat.fault = 1
+    with journal.SubmissionJournal(str(tmpdir.join('j.db'))) as journal_:
+        journal_.add(aeat, [_record(n) for n in range(4)])
+        counts = journal_.run(aeat, {}, batch_size=2)
+        assert counts == {'accepted': 2, 'rejected': 2}
+        assert [r[:2] for r in journal_.records(aeat, journal.REJECTED)] == [
+            (('B12345678', '0', '31-12-2017'), 4102),
+            (('B12345678', '1', '31-12-2017'), 4102)]
+        # Nothing is left to resend
+        assert journal_.run(aeat, {}, batch_size=2) == counts
+    assert aeat.sent == [[0, 1], [2, 3]]
+
+
+def test_rejected_are_sent_again_once_added(tmpdir):
+    aeat = _FakeAEAT()
+    aeat.reject.add(1)
+    with journal.SubmissionJournal(str(tmpdir.join('j.db'))) as journal_:
+        journal_.add(aeat, [_record(0), _record(1)])
+        journal_.run(aeat, {})
+        aeat.reject.clear()
+        journal_.add(aeat, [_record(0), _record(1)])
+        assert journal_.run(aeat, {}) == {'accepted': 2}
+    assert aeat.sent == [[0, 1], [1]]
+
+
+def test_submit_journaled(tmpdir):
+    aeat = _FakeAEAT()
+    svc = service._IssuedInvoiceService(mock.MagicMock())
+    svc.submit = aeat.submit
+    mapper = mock.Mock()
+    mapper.build_submit_request.side_effect = _record
+    with journal.SubmissionJournal(str(tmpdir.join('j.db'))) as journal_:
+        counts = svc.submit_journaled({}, range(3), journal_, mapper)
+    assert counts == {'accepted': 3}
+    assert aeat.sent == [[0, 1, 2]]
+
+
+def test_resume_cancel_against_mock_server(tmpdir):
+    path = str(tmpdir.join('j.db'))
+    headers = mapping.get_headers(
+        name='Company', vat='00000010X', comm_kind='A0')
+    mapper = IssuedTestInvoiceMapper()
+    invoices = [dict(_INVOICE, serial_number=n) for n in range(1, 5)]
+    with mockserver.MockSIIServer() as server:
+        svc = service.bind_issued_invoices_service(
+            None, None, cache=seeded_cache(tmpdir, base=service.wsdl_base),
+            offline=True, address=server.url)
+        svc.submit(headers, invoices, mapper)
+        cancel = svc.cancel
+
+        def lose_response(*args, **kwargs):
+            # AEAT cancels the batch but its response is lost
+            cancel(*args, **kwargs)
+            raise requests.ConnectionError()
+
+        with journal.SubmissionJournal(path) as journal_:
+            journal_.add(
+                svc, [mapper.build_delete_request(i) for i in invoices],
+                kind='cancel')
+            svc.cancel = lose_response
+            with pytest.raises(requests.ConnectionError):
+                journal_.run(svc, headers, kind='cancel', batch_size=2)
+            assert journal_.counts(svc, kind='cancel') == {
+                'in_flight': 2, 'pending': 2}
+
+        del svc.cancel
+        with journal.SubmissionJournal(path) as journal_:
+            counts = journal_.run(svc, headers, kind='cancel', batch_size=2)
+        assert server.invoices() == []
+    # The resent batch is not found, as it was cancelled
+    assert counts == {'accepted': 4}
@@ -0,0 +1,225 @@
+import pytest
+from zeep.exceptions import Fault, TransportError
+
+from pyAEATsii import mapping
+from pyAEATsii import mockserver
+from pyAEATsii import service
+from pyAEATsii.plugins import BoundedHistoryPlugin, PayloadFilePlugin
+from pyAEATsii.retry import RetryPolicy
+from pyAEATsii.validation import load_schema
+
+from .stub import seeded_cache
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+_KEY = ('00000010X', '1', '31-12-2017')
+
+
+def _headers(comm_kind='A0'):
+    return mapping.get_headers(
+        name='Company', vat='00000010X', comm_kind=comm_kind)
+
+
+def _invoices(count, **values):
+    return [
+        dict(_INVOICE, serial_number=n, **values)
+        for n in range(1, count + 1)]
+
+
+@pytest.fixture
+def wsdl_cache(tmpdir):
+    return seeded_cache(tmpdir, base=service.wsdl_base)
+
+
+def _bind(wsdl_cache, server, **kwargs):
+    return service.bind_issued_invoices_service(
+        None, None, cache=wsdl_cache, offline=True, address=server.url,
+        **kwargs)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_submit_and_cancel(wsdl_cache, stream):
+    mapper = IssuedTestInvoiceMapper()
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(wsdl_cache, server)
+        batch = svc.submit(
+            _headers(), _invoices(3), mapper, stream=stream, result='batch')
+        assert batch.status == 'Correcto'
+        assert batch.csv.startswith('MOCK')
+        assert [line.status for line in batch] == ['Correcto'] * 3
+        assert server.invoices()[0] == _KEY
+
+        batch = svc.submit(
+            _headers(), _invoices(2), mapper, stream=stream, result='batch')
+        assert batch.status == 'Incorrecto'
+        assert batch.error_codes() == {3000: 2}
+        assert all(line.duplicated for line in batch)
+
+        batch = svc.submit(
+            _headers('A1'), _invoices(4), mapper, stream=stream,
+            result='batch')
+        assert batch.status == 'ParcialmenteCorrecto'
+        assert batch.error_codes() == {mockserver.NOT_FOUND: 1}
+
+        batch = svc.cancel(
+            _headers(None), _invoices(4)[2:], mapper, stream=stream,
+            result='batch')
+        assert [(line.serial_number, line.error_code) for line in batch] == [
+            ('3', None), ('4', mockserver.NOT_FOUND)]
+        assert len(server.invoices()) == 2
+        assert server.calls == {'submit': 3, 'cancel': 1}
+
+
+def test_query_pages(wsdl_cache):
+    mapper = IssuedTestInvoiceMapper()
+    with mockserver.MockSIIServer(page_size=2) as server:
+        svc = _bind(wsdl_cache, server)
+        svc.submit(_headers(), _invoices(3), mapper, stream=True)
+        svc.submit(
+            _headers(), [dict(_INVOICE, serial_number=9, period=6)], mapper,
+            stream=True)
+
+        lines = svc.query(_headers(None), 2017, 5, result='lines')
+        assert [line.serial_number for line in lines] == ['1', '2']
+        assert (lines.status, lines.more) == ('ConDatos', True)
+        assert lines.csv is None
+
+        lines = svc.query(
+            _headers(None), 2017, 5, result='lines', pagination_key={
+                'IDEmisorFactura': {'NIF': '00000010X'},
+                'NumSerieFacturaEmisor': '2',
+                'FechaExpedicionFacturaEmisor': '31-12-2017',
+            })
+        assert [line.key for line in lines] == [
+            ('00000010X', '3', '31-12-2017')]
+        assert lines.more is False
+        assert lines.status == 'ConDatos'
+
+        lines = svc.query(_headers(None), 2017, 7, result='lines')
+        assert list(lines) == []
+        assert lines.status == 'SinDatos'
+
+
+def test_streamed_envelopes_reach_plugins(wsdl_cache, tmpdir):
+    history = BoundedHistoryPlugin(maxlen=10)
+    payloads = PayloadFilePlugin(str(tmpdir.join('payloads.log')))
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(
+            wsdl_cache, server, history=history, plugins=[payloads])
+        svc.submit(
+            _headers(), _invoices(2), IssuedTestInvoiceMapper(),
+            stream=True)
+    payloads.close()
+
+    assert [entry['kind'] for entry in history.entries] == [
+        'sent', 'received']
+    assert history.last_sent.count(b'RegistroLRFacturasEmitidas>') == 4
+    assert history.entries[0]['operation'] == 'SuministroLRFacturasEmitidas'
+    logged = tmpdir.join('payloads.log').read()
+    assert ' sent SuministroLRFacturasEmitidas' in logged
+    assert ' received SuministroLRFacturasEmitidas' in logged
+
+
+@pytest.mark.parametrize('stream, result', [
+    (False, 'batch'),
+    (True, 'batch'),
+    (True, 'lines'),
+])
+def test_read_results_reach_plugins(wsdl_cache, tmpdir, stream, result):
+    history = BoundedHistoryPlugin(maxlen=10)
+    payloads = PayloadFilePlugin(str(tmpdir.join('payloads.log')))
+    with mockserver.MockSIIServer() as server:
+        svc = _bind(
+            wsdl_cache, server, history=history, plugins=[payloads])
+        for count in (1, 2):
+            lines = svc.submit(
+                _headers(), _invoices(count), IssuedTestInvoiceMapper(),
+                stream=stream, result=result)
+            assert len(list(lines)) == count
+    payloads.close()
+
+    assert [entry['kind'] for entry in history.entries] == [
+        'sent', 'received'] * 2
+    # The last response is that of the second call, with a duplicate
+    assert history.last_received.count(b'RespuestaLinea>') == 4
+    assert b'RegistroDuplicado' in history.last_received
+    logged = tmpdir.join('payloads.log').read()
+    assert logged.count(' received SuministroLRFacturasEmitidas') == 2
+
+
+def test_batch_size_limit(wsdl_cache):
+    mapper = IssuedTestInvoiceMapper()
+    with mockserver.MockSIIServer(max_batch_size=2) as server:
+        svc = _bind(wsdl_cache, server)
+        with pytest.raises(Fault) as info:
+            svc.submit(
+                _headers(), _invoices(3), mapper, stream=True,
+                result='batch')
+        assert 'Codigo[4102]' in info.value.message
+        assert info.value.code.endswith('Client')
+        responses = svc.submit_batches(
+            _headers(), _invoices(3), mapper, batch_size=2, stream=True,
+            result='batch')
+        assert [len(batch) for batch in responses] == [2, 1]
+        assert server.calls == {'fault': 1, 'submit': 2}
+
+
+def test_schema_validation(wsdl_cache):
+    record = IssuedTestInvoiceMapper().build_submit_request(_INVOICE)
+    record['FacturaExpedida']['TipoFactura'] = 'X9'
+    with mockserver.MockSIIServer(schema=load_schema(
+            wsdl_cache, service.wsdl_base + 'SuministroLR.xsd')) as server:
+        svc = _bind(wsdl_cache, server)
+        with pytest.raises(Fault) as info:
+            svc.submit(_headers(), [record], stream=True, result='batch')
+        assert 'TipoFactura' in info.value.message
+
+
+def test_partial_rejection(wsdl_cache):
+    mapper = IssuedTestInvoiceMapper()
+    with mockserver.MockSIIServer(reject_rate=0.5, seed=1) as server:
+        svc = _bind(wsdl_cache, server)
+        invoices = _invoices(20)
+        batch = svc.submit(
+            _headers(), invoices, mapper, stream=True, result='batch')
+        assert batch.status == 'ParcialmenteCorrecto'
+        rejected = len(batch.rejected)
+        assert 0 < rejected < 20
+        assert len(server.invoices()) == 20 - rejected
+
+        server.reject_rate = 0
+        batch = svc.resubmit_rejected(_headers(), invoices, batch, mapper)
+        assert batch.status == 'Correcto'
+        assert len(server.invoices()) == 20
+
+
+def test_injected_failures_are_retried(wsdl_cache):
+    mapper = IssuedTestInvoiceMapper()
+    server = mockserver.MockSIIServer(unavailable_rate=1)
+    with server:
+        svc = _bind(wsdl_cache, server)
+        with pytest.raises(TransportError):
+            svc.submit(_headers(), _invoices(1), mapper, result='batch')
+
+        server.unavailable_rate = 0
+        server.fault_rate = 0.5
+        server._random.seed(3)
+        svc = _bind(wsdl_cache, server, retry=RetryPolicy(
+            max_attempts=10, sleep=lambda delay: None))
+        responses = svc.submit_many(
+            _headers(), _invoices(40), mapper, batch_size=4, max_workers=4,
+            stream=True, result='batch')
+        assert all(batch.status == 'Correcto' for batch in responses)
+        assert len(server.invoices()) == 40
+        assert server.calls['fault'] > 0
+        assert server.calls['submit'] == 10
+
+
+def test_latency_and_concurrency(wsdl_cache):
+    mapper = IssuedTestInvoiceMapper()
+    with mockserver.MockSIIServer(latency=(0.05, 0.1)) as server:
+        svc = _bind(wsdl_cache, server, pool_maxsize=4)
+        responses = svc.submit_many(
+            _headers(), _invoices(8), mapper, batch_size=1, max_workers=4,
+            stream=True, result='batch')
+        assert len(responses) == 8
+        assert 1 < server.peak_concurrency <= 4
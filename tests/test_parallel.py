@@ -0,0 +1,76 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import parallel
+from pyAEATsii import service
+
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+
+def _invoices(count):
+    return [dict(_INVOICE, serial_number=n) for n in range(count)]
+
+
+class _CountingExecutor(ThreadPoolExecutor):
+
+    def __init__(self):
+        super(_CountingExecutor, self).__init__(max_workers=2)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super(_CountingExecutor, self).submit(*args, **kwargs)
+
+
+def test_spec_is_picklable():
+    spec = parallel.MapperSpec(IssuedTestInvoiceMapper, compiled=True)
+    spec = pickle.loads(pickle.dumps(spec))
+    mapper = spec.build()
+    assert mapper.build_submit_request(_INVOICE) == \
+        IssuedTestInvoiceMapper().build_submit_request(_INVOICE)
+
+
+def test_map_on_processes():
+    invoices = _invoices(25)
+    spec = parallel.MapperSpec(IssuedTestInvoiceMapper)
+    with parallel.ParallelMapper(spec, max_workers=2, chunk_size=4) as pool:
+        records = list(pool.map(invoices))
+        deletes = list(pool.map(invoices, 'build_delete_request'))
+    mapper = IssuedTestInvoiceMapper()
+    assert records == [mapper.build_submit_request(i) for i in invoices]
+    assert deletes == [mapper.build_delete_request(i) for i in invoices]
+
+
+def test_batches_prefetch():
+    executor = _CountingExecutor()
+    pool = parallel.ParallelMapper(
+        parallel.MapperSpec(IssuedTestInvoiceMapper), chunk_size=5,
+        executor=executor)
+    batches = pool.batches(_invoices(100), 10, prefetch=2)
+    first = next(batches)
+    assert len(first) == 10
+    # The chunks of this batch and of the next two have been submitted,
+    # plus the one sent before the last chunk of this batch was collected
+    assert executor.submitted == 7
+    assert [len(batch) for batch in batches] == [10] * 9
+    executor.shutdown()
+
+
+def test_submit_batches_with_pool():
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas.side_effect = \
+        lambda headers, body: [
+            r['IDFactura']['NumSerieFacturaEmisor'] for r in body]
+    svc = service._IssuedInvoiceService(proxy)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pool = parallel.ParallelMapper(
+            parallel.MapperSpec(IssuedTestInvoiceMapper), chunk_size=2,
+            executor=executor)
+        responses = svc.submit_batches(
+            'HEADERS', _invoices(7), batch_size=3, pool=pool)
+    assert responses == [[0, 1, 2], [3, 4, 5], [6]]
@@ -0,0 +1,142 @@
+import logging
+
+from lxml import etree
+from requests import Session
+from zeep import Client
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import plugins
+from pyAEATsii.cache import OfflineTransport
+
+from .stub import BASE, echo_response, seeded_cache, serve
+
+
+def _envelope(text):
+    envelope = etree.Element('Envelope')
+    envelope.text = text
+    return envelope
+
+
+def test_history_keeps_serialized_envelopes():
+    history = plugins.BoundedHistoryPlugin()
+    history.egress(_envelope('request'), {'A': 'B'}, 'Operation', {})
+    history.ingress(_envelope('response'), {}, 'Operation')
+    assert history.last_sent == b'<Envelope>request</Envelope>'
+    assert history.last_received == b'<Envelope>response</Envelope>'
+    assert history.entries[0]['http_headers'] == {'A': 'B'}
+
+
+def test_history_maxlen():
+    history = plugins.BoundedHistoryPlugin(maxlen=1)
+    history.egress(_envelope('request'), {}, 'Operation', {})
+    history.ingress(_envelope('response'), {}, 'Operation')
+    assert history.last_sent is None
+    assert len(history.entries) == 1
+
+
+def test_history_max_bytes():
+    history = plugins.BoundedHistoryPlugin(maxlen=10, max_bytes=40)
+    history.egress(_envelope('request'), {}, 'Operation', {})
+    history.ingress(_envelope('response'), {}, 'Operation')
+    assert [e['kind'] for e in history.entries] == ['received']
+    history.egress(_envelope('x' * 100), {}, 'Operation', {})
+    assert len(history.last_sent) == 40
+    history.clear()
+    assert history.entries == []
+
+
+def test_logging_plugin_is_lazy():
+    plugin = plugins.LoggingPlugin()
+    with mock.patch.object(plugins.etree, 'tostring') as tostring:
+        with mock.patch.object(plugins._logger, 'isEnabledFor') as enabled:
+            enabled.return_value = False
+            plugin.egress(_envelope('request'), {}, 'Operation', {})
+    assert not tostring.called
+
+
+def test_logging_plugin_max_bytes(caplog):
+    plugin = plugins.LoggingPlugin(max_bytes=12, pretty_print=False)
+    with caplog.at_level(logging.DEBUG, logger=plugins.__name__):
+        plugin.ingress(_envelope('response'), {}, 'Operation')
+    assert 'envelope: <Envelope>re...' in caplog.text
+
+
+def test_payload_file_plugin(tmpdir):
+    filename = str(tmpdir.join('payloads.log'))
+    plugin = plugins.PayloadFilePlugin(filename, max_bytes=200)
+    tostring = mock.Mock(wraps=etree.tostring)
+    with mock.patch.object(plugins.etree, 'tostring', tostring):
+        for _ in range(5):
+            plugin.egress(_envelope('request'), {}, 'Submit', {})
+            plugin.ingress(_envelope('response'), {}, 'Submit')
+    plugin.close()
+    # Each envelope is serialized once
+    assert tostring.call_count == 10
+    with open(filename) as fh:
+        content = fh.read()
+    assert 'received Submit\n<Envelope>response</Envelope>\n' in content
+    assert tmpdir.join('payloads.log.1').check()
+    assert all(
+        0 < tmpdir.join(name).size() <= 200
+        for name in ('payloads.log', 'payloads.log.1'))
+
+
+def test_session_id_plugin_hooks():
+    plugin = plugins.SessionIdPlugin()
+    plugin.ingress(None, {
+        'Set-Cookie': 'JSESSIONID=abc; Path=/, other=1; Secure'}, None)
+    headers = {'Cookie': 'JSESSIONID=old; lb=2'}
+    plugin.egress(None, headers, None, {})
+    assert headers['Cookie'] == 'lb=2; JSESSIONID=abc'
+    plugin.reset()
+    headers = {}
+    plugin.egress(None, headers, None, {})
+    assert headers == {}
+
+
+def test_session_id_plugin_jar():
+    session = Session()
+    session.cookies.set('JSESSIONID', 'old', domain='sii.invalid')
+    session.cookies.set('lb', '2', domain='sii.invalid')
+    plugin = plugins.SessionIdPlugin(cookies=session.cookies)
+    plugin.ingress(None, {'Set-Cookie': 'JSESSIONID=abc; Path=/'}, None)
+    headers = {}
+    plugin.egress(None, headers, None, {})
+    assert headers == {}
+    assert sorted((c.name, c.value) for c in session.cookies) == [
+        ('JSESSIONID', 'abc'), ('lb', '2')]
+
+
+def test_session_id_plugin_endpoint(tmpdir):
+    def respond(handler, body):
+        return 200, [
+            ('Content-Type', 'text/xml; charset=utf-8'),
+            ('Set-Cookie', 'JSESSIONID=s%d; Path=/' % len(server.requests)),
+        ], echo_response('ok')
+
+    session = Session()
+    plugin = plugins.SessionIdPlugin(cookies=session.cookies)
+    client = Client(
+        BASE + 'stub.wsdl',
+        transport=OfflineTransport(
+            session=session, cache=seeded_cache(tmpdir)),
+        plugins=[plugin])
+    with serve(respond) as server:
+        # Cookies of the jar, e.g. load balancer affinity, are kept
+        session.cookies.set('BIGipServerpool', '123')
+        proxy = client.create_service(
+            '{urn:pyAEATsii:stub}StubBinding', server.url)
+        for _ in range(3):
+            assert proxy.Echo(Value='x') == 'ok'
+    cookies = [
+        sorted(headers.get('Cookie', '').split('; '))
+        for headers, _ in server.requests]
+    assert cookies == [
+        ['BIGipServerpool=123'],
+        ['BIGipServerpool=123', 'JSESSIONID=s1'],
+        ['BIGipServerpool=123', 'JSESSIONID=s2'],
+    ]
@@ -0,0 +1,45 @@
+from datetime import date
+
+from pyAEATsii import mapping
+
+
+def test_period_filter():
+    filter_ = mapping.build_query_filter(year=2017, period=5)
+    assert filter_ == {
+        'PeriodoLiquidacion': {'Ejercicio': 2017, 'Periodo': '05'},
+    }
+
+
+def test_invoice_filters():
+    filter_ = mapping.build_query_filter(
+        year=2017, period=12,
+        invoice_id={
+            'NumSerieFacturaEmisor': 'A1',
+            'FechaExpedicionFacturaEmisor': date(2017, 12, 31),
+        },
+        counterpart={'NombreRazon': 'Counterpart', 'NIF': '00000011B'},
+        modified_invoice=False,
+        balance_state='2',
+    )
+    assert filter_['IDFactura'] == {
+        'NumSerieFacturaEmisor': 'A1',
+        'FechaExpedicionFacturaEmisor': '31-12-2017',
+    }
+    assert filter_['Contraparte']['NIF'] == '00000011B'
+    assert filter_['FacturaModificada'] == 'N'
+    assert filter_['EstadoCuadre'] == '2'
+    assert 'FechaPresentacion' not in filter_
+
+
+def test_date_range_filters():
+    filter_ = mapping.build_query_filter(
+        year=2017, period=12,
+        presentation_date=(date(2018, 1, 1), date(2018, 1, 31)),
+        balance_date=(date(2018, 2, 1), None),
+    )
+    assert filter_['FechaPresentacion'] == {
+        'Desde': '01-01-2018', 'Hasta': '31-01-2018'}
+    # Open ranges end today, AEAT requires both bounds
+    assert filter_['FechaCuadre'] == {
+        'Desde': '01-02-2018',
+        'Hasta': date.today().strftime('%d-%m-%Y')}
@@ -0,0 +1,56 @@
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+import pytest
+
+from pyAEATsii import registry
+from pyAEATsii import service
+
+from .stub import BASE, seeded_cache
+
+
+def _registry(tmpdir, **kwargs):
+    return registry.ClientRegistry(
+        cache=seeded_cache(tmpdir), offline=True, **kwargs)
+
+
+@pytest.mark.parametrize('takes_documents', [
+    pytest.param(True, marks=pytest.mark.skipif(
+        not service._TAKES_DOCUMENTS, reason='zeep before 4.2')),
+    False,
+])
+def test_document_parsed_once(tmpdir, monkeypatch, takes_documents):
+    # Older zeep parses the document for each client, from the cache
+    monkeypatch.setattr(service, '_TAKES_DOCUMENTS', takes_documents)
+    registry_ = _registry(tmpdir)
+    first = service._get_client(
+        BASE + 'stub.wsdl', 'crt1', 'key1', registry=registry_)
+    second = service._get_client(
+        BASE + 'stub.wsdl', 'crt2', 'key2', registry=registry_)
+    assert (first.wsdl is second.wsdl) == takes_documents
+    assert first.transport.session is not second.transport.session
+    assert first.transport.cache is registry_.cache
+    assert second.bind('siiService', 'Stub').Echo
+
+
+def test_session_per_certificate(tmpdir):
+    registry_ = _registry(tmpdir)
+    session = registry_.session('crt', 'key')
+    assert registry_.session('crt', 'key') is session
+    assert session.cert == ('crt', 'key')
+
+
+def test_session_lru_eviction(tmpdir):
+    registry_ = _registry(tmpdir, max_sessions=2)
+    with mock.patch.object(service, 'Session') as Session:
+        Session.side_effect = lambda: mock.MagicMock()
+        first = registry_.session('crt1', 'key1')
+        second = registry_.session('crt2', 'key2')
+        registry_.session('crt1', 'key1')
+        registry_.session('crt3', 'key3')
+    assert second.close.called
+    assert not first.close.called
+    registry_.close()
+    assert first.close.called
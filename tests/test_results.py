@@ -0,0 +1,259 @@
+from datetime import date
+from io import BytesIO
+
+import pytest
+import requests
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from zeep.exceptions import Fault, TransportError
+
+from pyAEATsii import plugins
+from pyAEATsii import service
+from pyAEATsii.results import BatchResult, InvoiceResult, ResponseLines
+
+from .stub import serve
+
+_RESPONSE_NS = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/'
+    'dep/aplicaciones/es/aeat/ssii/fact/ws/RespuestaSuministro.xsd')
+_INFO_NS = (
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/'
+    'dep/aplicaciones/es/aeat/ssii/fact/ws/SuministroInformacion.xsd')
+
+
+def _envelope(body):
+    return (
+        '<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/"'
+        ' xmlns:siiR="%s" xmlns:sii="%s">'
+        '<env:Body>%s</env:Body></env:Envelope>' % (
+            _RESPONSE_NS, _INFO_NS, body)
+    ).encode('utf-8')
+
+
+def _line(serial, status, error=None, issuer='<sii:NIF>B12345678</sii:NIF>',
+          extra=''):
+    return (
+        '<siiR:RespuestaLinea>'
+        '<siiR:IDFactura>'
+        '<sii:IDEmisorFactura>%s</sii:IDEmisorFactura>'
+        '<sii:NumSerieFacturaEmisor>%s</sii:NumSerieFacturaEmisor>'
+        '<sii:FechaExpedicionFacturaEmisor>31-12-2017'
+        '</sii:FechaExpedicionFacturaEmisor>'
+        '</siiR:IDFactura>'
+        '<siiR:EstadoRegistro>%s</siiR:EstadoRegistro>'
+        '%s%s'
+        '</siiR:RespuestaLinea>' % (
+            issuer, serial, status,
+            '' if error is None else
+            '<siiR:CodigoErrorRegistro>%d</siiR:CodigoErrorRegistro>'
+            '<siiR:DescripcionErrorRegistro>Error %d'
+            '</siiR:DescripcionErrorRegistro>' % (error, error),
+            extra)
+    )
+
+
+def _submit_response(lines, status='ParcialmenteCorrecto'):
+    return _envelope(
+        '<siiR:RespuestaLRFacturasEmitidas>'
+        '<siiR:CSV>BATCHCSV</siiR:CSV>'
+        '<siiR:Cabecera><sii:IDVersionSii>1.1</sii:IDVersionSii>'
+        '</siiR:Cabecera>'
+        '<siiR:EstadoEnvio>%s</siiR:EstadoEnvio>'
+        '%s'
+        '</siiR:RespuestaLRFacturasEmitidas>' % (status, ''.join(lines)))
+
+
+_LINES = [
+    _line('F1', 'Correcto'),
+    _line('F2', 'Incorrecto', 1100),
+    _line(
+        'F3', 'Incorrecto', 3000,
+        extra='<siiR:RegistroDuplicado><sii:EstadoRegistro>Correcta'
+        '</sii:EstadoRegistro></siiR:RegistroDuplicado>'),
+    _line(
+        'F4', 'AceptadoConErrores', 2011,
+        issuer='<sii:IDOtro><sii:CodigoPais>FR</sii:CodigoPais>'
+        '<sii:IDType>02</sii:IDType><sii:ID>FR999</sii:ID></sii:IDOtro>'),
+]
+
+
+def test_lines():
+    lines = ResponseLines(BytesIO(_submit_response(_LINES)))
+    assert lines.status is None
+    results = list(lines)
+    assert lines.status == 'ParcialmenteCorrecto'
+    assert lines.csv == 'BATCHCSV'
+    assert [r.key for r in results] == [
+        ('B12345678', 'F1', '31-12-2017'),
+        ('B12345678', 'F2', '31-12-2017'),
+        ('B12345678', 'F3', '31-12-2017'),
+        ('FR999', 'F4', '31-12-2017'),
+    ]
+    assert [r.status for r in results] == [
+        'Correcto', 'Incorrecto', 'Incorrecto', 'AceptadoConErrores']
+    assert [r.error_code for r in results] == [None, 1100, 3000, 2011]
+    assert results[1].error_description == 'Error 1100'
+    assert [r.duplicated for r in results] == [False, False, True, False]
+
+
+def test_lines_are_released():
+    parents = []
+    original = InvoiceResult.from_element.__func__
+
+    def from_element(cls, line):
+        parents.append(len(line.getparent()))
+        return original(cls, line)
+
+    with mock.patch.object(
+            InvoiceResult, 'from_element', classmethod(from_element)):
+        list(ResponseLines(BytesIO(_submit_response(_LINES * 500))))
+    assert len(parents) == 2000
+    # Only the lines the parser has read ahead of the one being yielded
+    assert max(parents) < 200
+
+
+def test_fault():
+    content = _envelope(
+        '<env:Fault><faultcode>env:Client</faultcode>'
+        '<faultstring>Codigo[4102].El XML no cumple el esquema'
+        '</faultstring></env:Fault>')
+    with pytest.raises(Fault) as excinfo:
+        list(ResponseLines(BytesIO(content)))
+    assert excinfo.value.code == 'env:Client'
+    assert excinfo.value.message.startswith('Codigo[4102]')
+
+
+def test_query_records():
+    content = _envelope(
+        '<siiR:RespuestaConsultaLRFacturasEmitidas>'
+        '<siiR:IndicadorPaginacion>S</siiR:IndicadorPaginacion>'
+        '<siiR:ResultadoConsulta>ConDatos</siiR:ResultadoConsulta>'
+        '<siiR:RegistroRespuestaConsultaLRFacturasEmitidas>'
+        '<siiR:IDFactura><sii:IDEmisorFactura><sii:NIF>B12345678</sii:NIF>'
+        '</sii:IDEmisorFactura>'
+        '<sii:NumSerieFacturaEmisor>F1</sii:NumSerieFacturaEmisor>'
+        '<sii:FechaExpedicionFacturaEmisor>31-12-2017'
+        '</sii:FechaExpedicionFacturaEmisor></siiR:IDFactura>'
+        '<siiR:DatosPresentacion><sii:CSV>LINECSV</sii:CSV>'
+        '</siiR:DatosPresentacion>'
+        '<siiR:EstadoFactura>'
+        '<siiR:EstadoRegistro>AceptadaConErrores</siiR:EstadoRegistro>'
+        '<siiR:CodigoErrorRegistro>2011</siiR:CodigoErrorRegistro>'
+        '</siiR:EstadoFactura>'
+        '</siiR:RegistroRespuestaConsultaLRFacturasEmitidas>'
+        '</siiR:RespuestaConsultaLRFacturasEmitidas>')
+    lines = ResponseLines(BytesIO(content))
+    results = list(lines)
+    assert lines.status == 'ConDatos'
+    assert lines.csv is None
+    assert lines.more
+    assert [(r.serial_number, r.status, r.error_code) for r in results] == [
+        ('F1', 'AceptadaConErrores', 2011)]
+
+
+def test_from_streamed_response():
+    content = _submit_response(_LINES)
+
+    def respond(handler, body):
+        return 200, [('Content-Type', 'text/xml')], content
+
+    with serve(respond) as server:
+        response = requests.post(server.url, data=b'', stream=True)
+        lines = ResponseLines.from_response(response, streamed=True)
+        assert [r.serial_number for r in lines] == ['F1', 'F2', 'F3', 'F4']
+        assert lines.status == 'ParcialmenteCorrecto'
+
+
+def test_from_response_http_error():
+    response = mock.MagicMock(status_code=503, content=b'Unavailable')
+    with pytest.raises(TransportError) as excinfo:
+        ResponseLines.from_response(response)
+    assert excinfo.value.status_code == 503
+    assert response.close.called
+
+
+def test_submit_lines():
+    session_plugin = plugins.SessionIdPlugin()
+    proxy = mock.MagicMock()
+    proxy._client.plugins = [session_plugin]
+    proxy.SuministroLRFacturasEmitidas.return_value = mock.MagicMock(
+        status_code=200, content=_submit_response(_LINES),
+        headers={'Set-Cookie': 'JSESSIONID=abc; Path=/'})
+    svc = service._IssuedInvoiceService(proxy)
+    lines = svc.submit('HEADERS', ['INVOICE'], result='lines')
+    proxy._client.settings.assert_called_once_with(raw_response=True)
+    assert [r.status for r in lines] == [
+        'Correcto', 'Incorrecto', 'Incorrecto', 'AceptadoConErrores']
+    assert session_plugin.cookies == {'JSESSIONID': 'abc'}
+
+
+def test_unknown_result():
+    svc = service._IssuedInvoiceService(mock.MagicMock())
+    with pytest.raises(ValueError):
+        svc.submit('HEADERS', ['INVOICE'], result='unknown')
+
+
+def test_batch_result():
+    batch = BatchResult.from_lines(
+        ResponseLines(BytesIO(_submit_response(_LINES))))
+    assert batch.status == 'ParcialmenteCorrecto'
+    assert batch.csv == 'BATCHCSV'
+    assert len(batch) == 4
+    assert [r.serial_number for r in batch] == ['F1', 'F2', 'F3', 'F4']
+    assert batch['B12345678', 'F2', '31-12-2017'].error_code == 1100
+    assert batch['B12345678', 'F2', date(2017, 12, 31)].error_code == 1100
+    assert ('FR999', 'F4', '31-12-2017') in batch
+    assert ('FR999', 'F5', '31-12-2017') not in batch
+    assert batch.get(('FR999', 'F5', '31-12-2017')) is None
+    with pytest.raises(KeyError):
+        batch['FR999', 'F5', '31-12-2017']
+    assert [r.serial_number for r in batch.accepted] == ['F1', 'F4']
+    assert [r.serial_number for r in batch.correct] == ['F1']
+    assert [r.serial_number for r in batch.accepted_with_errors] == ['F4']
+    assert [r.serial_number for r in batch.rejected] == ['F2', 'F3']
+    assert [r.serial_number for r in batch.with_error(3000, 2011)] == [
+        'F3', 'F4']
+    assert batch.error_codes() == {1100: 1, 3000: 1, 2011: 1}
+
+
+def test_batch_result_from_zeep_response():
+    def line(serial, status, **kwargs):
+        return dict({
+            'IDFactura': {
+                'IDEmisorFactura': {'NIF': 'B12345678'},
+                'NumSerieFacturaEmisor': serial,
+                'FechaExpedicionFacturaEmisor': '31-12-2017',
+            },
+            'EstadoRegistro': status,
+        }, **kwargs)
+
+    batch = BatchResult.from_response({
+        'CSV': 'BATCHCSV',
+        'EstadoEnvio': 'ParcialmenteCorrecto',
+        'RespuestaLinea': [
+            line('F1', 'Correcto', CSV='LINECSV'),
+            line(
+                'F2', 'Incorrecto', CodigoErrorRegistro=3000,
+                RegistroDuplicado={'EstadoRegistro': 'Correcta'}),
+        ],
+    })
+    assert batch.status == 'ParcialmenteCorrecto'
+    assert batch['B12345678', 'F1', '31-12-2017'].csv == 'LINECSV'
+    rejected, = batch.rejected
+    assert rejected.error_code == 3000
+    assert rejected.duplicated
+
+
+def test_submit_batch():
+    proxy = mock.MagicMock()
+    proxy._client.plugins = []
+    proxy.SuministroLRFacturasEmitidas.return_value = mock.MagicMock(
+        status_code=200, content=_submit_response(_LINES), headers={})
+    svc = service._IssuedInvoiceService(proxy)
+    batch = svc.submit('HEADERS', ['INVOICE'], result='batch')
+    assert isinstance(batch, BatchResult)
+    assert len(batch.rejected) == 2
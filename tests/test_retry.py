@@ -0,0 +1,232 @@
+import pytest
+import requests
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from zeep.exceptions import Fault, TransportError
+
+from pyAEATsii import retry
+from pyAEATsii import service
+
+from .stub import BASE, seeded_cache, serve
+from .test_results import _envelope, _line, _submit_response
+
+
+def _fault(code, message):
+    return _envelope(
+        '<env:Fault><faultcode>%s</faultcode>'
+        '<faultstring>%s</faultstring></env:Fault>' % (code, message))
+
+
+def _record(serial):
+    return {
+        'IDFactura': {
+            'IDEmisorFactura': {'NIF': 'B12345678'},
+            'NumSerieFacturaEmisor': serial,
+            'FechaExpedicionFacturaEmisor': '31-12-2017',
+        },
+    }
+
+
+def _policy(**kwargs):
+    return retry.RetryPolicy(sleep=lambda seconds: None, **kwargs)
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_fault_code():
+    assert retry.fault_code(Fault('Codigo[4102].El XML no cumple')) == 4102
+    assert retry.fault_code(Fault('Internal error')) is None
+
+
+def test_is_retryable():
+    policy = _policy(fault_codes=[1117])
+    assert policy.is_retryable(Fault('Error', code='env:Server'))
+    assert policy.is_retryable(Fault('Codigo[1117].Busy', code='env:Client'))
+    assert not policy.is_retryable(Fault('Codigo[4102].', code='env:Client'))
+    assert policy.is_retryable(TransportError(status_code=503))
+    assert not policy.is_retryable(TransportError(status_code=403))
+    assert policy.is_retryable(requests.ConnectionError())
+    assert policy.is_retryable(requests.Timeout())
+    assert not policy.is_retryable(ValueError())
+
+
+def test_delay():
+    policy = _policy(backoff=1.0, max_backoff=5.0)
+    with mock.patch('random.uniform', side_effect=lambda a, b: b):
+        assert [policy.delay(n) for n in range(1, 6)] == [1, 2, 4, 5, 5]
+
+
+def test_call():
+    sleeps = []
+    policy = retry.RetryPolicy(max_attempts=3, sleep=sleeps.append)
+    function = mock.Mock(side_effect=[
+        requests.ConnectionError(), TransportError(status_code=502), 'OK'])
+    assert policy.call(function, 'a', b=1) == ('OK', 3)
+    function.assert_called_with('a', b=1)
+    assert len(sleeps) == 2
+
+    function = mock.Mock(side_effect=requests.ConnectionError())
+    with pytest.raises(requests.ConnectionError):
+        policy.call(function)
+    assert function.call_count == 3
+
+    function = mock.Mock(side_effect=ValueError())
+    with pytest.raises(ValueError):
+        policy.call(function)
+    assert function.call_count == 1
+
+
+def test_circuit_breaker():
+    clock = _Clock()
+    breaker = retry.CircuitBreaker(
+        failure_threshold=2, reset_timeout=10, clock=clock)
+    policy = _policy(max_attempts=1, breaker=breaker)
+    failing = mock.Mock(side_effect=TransportError(status_code=503))
+
+    for n in range(2):
+        with pytest.raises(TransportError):
+            policy.call(failing)
+    assert breaker.is_open
+    with pytest.raises(retry.CircuitOpenError):
+        policy.call(failing)
+    assert failing.call_count == 2
+
+    # A failed trial call opens it again
+    clock.now = 10
+    with pytest.raises(TransportError):
+        policy.call(failing)
+    assert failing.call_count == 3
+    with pytest.raises(retry.CircuitOpenError):
+        policy.call(failing)
+
+    clock.now = 20
+    assert policy.call(lambda: 'OK') == ('OK', 1)
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_blocks():
+    clock = _Clock()
+
+    def sleep(seconds):
+        clock.now += seconds
+
+    breaker = retry.CircuitBreaker(
+        failure_threshold=1, reset_timeout=10, block=True, clock=clock,
+        sleep=sleep)
+    breaker.record_failure()
+    breaker.before_call()
+    assert clock.now == 10
+
+
+def _flaky_service(tmpdir, server, policy):
+    client = service._get_client(
+        BASE + 'stub.wsdl', 'crt', 'key', cache=seeded_cache(tmpdir),
+        offline=True)
+    client.transport.session.cert = None
+    client.settings.force_https = False
+    proxy = client.create_service(
+        '{urn:pyAEATsii:stub}StubBinding', server.url)
+    return service._IssuedInvoiceService(proxy, retry=policy)
+
+
+def test_submit_retries_flaky_stub(tmpdir):
+    responses = [
+        (503, [], b'Service Unavailable'),
+        (500, [('Content-Type', 'text/xml')],
+         _fault('env:Server', 'Error interno')),
+        (200, [('Content-Type', 'text/xml')], _submit_response([
+            _line('F1', 'Correcto'),
+            _line('F2', 'Incorrecto', 3000),
+        ])),
+        (200, [('Content-Type', 'text/xml')], _submit_response([
+            _line('F2', 'Correcto'),
+        ], status='Correcto')),
+    ]
+
+    def respond(handler, body):
+        return responses.pop(0)
+
+    with serve(respond) as server:
+        svc = _flaky_service(tmpdir, server, _policy())
+        batch = svc.submit(
+            {'TipoComunicacion': 'A0'}, [_record('F1'), _record('F2')],
+            stream=True, result='batch')
+        sent = [body for headers, body in server.requests]
+
+    assert not responses
+    assert batch.status == 'Correcto'
+    assert [line.status for line in batch] == ['Correcto', 'Correcto']
+    assert len(sent) == 4
+    assert sent[0] == sent[1] == sent[2]
+    assert b'>A1<' in sent[3]
+    assert b'F2' in sent[3] and b'F1' not in sent[3]
+
+
+def test_submit_gives_up_on_client_fault(tmpdir):
+    def respond(handler, body):
+        return (500, [('Content-Type', 'text/xml')], _fault(
+            'env:Client', 'Codigo[4102].El XML no cumple el esquema'))
+
+    with serve(respond) as server:
+        svc = _flaky_service(tmpdir, server, _policy())
+        with pytest.raises(Fault):
+            svc.submit(
+                {'TipoComunicacion': 'A0'}, [_record('F1')], stream=True,
+                result='batch')
+        assert len(server.requests) == 1
+
+
+def _response_line(serial, status, code=None):
+    return dict(_record(serial), EstadoRegistro=status,
+                CodigoErrorRegistro=code)
+
+
+def test_submit_resends_duplicated_as_a1():
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas.side_effect = [
+        requests.ConnectionError(),
+        {
+            'EstadoEnvio': 'ParcialmenteCorrecto',
+            'RespuestaLinea': [
+                _response_line('F1', 'Correcto'),
+                _response_line('F2', 'Incorrecto', 3000),
+            ],
+        },
+        {
+            'EstadoEnvio': 'Correcto',
+            'RespuestaLinea': [_response_line('F2', 'Correcto')],
+        },
+    ]
+    svc = service._IssuedInvoiceService(proxy, retry=_policy())
+    response = svc.submit(
+        {'TipoComunicacion': 'A0'}, [_record('F1'), _record('F2')])
+    assert response['EstadoEnvio'] == 'Correcto'
+    assert [
+        line['EstadoRegistro'] for line in response['RespuestaLinea']
+    ] == ['Correcto', 'Correcto']
+    headers, records = proxy.SuministroLRFacturasEmitidas.call_args[0]
+    assert headers['TipoComunicacion'] == 'A1'
+    assert records == [_record('F2')]
+
+
+def test_duplicated_without_retry_is_kept():
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas.return_value = {
+        'EstadoEnvio': 'Incorrecto',
+        'RespuestaLinea': [_response_line('F1', 'Incorrecto', 3000)],
+    }
+    svc = service._IssuedInvoiceService(proxy, retry=_policy())
+    response = svc.submit({'TipoComunicacion': 'A0'}, [_record('F1')])
+    assert response['EstadoEnvio'] == 'Incorrecto'
+    assert proxy.SuministroLRFacturasEmitidas.call_count == 1
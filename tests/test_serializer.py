@@ -0,0 +1,158 @@
+from datetime import date
+
+import pytest
+from lxml import etree
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import mapping
+from pyAEATsii import mockserver
+from pyAEATsii import serializer
+from pyAEATsii import service
+from pyAEATsii.plugins import SessionIdPlugin
+
+from .stub import seeded_cache, serve
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+_NS = {
+    'soapenv': serializer.SOAP_ENV_NS,
+    'siiLR': serializer.SII_LR_NS,
+    'sii': serializer.SII_NS,
+}
+
+
+def _parse(chunks):
+    return etree.fromstring(b''.join(chunks))
+
+
+def _records(count, **variant):
+    mapper = IssuedTestInvoiceMapper()
+    return [
+        mapper.build_submit_request(dict(
+            _INVOICE, serial_number=n, **variant))
+        for n in range(count)
+    ]
+
+
+def test_envelope_structure():
+    headers = mapping.get_headers(
+        name='Company', vat='00000010X', comm_kind='A0')
+    chunks = list(serializer.iter_envelope(
+        'SuministroLRFacturasEmitidas', headers, iter(_records(5)),
+        flush_every=2))
+    assert len(chunks) == 3
+    root = _parse(chunks)
+    request = root.find(
+        'soapenv:Body/siiLR:SuministroLRFacturasEmitidas', _NS)
+    assert request.findtext('sii:Cabecera/sii:TipoComunicacion', None, _NS) \
+        == 'A0'
+    records = request.findall('siiLR:RegistroLRFacturasEmitidas', _NS)
+    assert len(records) == 5
+    assert [
+        etree.QName(child).localname for child in records[0]
+    ] == ['PeriodoLiquidacion', 'IDFactura', 'FacturaExpedida']
+    assert records[4].findtext(
+        'siiLR:IDFactura/sii:NumSerieFacturaEmisor', None, _NS) == '4'
+    assert records[0].findtext(
+        'siiLR:FacturaExpedida/sii:TipoDesglose/sii:DesgloseFactura/'
+        'sii:Sujeta/sii:NoExenta/sii:DesgloseIVA/sii:DetalleIVA/'
+        'sii:TipoImpositivo', None, _NS) == '21.0'
+    # Unset values are left out
+    assert request.find('sii:Cabecera/sii:Titular/sii:NIFRepresentante',
+                        _NS) is None
+
+
+def test_envelope_follows_xsd_order():
+    records = _records(
+        1, invoice_kind='R1', counterpart_id_type='02',
+        counterpart_country='LT')
+    root = _parse(serializer.iter_envelope(
+        'SuministroLRFacturasEmitidas', {}, records))
+    invoice = root.find('.//siiLR:FacturaExpedida', _NS)
+    names = [etree.QName(child).localname for child in invoice]
+    assert names[:3] == [
+        'TipoFactura', 'TipoRectificativa', 'ImporteRectificacion']
+    assert names[-2:] == ['Contraparte', 'TipoDesglose']
+    assert [
+        etree.QName(child).localname
+        for child in invoice.find('sii:Contraparte/sii:IDOtro', _NS)
+    ] == ['CodigoPais', 'IDType', 'ID']
+
+
+def test_cancel_envelope():
+    mapper = IssuedTestInvoiceMapper()
+    root = _parse(serializer.iter_envelope(
+        'AnulacionLRFacturasEmitidas', {},
+        [mapper.build_delete_request(_INVOICE)]))
+    assert root.find(
+        'soapenv:Body/siiLR:BajaLRFacturasEmitidas/'
+        'siiLR:RegistroLRBajaExpedidas/siiLR:IDFactura/'
+        'sii:FechaExpedicionFacturaEmisor', _NS).text == '31-12-2017'
+
+
+def test_post_envelope():
+    posted = {}
+
+    def post(url, data, headers, timeout, stream):
+        posted.update(
+            url=url, body=data.read(), headers=headers, stream=stream)
+        return response
+
+    response = mock.MagicMock(status_code=200)
+    session_plugin = SessionIdPlugin()
+    session_plugin.cookies['JSESSIONID'] = 'abc'
+    service = mock.MagicMock()
+    service._binding_options = {'address': 'https://sii.invalid/ws'}
+    service._client.plugins = [session_plugin]
+    service._client.transport.session.post.side_effect = post
+    service._binding.process_reply.return_value = 'RESULT'
+
+    result = serializer.post_envelope(
+        service, 'SuministroLRFacturasEmitidas', {},
+        (r for r in _records(3)))
+    assert result == 'RESULT'
+    assert posted['url'] == 'https://sii.invalid/ws'
+    assert posted['headers']['Cookie'] == 'JSESSIONID=abc'
+    assert not posted['stream']
+    assert len(_parse([posted['body']]).findall(
+        './/siiLR:RegistroLRFacturasEmitidas', _NS)) == 3
+    service._binding.get.assert_called_once_with(
+        'SuministroLRFacturasEmitidas')
+    args = service._binding.process_reply.call_args[0]
+    assert args[2] is response
+
+
+@pytest.mark.parametrize('stream', [True, 'chunked'])
+def test_submit_chunked(tmpdir, stream):
+    aeat = mockserver.MockSIIServer()
+
+    def respond(handler, body):
+        status, content = aeat.respond(body)
+        return status, [('Content-Type', 'text/xml; charset=utf-8')], content
+
+    with serve(respond) as server:
+        svc = service.bind_issued_invoices_service(
+            None, None, cache=seeded_cache(tmpdir, base=service.wsdl_base),
+            offline=True, address=server.url)
+        batch = svc.submit(
+            mapping.get_headers(
+                name='Company', vat='00000010X', comm_kind='A0'),
+            [dict(_INVOICE, serial_number=n) for n in range(3)],
+            IssuedTestInvoiceMapper(), stream=stream, result='batch')
+    assert batch.status == 'Correcto'
+    assert len(aeat.invoices()) == 3
+    (http_headers, body), = server.requests
+    if stream == 'chunked':
+        assert http_headers['Transfer-Encoding'] == 'chunked'
+        assert 'Content-Length' not in http_headers
+    else:
+        assert http_headers['Content-Length'] == str(len(body))
+
+
+def test_text_values():
+    assert serializer._text(21.0) == '21.0'
+    assert serializer._text(5.2) == '5.2'
+    assert serializer._text(date(2017, 1, 1)) == '2017-01-01'
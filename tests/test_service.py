@@ -0,0 +1,287 @@
+import threading
+import time
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from pyAEATsii import plugins
+from pyAEATsii import results
+from pyAEATsii import service
+
+from .stub import BASE, seeded_cache
+from .test_results import _line, _submit_response
+
+
+class _Mapper(object):
+
+    def build_submit_request(self, invoice):
+        return {'submit': invoice}
+
+    def build_delete_request(self, invoice):
+        return {'delete': invoice}
+
+
+def _issued_service():
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas.side_effect = \
+        lambda headers, body: len(body)
+    proxy.AnulacionLRFacturasEmitidas.side_effect = \
+        lambda headers, body: len(body)
+    return service._IssuedInvoiceService(proxy), proxy
+
+
+def test_chunks():
+    assert list(service._chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(service._chunks([], 2)) == []
+
+
+def test_chunks_invalid_size():
+    with pytest.raises(ValueError):
+        list(service._chunks(range(5), 0))
+
+
+def test_submit_maps_invoices():
+    svc, proxy = _issued_service()
+    svc.submit('HEADERS', [1, 2], mapper=_Mapper())
+    proxy.SuministroLRFacturasEmitidas.assert_called_once_with(
+        'HEADERS', [{'submit': 1}, {'submit': 2}])
+
+
+def test_submit_batches():
+    svc, proxy = _issued_service()
+    responses = svc.submit_batches(
+        'HEADERS', iter(range(5)), mapper=_Mapper(), batch_size=2)
+    assert responses == [2, 2, 1]
+    assert proxy.SuministroLRFacturasEmitidas.call_count == 3
+    proxy.SuministroLRFacturasEmitidas.assert_called_with(
+        'HEADERS', [{'submit': 4}])
+
+
+def test_cancel_batches():
+    svc, proxy = _issued_service()
+    responses = svc.cancel_batches('HEADERS', range(3), batch_size=2)
+    assert responses == [2, 1]
+    proxy.AnulacionLRFacturasEmitidas.assert_called_with('HEADERS', [2])
+
+
+def test_recieved_operations():
+    proxy = mock.MagicMock()
+    svc = service._RecievedInvoiceService(proxy)
+    svc.submit('HEADERS', [1])
+    svc.cancel('HEADERS', [1])
+    svc.query('HEADERS', year=2017, period=1)
+    assert proxy.SuministroLRFacturasRecibidas.called
+    assert proxy.AnulacionLRFacturasRecibidas.called
+    assert proxy.ConsultaLRFacturasRecibidas.called
+
+
+def test_submit_many_keeps_order():
+    svc, proxy = _issued_service()
+    responses = svc.submit_many(
+        'HEADERS', range(7), mapper=_Mapper(), batch_size=2, max_workers=3)
+    assert responses == [2, 2, 2, 1]
+    assert proxy.SuministroLRFacturasEmitidas.call_count == 4
+
+
+def test_submit_many_bounds_in_flight():
+    lock = threading.Lock()
+    state = {'running': 0, 'peak': 0}
+
+    def _slow(headers, body):
+        with lock:
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        time.sleep(0.01)
+        with lock:
+            state['running'] -= 1
+        return body[0]
+
+    proxy = mock.MagicMock()
+    proxy.SuministroLRFacturasEmitidas.side_effect = _slow
+    svc = service._IssuedInvoiceService(proxy)
+    responses = svc.submit_many(
+        'HEADERS', range(20), batch_size=1, max_workers=3)
+    assert responses == list(range(20))
+    assert state['peak'] <= 3
+
+
+def test_cancel_many():
+    svc, proxy = _issued_service()
+    responses = svc.cancel_many('HEADERS', range(3), batch_size=2)
+    assert responses == [2, 1]
+    assert proxy.AnulacionLRFacturasEmitidas.call_count == 2
+
+
+def test_history_opt_in(tmpdir):
+    wsdl_cache = seeded_cache(tmpdir)
+    client = service._get_client(
+        BASE + 'stub.wsdl', 'crt', 'key', cache=wsdl_cache, offline=True)
+    assert service._IssuedInvoiceService(
+        client.bind('siiService', 'Stub')).history is None
+
+    history = plugins.BoundedHistoryPlugin(maxlen=2)
+    client = service._get_client(
+        BASE + 'stub.wsdl', 'crt', 'key', cache=wsdl_cache, offline=True,
+        history=history)
+    assert service._IssuedInvoiceService(
+        client.bind('siiService', 'Stub')).history is history
+
+
+def _page(records, more):
+    return {
+        'IndicadorPaginacion': 'S' if more else 'N',
+        'RegistroRespuestaConsultaLRFacturasEmitidas': [
+            {'IDFactura': {
+                'IDEmisorFactura': {'NIF': '00000010X', 'IDOtro': None},
+                'NumSerieFacturaEmisor': str(n),
+                'FechaExpedicionFacturaEmisor': '31-12-2017',
+            }}
+            for n in records
+        ],
+    }
+
+
+def _paged_service():
+    pages = {
+        None: _page([1, 2], True),
+        '2': _page([3, 4], True),
+        '4': _page([], False),
+    }
+
+    def _query(headers, filter_):
+        key = filter_.get('ClavePaginacion')
+        if key:
+            assert key['IDEmisorFactura'] == {'NIF': '00000010X'}
+            key = key['NumSerieFacturaEmisor']
+        return pages[key]
+
+    proxy = mock.MagicMock()
+    proxy.ConsultaLRFacturasEmitidas.side_effect = _query
+    return service._IssuedInvoiceService(proxy), proxy
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_query_iter(prefetch):
+    svc, proxy = _paged_service()
+    records = svc.query_iter('HEADERS', 2017, 12, prefetch=prefetch)
+    assert [
+        r['IDFactura']['NumSerieFacturaEmisor'] for r in records
+    ] == ['1', '2', '3', '4']
+    assert proxy.ConsultaLRFacturasEmitidas.call_count == 3
+
+
+def test_query_iter_last_page():
+    proxy = mock.MagicMock()
+    proxy.ConsultaLRFacturasEmitidas.return_value = _page([1], False)
+    svc = service._IssuedInvoiceService(proxy)
+    assert len(list(svc.query_iter('HEADERS', 2017, 12))) == 1
+    assert proxy.ConsultaLRFacturasEmitidas.call_count == 1
+
+
+def test_query_filters():
+    proxy = mock.MagicMock()
+    svc = service._IssuedInvoiceService(proxy)
+    svc.query('HEADERS', 2017, 12, modified_invoice=True)
+    headers, filter_ = proxy.ConsultaLRFacturasEmitidas.call_args[0]
+    assert filter_['FacturaModificada'] == 'S'
+
+
+def test_submit_stream():
+    svc, proxy = _issued_service()
+    with mock.patch.object(service, 'post_envelope') as post_envelope:
+        post_envelope.side_effect = \
+            lambda service_, operation, headers, records, **kw: list(records)
+        responses = svc.submit_batches(
+            'HEADERS', range(3), _Mapper(), batch_size=2, stream=True)
+    assert responses == [[{'submit': 0}, {'submit': 1}], [{'submit': 2}]]
+    assert post_envelope.call_args[0][:3] == (
+        proxy, 'SuministroLRFacturasEmitidas', 'HEADERS')
+    assert not proxy.SuministroLRFacturasEmitidas.called
+
+
+def test_resubmit_rejected():
+    outcomes = {
+        'F2': [('Correcto', None)],
+        'F3': [('Incorrecto', 3500), ('Incorrecto', 3500)],
+    }
+    sent = []
+
+    def submit(headers, records):
+        serials = [
+            r['IDFactura']['NumSerieFacturaEmisor'] for r in records]
+        sent.append(serials)
+        return mock.MagicMock(status_code=200, headers={}, content=(
+            _submit_response([
+                _line(serial, *outcomes[serial].pop(0))
+                for serial in serials
+            ])))
+
+    proxy = mock.MagicMock()
+    proxy._client.plugins = []
+    proxy.SuministroLRFacturasEmitidas.side_effect = submit
+    svc = service._IssuedInvoiceService(proxy)
+
+    mapper = mock.Mock()
+    mapper.build_submit_request.side_effect = lambda serial: {
+        'IDFactura': {
+            'IDEmisorFactura': {'NIF': 'B12345678'},
+            'NumSerieFacturaEmisor': serial,
+            'FechaExpedicionFacturaEmisor': '31-12-2017',
+        },
+    }
+    response = {
+        'EstadoEnvio': 'ParcialmenteCorrecto',
+        'RespuestaLinea': [
+            {
+                'IDFactura': mapper.build_submit_request(serial)['IDFactura'],
+                'EstadoRegistro': status,
+                'CodigoErrorRegistro': code,
+            }
+            for serial, status, code in [
+                ('F1', 'Correcto', None),
+                ('F2', 'Incorrecto', 3501),
+                ('F3', 'Incorrecto', 3500),
+                ('F4', 'Incorrecto', 1100),
+            ]
+        ],
+    }
+    mapper.build_submit_request.reset_mock()
+
+    batch = svc.resubmit_rejected(
+        'HEADERS', ['F1', 'F2', 'F3', 'F4'], response, mapper, rounds=2)
+    assert sent == [['F2', 'F3'], ['F3']]
+    # Only the rejected invoices were mapped, once
+    assert [
+        c[0][0] for c in mapper.build_submit_request.call_args_list
+    ] == ['F2', 'F3']
+    assert [(line.serial_number, line.status) for line in batch] == [
+        ('F1', 'Correcto'), ('F2', 'Correcto'), ('F3', 'Incorrecto'),
+        ('F4', 'Incorrecto')]
+    assert batch.status == 'ParcialmenteCorrecto'
+    assert [line.serial_number for line in batch.retryable()] == ['F3']
+    assert [
+        line.serial_number for line in batch.permanently_rejected()
+    ] == ['F4']
+
+
+def test_resubmit_rejected_out_of_order():
+    records = [
+        {'IDFactura': {
+            'IDEmisorFactura': {'NIF': 'B12345678'},
+            'NumSerieFacturaEmisor': serial,
+            'FechaExpedicionFacturaEmisor': '31-12-2017',
+        }}
+        for serial in ('F1', 'F2')
+    ]
+    batch = results.BatchResult(None, None, [
+        results.InvoiceResult(
+            'B12345678', 'F2', '31-12-2017', 'Incorrecto', 3500),
+        results.InvoiceResult('B12345678', 'F1', '31-12-2017', 'Correcto'),
+    ])
+    found = service._rejected_records(
+        batch, records, None, results.TRANSIENT_ERRORS)
+    assert list(found.values()) == [records[1]]
@@ -0,0 +1,107 @@
+import pytest
+
+from pyAEATsii import validation
+
+from .stub import BASE, seeded_cache
+from .test_compiled import IssuedTestInvoiceMapper, _INVOICE
+
+
+def _record(**values):
+    return IssuedTestInvoiceMapper().build_submit_request(
+        dict(_INVOICE, **values))
+
+
+def _errors(record, **kwargs):
+    return [
+        (error.path, error.message)
+        for error in validation.Validator(**kwargs).validate(record)
+    ]
+
+
+@pytest.mark.parametrize('values', [
+    {},
+    {'invoice_kind': 'F2'},
+    {'invoice_kind': 'R1'},
+    {'invoice_kind': 'R1', 'rectified_invoice_kind': 'I'},
+    {'invoice_kind': 'R5', 'rectified_invoice_kind': 'I'},
+])
+def test_mapped_records_are_valid(values):
+    assert _errors(_record(**values)) == []
+
+
+def test_counterpart_rules():
+    record = _record()
+    del record['FacturaExpedida']['Contraparte']
+    assert _errors(record) == [
+        ('FacturaExpedida/Contraparte', 'Required for F1 invoices')]
+
+    record = _record(invoice_kind='F2')
+    record['FacturaExpedida']['Contraparte'] = {'NIF': '00000011B'}
+    assert _errors(record) == [
+        ('FacturaExpedida/Contraparte', 'Not allowed for F2 invoices')]
+
+
+def test_rectification_rules():
+    record = _record(invoice_kind='R1')
+    del record['FacturaExpedida']['ImporteRectificacion']['CuotaRectificada']
+    assert _errors(record) == [(
+        'FacturaExpedida/ImporteRectificacion/CuotaRectificada',
+        'Required for substitutive rectifications')]
+
+    record = _record(invoice_kind='R2', rectified_invoice_kind=None)
+    assert _errors(record) == [(
+        'FacturaExpedida/TipoRectificativa',
+        'Must be S or I for R2 invoices')]
+
+    record = _record()
+    record['FacturaExpedida']['TipoRectificativa'] = 'I'
+    assert _errors(record) == [(
+        'FacturaExpedida/TipoRectificativa',
+        'Only allowed for rectifying invoices')]
+
+
+def test_period_and_id_rules():
+    record = _record(year=17)
+    record['PeriodoLiquidacion']['Periodo'] = '13'
+    record['IDFactura']['FechaExpedicionFacturaEmisor'] = '2017-12-31'
+    assert [path for path, message in _errors(record)] == [
+        'PeriodoLiquidacion/Ejercicio',
+        'PeriodoLiquidacion/Periodo',
+        'IDFactura/FechaExpedicionFacturaEmisor',
+    ]
+    assert _errors(_record(period='1T')) == []
+
+
+def test_xsd(tmpdir):
+    cache = seeded_cache(tmpdir)
+    kwargs = {'cache': cache, 'schema_url': BASE + 'SuministroLR.xsd'}
+    assert _errors(_record(), **kwargs) == []
+
+    record = _record(total_amount='a lot', counterpart_nif='B123')
+    errors = _errors(record, rules=(), **kwargs)
+    assert [path for path, message in errors] == [
+        'FacturaExpedida/ImporteTotal',
+        'FacturaExpedida/Contraparte/NIF',
+    ]
+    assert 'ImporteTotal' in errors[0][1]
+
+
+def test_load_schema_not_cached(tmpdir):
+    with pytest.raises(IOError):
+        validation.load_schema(seeded_cache(tmpdir))
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_partition(tmpdir, max_workers):
+    validator = validation.Validator(
+        cache=seeded_cache(tmpdir), schema_url=BASE + 'SuministroLR.xsd')
+    records = [_record(serial_number=n) for n in range(20)]
+    for n in (3, 17):
+        del records[n]['FacturaExpedida']['Contraparte']
+    valid, errors = validator.partition(
+        records, max_workers=max_workers, chunk_size=4)
+    assert len(valid) == 18
+    assert [(error.index, error.key) for error in errors] == [
+        (3, ('00000010X', '3', '31-12-2017')),
+        (17, ('00000010X', '17', '31-12-2017')),
+    ]